@@ -20,16 +20,18 @@ import csv
 import os
 import io
 from io import StringIO
+from array import array
 from datetime import datetime
 import time
 import sys
 import pandas as pd
 import numpy as np
 import glob
-from util import csvheaders2colNames, log_format # TODO Check ARFF compatibility
+from util import csvheaders2colNames, log_format, write_frame, read_frame # TODO Check ARFF compatibility
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.preprocessing import StandardScaler, OrdinalEncoder
 import joblib
+from joblib import Parallel, delayed
 import importlib
 from functools import reduce
 import tqdm
@@ -40,10 +42,27 @@ warnings.filterwarnings("ignore", category=FutureWarning)
 
 class DataFormatter:
 
-    def __init__(self, dataDir):
+    def __init__(self, dataDir,
+                 checkpoint_format='parquet',
+                 checkpoint_compression='snappy'):
         self.dataDir = dataDir
         self.fmHead = 0
         self.scaler_mod = 'sklearn.preprocessing'
+        self.checkpoint_format = checkpoint_format
+        self.checkpoint_compression = checkpoint_compression
+
+    def checkpoint(self, df, name, index=True):
+        '''
+        :param df: dataframe to checkpoint
+        :param name: checkpoint name without extension (ex. pr_data)
+        :param index: persist the index
+        :return: location of the checkpoint file
+        '''
+        floc = write_frame(df, os.path.join(self.dataDir, name), fmt=self.checkpoint_format,
+                           compression=self.checkpoint_compression, index=index)
+        logger.info('[{}] : [INFO] Checkpoint persisted to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), floc))
+        return floc
 
     def getJson(self):
         return 'load Json'
@@ -666,38 +685,66 @@ class DataFormatter:
                detect=False):
         """
         From PR backend to dataframe
-        :param data: PR response JSON
+        :param data: PR response JSON or an iterator over data.result series (streamed response)
         :return: dataframe
         """
         if not data:
             logger.error('[{}] : [ERROR] PR query response is empty, exiting.'.format(
                     datetime.fromtimestamp(time.time()).strftime(log_format)))
             sys.exit(2)
-        df = pd.DataFrame()
-        df_time = pd.DataFrame()
-        if verbose:
-            dr = tqdm.tqdm(data['data']['result'])
-        else:
+        t_start = time.perf_counter()
+        if isinstance(data, dict):
             dr = data['data']['result']
+        else:
+            dr = data
+        if verbose:
+            dr = tqdm.tqdm(dr)
+        # Decode each series straight into float64 arrays, duplicate series names are overwritten as before
+        series = {}
         for el in dr:
-            metric_name = el['metric']['__name__']
-            instance_name = el['metric']['instance']
-            new_metric = "{}_{}".format(metric_name, instance_name)
-            values = el['values']
-            proc_val = []
-            proc_time = []
-            for val in values:
-                proc_val.append(val[1])
-                proc_time.append(val[0])
-            df[new_metric] = proc_val
-            time_new_metric = "time_{}".format(new_metric)
-            df_time[time_new_metric] = proc_time
-        # Calculate the meant time for all metrics
-        df_time['mean'] = df_time.mean(axis=1)
-        # Round to np.ceil all metrics
-        df_time['mean'] = df_time['mean'].apply(np.ceil)
-        # Add the meant time to rest of metrics
-        df['time'] = df_time['mean']
+            new_metric = "{}_{}".format(el['metric']['__name__'], el['metric']['instance'])
+            series[new_metric] = np.array(el['values'], dtype=np.float64).reshape(-1, 2)
+        t_decode = time.perf_counter()
+        columns = list(series.keys())
+        lengths = np.fromiter((series[c].shape[0] for c in columns), dtype=np.int64, count=len(columns))
+        n_rows = int(lengths.max()) if len(columns) else 0
+        if len(columns) and np.all(lengths == n_rows):
+            # Aligned range matrix, shared grid is the ceil of the mean timestamp of each step
+            ts = np.empty((n_rows, len(columns)), dtype=np.float64)
+            values = np.empty((n_rows, len(columns)), dtype=np.float64)
+            for i, c in enumerate(columns):
+                ts[:, i] = series[c][:, 0]
+                values[:, i] = series[c][:, 1]
+            time_grid = np.ceil(ts.mean(axis=1)).astype(np.int64)
+        elif len(columns):
+            # Series with missing steps are snapped to origin + k * step, step inferred from the longest series,
+            # and aligned on the union of their steps
+            longest = series[columns[int(lengths.argmax())]][:, 0]
+            step = float(np.median(np.diff(longest))) if longest.shape[0] > 1 else 0.0
+            origin = min(series[c][0, 0] for c in columns if series[c].shape[0])
+            if step > 0:
+                steps = {c: np.rint((series[c][:, 0] - origin) / step).astype(np.int64) for c in columns}
+            else:
+                steps = {c: np.ceil(series[c][:, 0]).astype(np.int64) for c in columns}
+            grid = np.unique(np.concatenate(list(steps.values())))
+            values = np.full((grid.shape[0], len(columns)), np.nan, dtype=np.float64)
+            for i, c in enumerate(columns):
+                values[np.searchsorted(grid, steps[c]), i] = series[c][:, 1]
+            time_grid = np.ceil(origin + grid * step).astype(np.int64) if step > 0 else grid
+            logger.warning('[{}] : [WARN] PR query series have unequal lengths, aligned on {} timestamps'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), time_grid.shape[0]))
+        else:
+            values = np.empty((0, 0), dtype=np.float64)
+            time_grid = np.empty(0, dtype=np.int64)
+            logger.warning('[{}] : [WARN] PR query returned no series'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format)))
+        t_align = time.perf_counter()
+        df = pd.DataFrame(values, columns=columns, copy=False)
+        df['time'] = time_grid
+        t_frame = time.perf_counter()
+        logger.info('[{}] : [INFO] PR query ingestion timings: decode {:.4f}s, align {:.4f}s, frame {:.4f}s'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), t_decode - t_start, t_align - t_decode,
+            t_frame - t_align))
         logger.info('[{}] : [INFO] PR query resulted in dataframe of size: {}'.format(
                     datetime.fromtimestamp(time.time()).strftime(log_format), df.shape))
         if index is not None:
@@ -706,13 +753,10 @@ class DataFormatter:
                 datetime.fromtimestamp(time.time()).strftime(log_format), index))
         if checkpoint:
             if detect:
-                pr = "pr_data_detect.csv"
+                pr = "pr_data_detect"
             else:
-                pr = "pr_data.csv"
-            pr_csv_loc = os.path.join(self.dataDir, pr)
-            df.to_csv(pr_csv_loc, index=True)
-            logger.info('[{}] : [INFO] PR query dataframe persisted to {}'.format(
-                    datetime.fromtimestamp(time.time()).strftime(log_format), self.dataDir))
+                pr = "pr_data"
+            self.checkpoint(df, pr)
         return df
     
     def sr_pmds_to_df(self,
@@ -724,53 +768,94 @@ class DataFormatter:
         :param node_id: name of field for unique identifier for nodes, can be node or node_id
         :return: pandas dataframe
         """
-        c_data = {}
-        for e in resp:
-            if f"""{e['_field']}_{e[node_id]}""" in c_data.keys():
-                c_data[f"""{e['_field']}_{e[node_id]}"""].append((pd.to_datetime(e['_time']), e['_value']))
-            else:
-                c_data[f"""{e['_field']}_{e[node_id]}"""] = [(pd.to_datetime(e['_time']), e['_value'])]
-
-        list_df = []
-        for k, v in c_data.items():
-            list_df.append(pd.DataFrame(v, columns=[f'time_{k}', k]))
-
-        df_central = pd.concat(list_df, axis=1, join='inner')
-        # Timestamp columns to drop
-        t_columns = df_central.filter(regex='^time', axis=1).columns
-        # TODO calculate mean timestamp for each row
-        df_central['time'] = df_central[
-            df_central.filter(regex='^time', axis=1).columns[0]]  # regex with begin anchor, $ for end anchor
-        df_central.drop(t_columns, axis=1, inplace=True)
-        # df_central.set_index('time', inplace=True)
+        # Records are consumed one at a time into code and value arrays, a streamed response is never
+        # materialized as a list of records
+        time_codes = {}
+        column_codes = {}
+        tcode = array('q')
+        ccode = array('q')
+        values = array('d')
+        other = {}  # record position and value of non numeric samples
+        for rec in resp:
+            column = '{}_{}'.format(rec.get('_field'), rec.get(node_id))
+            ccode.append(column_codes.setdefault(column, len(column_codes)))
+            tcode.append(time_codes.setdefault(rec.get('_time'), len(time_codes)))
+            value = rec.get('_value')
+            try:
+                values.append(np.nan if value is None else float(value))
+            except (TypeError, ValueError):
+                other[len(values)] = value
+                values.append(np.nan)
+        if not column_codes:
+            logger.warning('[{}] : [WARN] PMDS response contains no records'.format(
+                datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')))
+            return pd.DataFrame(columns=['time'])
+        ccode = np.frombuffer(ccode, dtype=np.int64)
+        tcode = np.frombuffer(tcode, dtype=np.int64)
+        values = np.frombuffer(values, dtype=np.float64)
+        # Series are aligned by position, the n-th sample of every series forms a row
+        counts = np.bincount(ccode, minlength=len(column_codes))
+        order = np.argsort(ccode, kind='stable')
+        pos = np.empty_like(ccode)
+        pos[order] = np.arange(ccode.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        nrows = int(counts.min())
+        keep = pos < nrows
+        grid = np.full((nrows, len(column_codes)), np.nan, dtype=np.float64)
+        grid[pos[keep], ccode[keep]] = values[keep]
+        df_central = pd.DataFrame(grid, columns=list(column_codes), copy=False)
+        if other:
+            # Series with non numeric samples (ex. status strings) are kept as object columns
+            names = list(column_codes)
+            opos = np.fromiter(other, dtype=np.int64, count=len(other))
+            opos = opos[keep[opos]]
+            for code in np.unique(ccode[opos]).tolist():
+                sel = opos[ccode[opos] == code]
+                column = grid[:, code].astype(object)
+                column[pos[sel]] = [other[i] for i in sel.tolist()]
+                df_central[names[code]] = column
+            logger.warning('[{}] : [WARN] PMDS response contains {} non numeric samples'.format(
+                datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), len(other)))
+        # Timestamps repeat across fields and nodes, parse every distinct value once
+        first = keep & (ccode == 0)
+        rows = np.empty(nrows, dtype=np.int64)
+        rows[pos[first]] = tcode[first]
+        df_central['time'] = pd.to_datetime(pd.Index(list(time_codes), dtype=object))[rows]
         return df_central
 
     def sr_pmds_list_to_df(self,
                            resp_list,
                            checkpoint=False,
                            detect=False,
+                           n_jobs=None
                            ):
         """
         Convert Serrano PMDS response to dataframe
-        :param resp_list: list of responses from node, pods query
+        :param resp_list: list of responses from node, pods query (decoded JSON or streamed record iterators)
+        :param n_jobs: number of responses converted concurrently, defaults to one per response up to the cpu count
         :return: pandas dataframe
         """
-        df_list = []
-        for resp in resp_list:
-            df_list.append(self.sr_pmds_to_df(resp))
+        resp_list = list(resp_list)
+        if not resp_list:
+            logger.warning('[{}] : [WARN] No PMDS responses to convert. Returning empty dataframe.'.format(
+                datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')))
+            return pd.DataFrame()
+        if n_jobs is None:
+            n_jobs = min(len(resp_list), os.cpu_count() or 1)
+        start = time.time()
+        df_list = Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(self.sr_pmds_to_df)(resp) for resp in resp_list)
+        logger.info('[{}] : [INFO] Converted {} PMDS responses in {:.3f} seconds'.format(
+            datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), len(df_list), time.time() - start))
         # Check if all dataframes have the same shape
         if all([set(df_list[0].shape == set(df.shape) for df in df_list)]):
             df = pd.concat(df_list, axis=1)
             df = self.__sr_pmds_df_index_fix(df)
             if checkpoint:
                 if detect:
-                    pr = "pmds_data_detect.csv"
+                    pr = "pmds_data_detect"
                 else:
-                    pr = "pmds_data.csv"
-                pmds_csv_loc = os.path.join(self.dataDir, pr)
-                df.to_csv(pmds_csv_loc, index=True)
-                logger.info('[{}] : [INFO] PMDS query dataframe persisted to {}'.format(
-                    datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.dataDir))
+                    pr = "pmds_data"
+                self.checkpoint(df, pr)
         else:
             logger.warning('[{}] : [WARN] Dataframes do not have the same shape. Returning empty dataframe.'.format(
                 datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')))
@@ -778,39 +863,31 @@ class DataFormatter:
         return df
 
     def sr_cth_metrics_to_df(self, resp_metrics):
-        time_st = []
-        metrics_dict = {}
         if 'error' in resp_metrics.keys():
             logger.error('[{}] : [ERROR] Serrano CTH failed to provide metrics, '
                          'returning empty dataframe ...'.format(datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')))
             return pd.DataFrame()
         try:
+            # One flat row per timestamp, nodes missing from a snapshot become NaN instead of shifting columns
+            time_st = []
+            rows = []
             for e in resp_metrics['metrics']:
                 time_st.append(e['timestamp'])
+                row = {}
                 for n in e['state']['Nodes']:
                     node_name = n['node_name']
                     for k, v in n.items():
+                        if k == 'node_name':
+                            continue
                         if k == 'node_cpus':
                             for cp in v:
-                                for k_cp, v_cp in cp.items():
-                                    if k_cp == 'label':
-                                        continue
-                                    metric = f"{k}_{cp['label']}_{k_cp}_{node_name}"
-                                    if metric in metrics_dict.keys():
-                                        metrics_dict[metric].append(v_cp)
-                                    else:
-                                        metrics_dict[metric] = [v_cp]
+                                label = cp['label']
+                                row.update({f"{k}_{label}_{k_cp}_{node_name}": v_cp
+                                            for k_cp, v_cp in cp.items() if k_cp != 'label'})
                         else:
-                            if k == 'node_name':
-                                continue
-                            metric = f"{k}_{node_name}"
-                            if metric in metrics_dict.keys():
-                                metrics_dict[metric].append(v)
-                            else:
-                                metrics_dict[metric] = [v]
-            metrics_dict['time'] = time_st
-            df_cth_metrics = pd.DataFrame().from_dict(metrics_dict)
-            df_cth_metrics.set_index('time', inplace=True)
+                            row[f"{k}_{node_name}"] = v
+                rows.append(row)
+            df_cth_metrics = pd.DataFrame(rows, index=pd.Index(time_st, name='time'))
             logger.info('[{}] : [INFO] CTH metrics dataframe created'.format(datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')))
         except Exception as inst:
             logger.error('[{}] : [ERROR] CTH metrics dataframe creation failed with {} and {}, returning empty dataframe ...'.format(datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), type(inst), inst.args))
@@ -865,9 +942,10 @@ class DataFormatter:
             dfList.append(df)
         return dfList
 
-    def toDF(self, fileName):
+    def toDF(self, fileName, columns=None):
         '''
-        :param fileName: absolute path to file
+        :param fileName: absolute path to file, csv, parquet or feather
+        :param columns: list of columns to load, None loads all
         :return: dataframe
         '''
         if not os.path.isfile(fileName):
@@ -875,9 +953,57 @@ class DataFormatter:
             logger.error('[%s] : [ERROR] File %s does not exist',
                         datetime.fromtimestamp(time.time()).strftime(log_format), str(fileName))
             sys.exit(1)
-        df = pd.read_csv(fileName)
+        df = read_frame(fileName, columns=columns)
         return df
 
+    def toDask(self, fileName,
+               blocksize='64MB',
+               columns=None,
+               time_range=None,
+               time_col='time'):
+        '''
+        Lazily load a csv or parquet file as a partitioned dask dataframe, nothing is read until a partition
+        is computed.
+
+        :param fileName: absolute path to file, csv or parquet
+        :param blocksize: csv partition size
+        :param columns: list of columns or predicate on the column name, None loads all. time_col is always kept
+        :param time_range: tuple (gd, ld), only rows with gd < time_col < ld are kept, gd can be None
+        :param time_col: name of the timestamp column used by time_range
+        :return: dask dataframe
+        '''
+        import dask.dataframe as dd
+        if not os.path.isfile(fileName):
+            logger.error('[%s] : [ERROR] File %s does not exist',
+                         datetime.fromtimestamp(time.time()).strftime(log_format), str(fileName))
+            sys.exit(1)
+        ext = os.path.splitext(fileName)[1].lower()
+        if ext == '.parquet':
+            ddf = dd.read_parquet(fileName)
+        elif ext == '.csv':
+            ddf = dd.read_csv(fileName, blocksize=blocksize)
+        else:
+            logger.error('[{}] : [ERROR] Unsupported file type {} for out of core loading'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), ext))
+            sys.exit(1)
+        if ddf.index.name is not None:
+            ddf = ddf.reset_index()
+        if columns is not None:
+            if callable(columns):
+                selected = [c for c in ddf.columns if c == time_col or columns(c)]
+            else:
+                selected = [c for c in ddf.columns if c == time_col or c in set(columns)]
+            ddf = ddf[selected]
+        if time_range is not None and time_col in ddf.columns:
+            gd, ld = time_range
+            if gd is not None:
+                ddf = ddf[(ddf[time_col] > gd) & (ddf[time_col] < ld)]
+            else:
+                ddf = ddf[ddf[time_col] < ld]
+        logger.info('[{}] : [INFO] Loaded {} as dask dataframe with {} partitions'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), fileName, ddf.npartitions))
+        return ddf
+
     def dtoDF(self, dlist):
         '''
         :param dlist: list of dictionaries
@@ -957,6 +1083,68 @@ class DataFormatter:
         joblib.dump(scaler, filename=scale_file_location)
         return df_scaled
 
+    def partial_scale(self, batches,
+                      scaler_type=None):
+        '''
+        Incrementally fit a scaler over data that does not fit in memory.
+
+        :param batches: iterable of dataframes, all with the same columns
+        :param scaler_type: scaler definition, same format as for scale
+        :return: fitted scaler instance, None if no scaler is defined
+        '''
+        if not scaler_type:
+            logger.warning('[{}] : [WARN] No data scaling used!'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format)))
+            return None
+        scaler_name = list(scaler_type.keys())[-1]
+        scaler_attr = list(scaler_type.values())[-1]
+        try:
+            sc_mod = importlib.import_module(self.scaler_mod)
+            scaler = getattr(sc_mod, scaler_name)(**scaler_attr)
+        except Exception as inst:
+            logger.error('[{}] : [ERROR] Error while initializing scaler {} with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), scaler_name, type(inst), inst.args))
+            sys.exit(2)
+        if not hasattr(scaler, 'partial_fit'):
+            logger.warning('[{}] : [WARN] Scaler {} does not support incremental fitting, fitting on first batch only'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), scaler_name))
+        logger.info('[{}] : [INFO] Incrementally fitting scaler {} with parameters {}.'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), scaler_name, scaler_attr))
+        nbatches = 0
+        for batch in batches:
+            if batch.empty:
+                continue
+            if hasattr(scaler, 'partial_fit'):
+                scaler.partial_fit(batch)
+            else:
+                scaler.fit(batch)
+                nbatches += 1
+                break
+            nbatches += 1
+        logger.info('[{}] : [INFO] Scaler fitted on {} batches'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), nbatches))
+        scaler_file = '{}.scaler'.format(scaler_name)
+        logger.info('[{}] : [INFO] Saving scaler instance {} ...'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), scaler_file))
+        joblib.dump(scaler, filename=os.path.join(self.dataDir, scaler_file))
+        return scaler
+
+    def transform(self, data,
+                  scaler,
+                  rindex='time'):
+        '''
+        :param data: dataframe to scale
+        :param scaler: fitted scaler instance
+        :param rindex: name of the index column
+        :return: scaled dataframe
+        '''
+        sdata = scaler.transform(data)
+        # Transform numpy array into dataframe, re-add columns to scaled numpyarray
+        df_scaled = pd.DataFrame(sdata, columns=data.columns)
+        df_scaled[rindex] = list(data.index)
+        df_scaled.set_index(rindex, inplace=True)
+        return df_scaled
+
     def load_scaler(self, data,
                     scaler_loc,
                     rindex='time'):
@@ -16,6 +16,8 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import time
+startup = time.time()
 import sys, getopt
 import os.path
 from addict import Dict
@@ -23,10 +25,8 @@ from edeconfig import readConf
 from edelogger import logger
 from datetime import datetime
 from edengine import edengine
-from util import getModelList, check_dask_settings, log_format
-import time
-from dask.distributed import Client, LocalCluster
-from signal import signal, SIGINT
+from util import getModelList, check_dask_settings, log_format, import_profile
+from signal import signal, SIGINT, SIGTERM
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.filterwarnings("ignore", category=FutureWarning)
@@ -60,6 +60,19 @@ def main(argv,
     settings.prkafkaendpoint = None
     settings.prkafkaport = 9092
     settings.prkafkatopic = "edetopic"
+    settings.stream = False
+    settings.http = None
+    settings.qconcurrency = 8
+    settings.incremental = False
+    settings.prrange = None
+    settings.checkpointformat = 'parquet'
+    settings.checkpointcompression = 'snappy'
+    settings.outofcore = None
+    settings.streaming = None
+    settings.detectpipeline = None
+    settings.shared = None
+    settings.ensemble = None
+    settings.reporting = None
     settings.augmentation = None  # augmentation including scaler and user defined methods
     settings.detectionscaler = None
     settings.MPort = 9090
@@ -365,6 +378,10 @@ def main(argv,
             else:
                 settings.prkafkatopic = readCnf['Connector']['KafkaTopic']
                 settings.prkafkaport = readCnf['Connector']['KafkaPort']
+                try:
+                    settings.kafka = readCnf['Connector']['KafkaProducer']
+                except Exception:
+                    settings.kafka = None
             logger.info('[{}] : [INFO] Kafka Endpoint set to  {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), settings.prkafkaendpoint))
         except Exception:
@@ -379,6 +396,10 @@ def main(argv,
             else:
                 settings.grafanatoken = readCnf['Connector']['GrafanaToken']
                 settings.grafanatag = readCnf['Connector']['GrafanaTag']
+                try:
+                    settings.grafanagap = readCnf['Connector']['GrafanaGap']
+                except Exception:
+                    settings.grafanagap = None
             logger.info('[{}] : [INFO] Grafana Endpoint set to  {}'.format(
                 datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), settings.grafanaurl))
         except:
@@ -457,6 +478,40 @@ def main(argv,
     else:
         logger.info('[{}] : [INFO] Local datasource set to {}'.format(
             datetime.fromtimestamp(time.time()).strftime(log_format), settings['local']))
+    try:
+        settings['stream'] = readCnf['Connector']['Stream']
+        logger.info('[{}] : [INFO] Streaming response decoding set to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['stream']))
+    except Exception:
+        logger.info('[{}] : [INFO] Streaming response decoding set to default {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['stream']))
+    try:
+        settings['http'] = readCnf['Connector']['HTTP']
+        logger.info('[{}] : [INFO] HTTP session settings set to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['http']))
+    except Exception:
+        logger.info('[{}] : [INFO] HTTP session settings set to default'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format)))
+    try:
+        settings['esbulk'] = readCnf['Connector']['ESBulk']
+        logger.info('[{}] : [INFO] ES bulk anomaly reporting set to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['esbulk']))
+    except Exception:
+        settings['esbulk'] = None
+    try:
+        settings['prrange'] = readCnf['Connector']['Range']
+        logger.info('[{}] : [INFO] PR query_range set to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['prrange']))
+    except Exception:
+        logger.info('[{}] : [INFO] PR query_range not set, using instant queries'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format)))
+    try:
+        settings['qconcurrency'] = int(readCnf['Connector']['QConcurrency'])
+        logger.info('[{}] : [INFO] Query concurrency set to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['qconcurrency']))
+    except Exception:
+        logger.info('[{}] : [INFO] Query concurrency set to default {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['qconcurrency']))
     # Mode
     if settings["train"] is None:
         try:
@@ -543,6 +598,46 @@ def main(argv,
         except Exception:
             settings['PredAnalysis'] = False
 
+    if settings.streaming is None:
+        try:
+            settings.streaming = readCnf['Detect']['Streaming']
+            logger.info('[{}] : [INFO] Streaming detection set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), settings.streaming))
+        except Exception:
+            settings.streaming = None
+
+    if settings.detectpipeline is None:
+        try:
+            settings.detectpipeline = readCnf['Detect']['Pipeline']
+            logger.info('[{}] : [INFO] Detect compiled pipeline set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), settings.detectpipeline))
+        except Exception:
+            settings.detectpipeline = True
+
+    if settings.shared is None:
+        try:
+            settings.shared = readCnf['Detect']['Shared']
+            logger.info('[{}] : [INFO] Shared memory scoring set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), settings.shared))
+        except Exception:
+            settings.shared = None
+
+    if settings.ensemble is None:
+        try:
+            settings.ensemble = readCnf['Detect']['Ensemble']
+            logger.info('[{}] : [INFO] Ensemble detection set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), settings.ensemble))
+        except Exception:
+            settings.ensemble = None
+
+    if settings.reporting is None:
+        try:
+            settings.reporting = readCnf['Detect']['Reporting']
+            logger.info('[{}] : [INFO] Background anomaly reporting set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), settings.reporting))
+        except Exception:
+            settings.reporting = None
+
     if settings["trainMethod"] is None:
         try:
             settings["trainMethod"] = readCnf['Training']['Method']
@@ -746,6 +841,14 @@ def main(argv,
         except Exception:
             settings.returnestimators = False
 
+    if settings.outofcore is None:
+        try:
+            settings.outofcore = readCnf['Training']['OutOfCore']
+            logger.info('[{}] : [INFO] Out of core training set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), settings.outofcore))
+        except Exception:
+            settings.outofcore = None
+
     if settings["load"] is None:
         try:
             settings["load"] = readCnf['Detect']['Load']
@@ -969,6 +1072,26 @@ def main(argv,
         logger.info('[%s] : [INFO] Reset index set to %s',
                     datetime.fromtimestamp(time.time()).strftime(log_format), settings['resetindex'])
 
+    try:
+        settings['checkpointformat'] = readCnf['Misc']['checkpointformat']
+        logger.info('[{}] : [INFO] Checkpoint format set to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['checkpointformat']))
+    except Exception:
+        logger.info('[{}] : [INFO] Checkpoint format set to default {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['checkpointformat']))
+    try:
+        settings['checkpointcompression'] = readCnf['Misc']['checkpointcompression']
+    except Exception:
+        pass
+
+    try:
+        settings['incremental'] = readCnf['Misc']['incremental']
+        logger.info('[{}] : [INFO] Incremental detection window set to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['incremental']))
+    except Exception:
+        logger.info('[{}] : [INFO] Incremental detection window set to default {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), settings['incremental']))
+
     try:
         settings['EDEPort'] = readCnf['Connector']['EDEPort']
         logger.info('[{}] : [INFO] EDEPort is set to {}'.format(
@@ -1072,6 +1195,12 @@ def main(argv,
                                      queryDir=queryDir)
     #engine.printTest()
     engine.initConnector()
+    profile = import_profile(startup)
+    logger.info('[{}] : [INFO] Startup import profile {}'.format(
+        datetime.fromtimestamp(time.time()).strftime(log_format), profile))
+    if profile['heavy_loaded'] and not dask_backend:
+        logger.warning('[{}] : [WARN] Modules {} loaded at startup, expected to load on demand only'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), profile['heavy_loaded']))
     if dask_backend:
         engine.runDask(engine)
     else:
@@ -1094,8 +1223,10 @@ if __name__ == "__main__":
         datetime.fromtimestamp(time.time()).strftime(log_format)))
         sys.exit(0)
     signal(SIGINT, handler)
+    signal(SIGTERM, handler)
     SchedulerEndpoint, Scale, SchedulerPort, EnforceCheck = check_dask_settings(cnf=sys.argv[1:])  # Todo Better solution
     if SchedulerEndpoint:
+        from dask.distributed import Client, LocalCluster  # only needed by the Dask backend
         if SchedulerEndpoint == "local":
             cluster = LocalCluster(n_workers=int(Scale))
             logger.info('[{}] : [INFO] Starting Dask local Cluster Backend with: {}'.format(
@@ -19,17 +19,48 @@ limitations under the License.
 from datetime import datetime
 from elasticsearch import Elasticsearch
 from kafka import KafkaProducer
-import pandas as pd
+import numpy as np
 import requests
 import os
 import sys
+import atexit
 from edelogger import logger
 import json
 import time
+import random
+import threading
 from requests.auth import HTTPBasicAuth
-from util import log_format
+from requests.adapters import HTTPAdapter
+from util import log_format, parseDelay, read_frame
 from joblib import Parallel, delayed
 from tqdm import tqdm
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _encode_default(o):
+    """
+    Converts numpy scalars and arrays found in anomaly reports (e.g. SHAP values) for JSON and msgpack encoding
+    """
+    if hasattr(o, 'item') and getattr(o, 'ndim', 0) == 0:
+        return o.item()
+    if hasattr(o, 'tolist'):
+        return o.tolist()
+    return str(o)
+
+
+class ConnectorError(Exception):
+    """
+    Raised when a monitoring endpoint can not be reached after all retries or while its circuit breaker is open
+    """
+    pass
+
 
 class Connector:
     def __init__(self,
@@ -45,17 +76,28 @@ class Connector:
                  prKafkaTopic='edetopic',
                  srTelemetryPMDS=None,
                  central_telemetry_handler='http://central-telemetry.services.cloud.ict-serrano.eu/',
-                 enhanced_telemetry_agent='http://85.120.206.26:30090'
+                 enhanced_telemetry_agent='http://85.120.206.26:30090',
+                 http_settings=None,
+                 pool_size=10,
+                 query_concurrency=8,
+                 es_bulk=None,
+                 kafka_settings=None
                  ):
         self.dataDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+        self.query_concurrency = max(int(query_concurrency), 1)
+        self.__init_session(http_settings, max(int(pool_size), self.query_concurrency))
         if esEndpoint is None:
             self.esInstance = None
+            self.esBulk = None
+            self.esBulkSinks = {}
         else:
-            self.esInstance = Elasticsearch(esEndpoint)
+            self.esInstance = Elasticsearch(esEndpoint, maxsize=self.query_concurrency)
             self.esEndpoint = esEndpoint
             self.dmonPort = dmonPort
             self.esInstanceEndpoint = MInstancePort
             self.myIndex = index
+            self.esBulk = es_bulk
+            self.esBulkSinks = {}
             logger.info('[{}] : [INFO] EDE ES backend Defined at: {} with port {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), esEndpoint, MInstancePort))
         if prEndpoint is None:
@@ -80,16 +122,7 @@ class Connector:
                 datetime.fromtimestamp(time.time()).strftime(log_format)))
         else:
             self.prKafkaTopic = prKafkaTopic
-            try:
-                self.producer = KafkaProducer(value_serializer=lambda v: json.dumps(v).encode('utf-8'),
-                                              bootstrap_servers=["{}:{}".format(prKafkaEndpoint, prKafkaPort)],
-                                              retries=5)
-                logger.info('[{}] : [INFO] EDE Kafka reporter initialized to server {}:{}'.format(
-                    datetime.fromtimestamp(time.time()).strftime(log_format), prKafkaEndpoint, prKafkaPort))
-            except Exception as inst:
-                logger.error('[{}] : [ERROR] EDE Kafka reporter failed with {} and {}'.format(
-                    datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
-                self.producer = None
+            self.__init_producer(prKafkaEndpoint, prKafkaPort, kafka_settings)
         if srTelemetryPMDS is None:
             self.srTelemetryPMDS = os.getenv('PMDS_SERVICE', 'http://pmds.services.cloud.ict-serrano.eu')
         else:
@@ -97,18 +130,167 @@ class Connector:
         self.central_telemetry_handler = central_telemetry_handler
         self.enhanced_telemetry_agent = enhanced_telemetry_agent
 
+    def __init_producer(self, prKafkaEndpoint, prKafkaPort, kafka_settings):
+        """
+        Kafka producer used for anomaly reporting, flushed on exit
+
+        :param prKafkaEndpoint: Kafka endpoint
+        :param prKafkaPort: Kafka port
+        :param kafka_settings: dict with LingerMs, BatchSize, Compression, Acks, MaxRequestSize and Encoding (json or msgpack)
+        """
+        if not kafka_settings:
+            kafka_settings = {}
+        self.kafka_encoding = kafka_settings.get('Encoding', 'json')
+        if self.kafka_encoding == 'msgpack' and msgpack is None:
+            logger.warning('[{}] : [WARN] msgpack not installed, falling back to json Kafka encoding'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format)))
+            self.kafka_encoding = 'json'
+        if self.kafka_encoding == 'msgpack':
+            serializer = lambda v: msgpack.packb(v, default=_encode_default, use_bin_type=True)
+            self.kafka_headers = [('content-type', b'application/msgpack')]
+        else:
+            serializer = lambda v: json.dumps(v, default=_encode_default).encode('utf-8')
+            self.kafka_headers = None
+        self.__kafka_lock = threading.Lock()
+        self.__kafka_metrics = {'sent': 0, 'delivered': 0, 'failed': 0, 'bytes': 0, 'serialize_time': 0.0}
+        config = {'linger_ms': int(kafka_settings.get('LingerMs', 50)),
+                  'batch_size': int(kafka_settings.get('BatchSize', 262144)),
+                  'compression_type': kafka_settings.get('Compression', None),
+                  'acks': kafka_settings.get('Acks', 1),
+                  'max_request_size': int(kafka_settings.get('MaxRequestSize', 10485760))}
+        try:
+            self.producer = KafkaProducer(bootstrap_servers=["{}:{}".format(prKafkaEndpoint, prKafkaPort)],
+                                          retries=5, **config)
+            self.kafka_serializer = serializer
+            atexit.register(self.closeKafka)  # detect processes flush through closeReporting
+            logger.info('[{}] : [INFO] EDE Kafka reporter initialized to server {}:{} with {} encoding and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), prKafkaEndpoint, prKafkaPort,
+                self.kafka_encoding, config))
+        except Exception as inst:
+            logger.error('[{}] : [ERROR] EDE Kafka reporter failed with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+            self.producer = None
+
+    def __kafka_update(self, **kwargs):
+        with self.__kafka_lock:
+            for k, v in kwargs.items():
+                self.__kafka_metrics[k] += v
+
+    def __kafka_delivered(self, record_metadata):
+        self.__kafka_update(delivered=1)
+
+    def __kafka_failed(self, exc):
+        self.__kafka_update(failed=1)
+        logger.error('[{}] : [ERROR] Failed to deliver anomalies to kafka topic {} with {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), self.prKafkaTopic, exc))
+
+    def kafkaMetrics(self):
+        """
+        :return: copy of the Kafka delivery counters, pending reports were sent but not yet acknowledged
+        """
+        with self.__kafka_lock:
+            metrics = dict(self.__kafka_metrics)
+        metrics['pending'] = metrics['sent'] - metrics['delivered'] - metrics['failed']
+        return metrics
+
+    def closeKafka(self, timeout=30):
+        """
+        Flush reports buffered by the producer and close it
+
+        :param timeout: seconds to wait for pending reports
+        """
+        if self.producer is None:
+            return
+        try:
+            self.producer.flush(timeout=timeout)
+            self.producer.close(timeout=timeout)
+        except Exception as inst:
+            logger.error('[{}] : [ERROR] Failed to flush kafka reporter with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+        self.producer = None
+        logger.info('[{}] : [INFO] Kafka reporter closed with metrics {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), self.kafkaMetrics()))
+
+    def __init_session(self, http_settings, pool_size):
+        """
+        Shared keep-alive session used by all HTTP based endpoints
+
+        :param http_settings: dict with Timeout, Retries, Backoff, BreakerThreshold and BreakerCooldown
+        :param pool_size: number of pooled connections per host, at least the query concurrency and PMDS group fan-out
+        """
+        if not http_settings:
+            http_settings = {}
+        self.http_timeout = float(http_settings.get('Timeout', 60))
+        self.http_retries = int(http_settings.get('Retries', 3))
+        self.http_backoff = float(http_settings.get('Backoff', 0.5))
+        self.breaker_threshold = int(http_settings.get('BreakerThreshold', 5))
+        self.breaker_cooldown = float(http_settings.get('BreakerCooldown', 30))
+        self.pool_size = max(int(pool_size), 1)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.__breaker_lock = threading.Lock()
+        self.__breaker = {}  # host -> [consecutive failures, open until]
+        logger.info('[{}] : [INFO] EDE HTTP session pool size {}, timeout {}s, retries {}, backoff {}s'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), self.pool_size, self.http_timeout,
+            self.http_retries, self.http_backoff))
+
+    def __get(self, url, **kwargs):
+        """
+        GET using the pooled session with jittered exponential backoff and a per host circuit breaker
+
+        :param url: full request url
+        :param kwargs: passed on to requests
+        :return: response object
+        """
+        host = requests.utils.urlparse(url).netloc
+        with self.__breaker_lock:
+            failures, open_until = self.__breaker.get(host, [0, 0.0])
+        if open_until > time.time():
+            raise ConnectorError('Circuit open for {} for another {:.1f}s'.format(host, open_until - time.time()))
+        kwargs.setdefault('timeout', self.http_timeout)
+        last_exc = None
+        for attempt in range(self.http_retries + 1):
+            try:
+                resp = self.session.get(url, **kwargs)
+                if resp.status_code not in (429, 502, 503, 504):
+                    with self.__breaker_lock:
+                        self.__breaker[host] = [0, 0.0]
+                    return resp
+                last_exc = ConnectorError('{} returned status {}'.format(host, resp.status_code))
+                resp.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as inst:
+                last_exc = inst
+            if attempt < self.http_retries:
+                wait = self.http_backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning('[{}] : [WARN] Request to {} failed with {}, retry {}/{} in {:.2f}s'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), host, last_exc, attempt + 1,
+                    self.http_retries, wait))
+                time.sleep(wait)
+        with self.__breaker_lock:
+            failures, open_until = self.__breaker.get(host, [0, 0.0])
+            failures += 1
+            if failures >= self.breaker_threshold:
+                open_until = time.time() + self.breaker_cooldown
+                logger.error('[{}] : [ERROR] Circuit opened for {} after {} failed requests, cooling down {}s'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), host, failures, self.breaker_cooldown))
+                failures = 0
+            self.__breaker[host] = [failures, open_until]
+        raise ConnectorError('Request to {} failed after {} retries with {}'.format(host, self.http_retries, last_exc))
+
     def pr_health_check(self):
         pr_target_health = '/-/healthy'
         pr_target_ready = '/-/ready'
         try:
             if self.__check_auth_pr():
-                resp_h = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_health),
+                resp_h = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_health),
                                       auth=HTTPBasicAuth(self.prEndpointUser, self.prEndpointPasswd))
-                resp_r = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_ready),
+                resp_r = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_ready),
                                       auth=HTTPBasicAuth(self.prEndpointUser, self.prEndpointPasswd))
             else:
-                resp_h = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_health))
-                resp_r = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_ready))
+                resp_h = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_health))
+                resp_r = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_ready))
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has occured while connecting to PR endpoint with type {} at arguments {}'.format(
@@ -148,10 +330,10 @@ class Connector:
             sys.exit(1)
         try:
             if self.__check_auth_pr():
-                resp = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string),
+                resp = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string),
                                     auth=HTTPBasicAuth(self.prEndpointUser, self.prEndpointPasswd))
             else:
-                resp = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string))
+                resp = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string))
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has occured while connecting to PR endpoint with type {} at arguments {}'.format(
@@ -167,10 +349,10 @@ class Connector:
         pr_target_string = '/api/v1/targets'
         try:
             if self.__check_auth_pr():
-                resp = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string),
+                resp = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string),
                                     auth=HTTPBasicAuth(self.prEndpointUser, self.prEndpointPasswd))
             else:
-                resp = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string))
+                resp = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string))
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has occured while connecting to PR endpoint with type {} at arguments {}'.format(
@@ -185,10 +367,10 @@ class Connector:
             pr_target_string = '/api/v1/label/{}/values'.format(label)
         try:
             if self.__check_auth_pr():
-                resp = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string),
+                resp = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string),
                                     auth=HTTPBasicAuth(self.prEndpointUser, self.prEndpointPasswd))
             else:
-                resp = requests.get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string))
+                resp = self.__get("https://{}:{}{}".format(self.prEndpoint, self.MInstancePort, pr_target_string))
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has occured while connecting to PR endpoint with type {} at arguments {}'.format(
@@ -196,27 +378,135 @@ class Connector:
             sys.exit(2)
         return resp.json()
 
-    def pr_query(self, query):
+    def pr_query(self, query, stream=False):
         """
         QUery Monitoring Data From PR backend
         :param query: Query string for PR backend
+        :param stream: if True the response is decoded incrementally and an iterator over data.result series is returned
         :return: Monitoring Data
         """
         try:
             url = '/api/v1/query'
             if self.__check_auth_pr():
-                resp = requests.get('https://{}:{}{}'.format(self.prEndpoint, self.MInstancePort, url), params=query,
-                                    auth=HTTPBasicAuth(self.prEndpointUser, self.prEndpointPasswd))
+                resp = self.__get('https://{}:{}{}'.format(self.prEndpoint, self.MInstancePort, url), params=query,
+                                    auth=HTTPBasicAuth(self.prEndpointUser, self.prEndpointPasswd), stream=stream)
             else:
-                resp = requests.get('https://{}:{}{}'.format(self.prEndpoint, self.MInstancePort, url), params=query)
+                resp = self.__get('https://{}:{}{}'.format(self.prEndpoint, self.MInstancePort, url), params=query,
+                                    stream=stream)
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has occured while connecting to PR endpoint with type {} at arguments {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
-            sys.exit(2)
+            raise ConnectorError(inst) from inst
+        if stream:
+            return self.__stream_json(resp, 'data.result.item')
         return resp.json()
 
-    def __sr_pmds_service_query_nodes(self, cluster_uuid, **kwargs):
+    def pr_query_range(self, query, start, end, step, chunk=None, stream=False):
+        """
+        Query Monitoring Data From PR backend using query_range. Long ranges are split in chunks aligned to step,
+        fetched in parallel and concatenated in order.
+
+        :param query: PromQL expression, without range selector
+        :param start: start epoch in seconds
+        :param end: end epoch in seconds
+        :param step: resolution step (ex. 30s, 1m) or seconds
+        :param chunk: maximum range fetched with one request (ex. 6h) or seconds, if None a single request is issued
+        :param stream: if True chunks are decoded incrementally into float arrays and an iterator over the merged
+        series is returned
+        :return: Monitoring Data in the same format as a range vector pr_query response
+        """
+        step_s = parseDelay(step) if isinstance(step, str) else int(step)
+        if step_s <= 0:
+            logger.error('[{}] : [ERROR] Invalid PR query_range step {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), step))
+            raise ConnectorError('Invalid PR query_range step {}'.format(step))
+        start = int(start) - int(start) % step_s
+        end = int(end)
+        if chunk is None:
+            chunk_s = end - start + step_s
+        else:
+            chunk_s = parseDelay(chunk) if isinstance(chunk, str) else int(chunk)
+        chunk_s = max(step_s, chunk_s - chunk_s % step_s)
+        chunks = []
+        c_start = start
+        while c_start <= end:
+            c_end = min(c_start + chunk_s - step_s, end)
+            chunks.append((c_start, c_end))
+            c_start = c_end + step_s
+        logger.info('[{}] : [INFO] PR query_range from {} to {} with step {}s split in {} chunks'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), start, end, step_s, len(chunks)))
+        resp_list = Parallel(n_jobs=max(min(len(chunks), self.query_concurrency), 1), backend='threading')(
+            delayed(self.__pr_query_range_chunk)(query, c_start, c_end, step_s, stream) for c_start, c_end in chunks)
+        if stream:
+            return self.__pr_merge_series(resp_list)
+        series = {}
+        for resp in resp_list:
+            for el in resp['data']['result']:
+                key = json.dumps(el['metric'], sort_keys=True)
+                if key in series:
+                    series[key]['values'].extend(el['values'])
+                else:
+                    series[key] = {'metric': el['metric'], 'values': list(el['values'])}
+        return {'status': 'success', 'data': {'resultType': 'matrix', 'result': list(series.values())}}
+
+    def __pr_merge_series(self, chunk_list):
+        """
+        Concatenate the series of streamed query_range chunks in chunk order
+
+        :param chunk_list: list of dictionaries mapping series labels to metric and list of value arrays
+        :return: generator over merged series
+        """
+        series = {}
+        for chunk in chunk_list:
+            for key, (metric, values) in chunk.items():
+                series.setdefault(key, (metric, []))[1].append(values)
+        chunk_list.clear()
+        for key in list(series):
+            metric, values = series.pop(key)
+            yield {'metric': metric, 'values': values[0] if len(values) == 1 else np.concatenate(values)}
+
+    def __pr_query_range_chunk(self, query, start, end, step, stream=False):
+        params = {'query': query, 'start': start, 'end': end, 'step': step}
+        try:
+            url = '/api/v1/query_range'
+            if self.__check_auth_pr():
+                resp = self.__get('https://{}:{}{}'.format(self.prEndpoint, self.MInstancePort, url), params=params,
+                                  auth=HTTPBasicAuth(self.prEndpointUser, self.prEndpointPasswd), stream=stream)
+            else:
+                resp = self.__get('https://{}:{}{}'.format(self.prEndpoint, self.MInstancePort, url), params=params,
+                                  stream=stream)
+        except Exception as inst:
+            logger.error(
+                '[{}] : [ERROR] Exception has occured while connecting to PR endpoint with type {} at arguments {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+            raise ConnectorError(inst) from inst
+        if stream:
+            # Prometheus answers failed queries with a non 2xx status and a small error body
+            if resp.status_code >= 400:
+                try:
+                    error = resp.json().get('error')
+                except ValueError:
+                    error = resp.text
+                finally:
+                    resp.close()
+                logger.error('[{}] : [ERROR] PR query_range chunk {} - {} failed with status {} and {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), start, end, resp.status_code, error))
+                raise ConnectorError(error)
+            # Only one series is decoded at a time, its samples are kept as a float array
+            series = {}
+            for el in self.__stream_json(resp, 'data.result.item'):
+                series[json.dumps(el['metric'], sort_keys=True)] = (
+                    el['metric'], np.array(el['values'], dtype=np.float64).reshape(-1, 2))
+            return series
+        body = resp.json()
+        if body.get('status') != 'success':
+            logger.error('[{}] : [ERROR] PR query_range chunk {} - {} failed with {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), start, end, body.get('error')))
+            raise ConnectorError(body.get('error'))
+        return body
+
+    def __sr_pmds_service_query_nodes(self, cluster_uuid, stream=False, **kwargs):
         valid_query_params = ["group",
                               "start",
                               "stop",
@@ -225,14 +515,39 @@ class Connector:
                               "format"]
         query_params = {k: v for (k, v) in kwargs.items() if k in valid_query_params}
         try:
-            res = requests.get(f"{self.srTelemetryPMDS}/api/v1/pmds/nodes/{cluster_uuid}", params=query_params)
+            res = self.__get(f"{self.srTelemetryPMDS}/api/v1/pmds/nodes/{cluster_uuid}", params=query_params,
+                               stream=stream)
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has ocurred while connecting to PMDS node endpoint with type {} at arguments {}'.format(
                     datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), type(inst), inst.args))
-            sys.exit(2)
+            raise ConnectorError(inst) from inst
+        if stream:
+            return self.__stream_json(res, 'item')
         return res.json()
 
+    def __stream_json(self, resp, prefix):
+        """
+        Incrementally decode a streamed JSON response, only one element under prefix is materialized at a time
+
+        :param resp: response object issued with stream=True
+        :param prefix: ijson prefix of the elements to be yielded (ex. data.result.item)
+        :return: generator over decoded elements
+        """
+        if ijson is None:
+            logger.warning('[{}] : [WARN] ijson not installed, falling back to full response decoding'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format)))
+            body = resp.json()
+            for key in prefix.split('.')[:-1]:
+                body = body[key]
+            yield from body
+            return
+        resp.raw.decode_content = True  # transparently handle gzip/deflate encoded bodies
+        try:
+            yield from ijson.items(resp.raw, prefix, use_float=True)
+        finally:
+            resp.close()
+
     def sr_pmds_service_query_deployments(self, cluster_uuid,
                                             namespace,
                                             **kwargs):
@@ -244,12 +559,12 @@ class Connector:
         query_params = {k: v for (k, v) in kwargs.items() if k in valid_query_params}
         query_params["namespace"] = namespace
         try:
-            res = requests.get(f"{self.srTelemetryPMDS}/api/v1/pmds/deployments/{cluster_uuid}", params=query_params)
+            res = self.__get(f"{self.srTelemetryPMDS}/api/v1/pmds/deployments/{cluster_uuid}", params=query_params)
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has ocurred while connecting to PMDS deployment endpoint with type {} at arguments {}'.format(
                     datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), type(inst), inst.args))
-            sys.exit(2)
+            raise ConnectorError(inst) from inst
         return res
 
     def __sr_pmds_service_query_pods(self, cluster_uuid, namespace, **kwargs):
@@ -263,12 +578,12 @@ class Connector:
         query_params["namespace"] = namespace
 
         try:
-            res = requests.get(f"{self.srTelemetryPMDS}/api/v1/pmds/pods/{cluster_uuid}", params=query_params)
+            res = self.__get(f"{self.srTelemetryPMDS}/api/v1/pmds/pods/{cluster_uuid}", params=query_params)
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has ocurred while connecting to PMDS pod endpoint with type {} at arguments {}'.format(
                     datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), type(inst), inst.args))
-            sys.exit(2)
+            raise ConnectorError(inst) from inst
         return res.json()
 
     def cth_inventory(self, cluster_uuid):
@@ -279,7 +594,7 @@ class Connector:
         """
         url_inv = f"{self.central_telemetry_handler}/api/v1/telemetry/central/cluster/inventory/{cluster_uuid}"
         try:
-            resp = requests.get(
+            resp = self.__get(
                 url_inv)
         except Exception as inst:
             logger.error(
@@ -288,7 +603,7 @@ class Connector:
             resp = {"error": "Exception has ocurred while connecting to CTH inventory endpoint"}
         return resp
 
-    def sr_pmds_query(self, query_param):
+    def sr_pmds_query(self, query_param, stream=False):
         '''
         Executes PMDS query in parallel using joblib backend.
         It parses the length of the arguments
@@ -296,6 +611,7 @@ class Connector:
         It then executes the query in parallel and returns.
 
         :param query_param: query parameters based on PMDS API
+        :param stream: if True each response is an iterator over incrementally decoded records
         :return: list of responses in JSON format
         '''
         # cluster_uudi = query_param.pop('cluster_uuid')
@@ -311,7 +627,7 @@ class Connector:
         logger.info('[{}] : [INFO] EDE PMDS Executing parallel query with {} jobs'.format(
                 datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), n_jobs))
         resp_list = Parallel(n_jobs=n_jobs, backend='threading')(
-            delayed(self.__sr_pmds_service_query_nodes)(**query) for query in tqdm(querys))
+            delayed(self.__sr_pmds_service_query_nodes)(stream=stream, **query) for query in tqdm(querys))
         return resp_list
 
     def eta_status(self):
@@ -321,7 +637,7 @@ class Connector:
         """
         url_telem_agent = f"{self.enhanced_telemetry_agent}/api/v1/telemetry/agent"
         try:
-            resp_telem_agent = requests.get(url_telem_agent)
+            resp_telem_agent = self.__get(url_telem_agent)
         except Exception as inst:
             logger.error(
                 '[{}] : [ERROR] Exception has ocurred while connecting to ETA status endpoint with type {} at arguments {}'.format(
@@ -337,7 +653,7 @@ class Connector:
         """
         url_mon = f"{self.central_telemetry_handler}/api/v1/telemetry/central/cluster/monitor/{cluster_uuid}"
         try:
-            resp = requests.get(
+            resp = self.__get(
                 url_mon)
         except Exception as inst:
             logger.error(
@@ -354,7 +670,7 @@ class Connector:
         """
         url_met = f"{self.central_telemetry_handler}/api/v1/telemetry/central/cluster/metrics/{cluster_uuid}"
         try:
-            resp = requests.get(
+            resp = self.__get(
                 url_met)
         except Exception as inst:
             logger.error(
@@ -423,7 +739,7 @@ class Connector:
         logger.info('[%s] : [INFO] dmon get roles url -> %s',
                     datetime.fromtimestamp(time.time()).strftime(log_format), nUrl)
         try:
-            rRoles = requests.get(nUrl)
+            rRoles = self.__get(nUrl)
         except Exception as inst:
             logger.error('[%s] : [ERROR] Exception has occured while connecting to dmon with type %s at arguments %s',
                          datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args)
@@ -502,7 +818,7 @@ class Connector:
         logger.info('[%s] : [INFO] dmon get storm topology url -> %s',
                     datetime.fromtimestamp(time.time()).strftime(log_format), nUrl)
         try:
-            rStormTopology = requests.get(nUrl)
+            rStormTopology = self.__get(nUrl)
         except Exception as inst:
             logger.error('[%s] : [ERROR] Exception has occured while connecting to dmon with type %s at arguments %s',
                          datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args)
@@ -520,17 +836,59 @@ class Connector:
             sys.exit(2)
         return res
 
+    def pushAnomaliesES(self, anomalyIndex, doc_type, bodies):
+        """
+        Index several anomaly reports, through the bulk sink of anomalyIndex if ESBulk is set
+
+        :param anomalyIndex: anomaly index
+        :param doc_type: document type
+        :param bodies: list of anomaly reports
+        """
+        if not self.esBulk:
+            for body in bodies:
+                self.pushAnomalyES(anomalyIndex=anomalyIndex, doc_type=doc_type, body=body)
+            return 0
+        sink = self.esBulkSinks.get(anomalyIndex)
+        if sink is None:
+            from edereporting.edeelastic import ESBulkSink
+            settings = self.esBulk if isinstance(self.esBulk, dict) else {}
+            sink = ESBulkSink(self.esInstance, anomalyIndex, doc_type=doc_type,
+                              spool=settings.get('Spool', os.path.join(self.dataDir, '{}.spool'.format(anomalyIndex))),
+                              batch_size=settings.get('BatchSize', 500),
+                              flush_interval=settings.get('FlushInterval', 5),
+                              retry_interval=settings.get('RetryInterval', 30))
+            atexit.register(sink.close)  # detect processes close the sinks through closeReporting
+            self.esBulkSinks[anomalyIndex] = sink
+            logger.info('[{}] : [INFO] EDE ES bulk reporting to index {} set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), anomalyIndex, settings))
+        sink.push(bodies)
+        return 0
+
+    def closeReporting(self):
+        """
+        Index or spool the anomaly documents pending in the ES bulk sinks and flush the Kafka producer
+        """
+        for sink in self.esBulkSinks.values():
+            sink.close()
+        self.closeKafka()
+
     def pushAnomalyKafka(self, body):
         if self.producer is None:
             logger.warning('[{}] : [WARN] Kafka reporter not defined, skipping reporting'.format(
             datetime.fromtimestamp(time.time()).strftime(log_format)))
         else:
             try:
-                self.producer.send(self.prKafkaTopic, body)
-                # self.producer.flush()
+                self.__kafka_update(sent=1)
+                start = time.time()
+                value = self.kafka_serializer(body)
+                self.__kafka_update(bytes=len(value), serialize_time=time.time() - start)
+                future = self.producer.send(self.prKafkaTopic, value, headers=self.kafka_headers)
+                future.add_callback(self.__kafka_delivered)
+                future.add_errback(self.__kafka_failed)
                 logger.info('[{}] : [INFO] Anomalies reported to kafka topic {}'.format(
                     datetime.fromtimestamp(time.time()).strftime(log_format), self.prKafkaTopic))
             except Exception as inst:
+                self.__kafka_update(failed=1)
                 logger.error('[{}] : [ERROR] Failed to report anomalies to kafka topic {} with {} and {}'.format(
             datetime.fromtimestamp(time.time()).strftime(log_format), self.prKafkaTopic, type(inst), inst.args))
         return 0
@@ -551,10 +909,20 @@ class Connector:
     def pushModel(self):
         return "push model"
 
-    def localData(self, data):
+    def localData(self, data, columns=None, time_range=None):
+        '''
+        Load local data from csv, Parquet, Arrow IPC/Feather or npy (structured arrays keep column names)
+
+        :param data: file name relative to the data directory
+        :param columns: list of columns or predicate on column names to load, None loads all
+        :param time_range: tuple (gd, ld) pushed down to the reader as gd < time < ld
+        :return: dataframe
+        '''
         data_loc = os.path.join(self.dataDir, data)
         try:
-            df = pd.read_csv(data_loc)
+            df = read_frame(data_loc, columns=columns, time_range=time_range)
+            if df.index.name is not None:  # columnar checkpoints restore the index, keep csv layout
+                df.reset_index(inplace=True)
         except Exception as inst:
             logger.error('[{}] : [ERROR] Cannot load local data with  {} and {}'.format(
             datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
@@ -568,7 +936,7 @@ class Connector:
         logger.info('[%s] : [INFO] dmon get interval url -> %s',
                     datetime.fromtimestamp(time.time()).strftime(log_format), nUrl)
         try:
-            rInterval = requests.get(nUrl)
+            rInterval = self.__get(nUrl)
         except Exception as inst:
             logger.error('[%s] : [ERROR] Exception has occured while connecting to dmon with type %s at arguments %s',
                          datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args)
@@ -587,6 +955,28 @@ class Connector:
             sys.exit(2)
         return res
 
+    def aggQueryParallel(self, queryBodies):
+        '''
+        Executes a batch of ES aggregation queries concurrently using the joblib threading backend.
+        At most query_concurrency queries are in flight at the same time.
+
+        :param queryBodies: list of query bodies as built by QueryConstructor
+        :return: list of responses in the same order as queryBodies
+        '''
+        if not queryBodies:
+            return []
+        n_jobs = min(self.query_concurrency, len(queryBodies))
+        start = time.perf_counter()
+        if n_jobs == 1:
+            resp_list = [self.aggQuery(q) for q in queryBodies]
+        else:
+            resp_list = Parallel(n_jobs=n_jobs, backend='threading')(
+                delayed(self.aggQuery)(q) for q in queryBodies)
+        logger.info('[{}] : [INFO] Executed {} ES queries with concurrency {} in {:.2f}s'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), len(queryBodies), n_jobs,
+            time.perf_counter() - start))
+        return resp_list
+
     def getNodeList(self):
         '''
         :return: -> returns the list of registered nodes from dmon
@@ -595,7 +985,7 @@ class Connector:
         logger.info('[%s] : [INFO] dmon get node url -> %s',
                     datetime.fromtimestamp(time.time()).strftime(log_format), nUrl)
         try:
-            rdmonNode = requests.get(nUrl)
+            rdmonNode = self.__get(nUrl)
         except Exception as inst:
             logger.error('[%s] : [ERROR] Exception has occured while connecting to dmon with type %s at arguments %s',
                          datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args)
@@ -612,7 +1002,7 @@ class Connector:
         logger.info('[%s] : [INFO] dmon get core status url -> %s',
                     datetime.fromtimestamp(time.time()).strftime(log_format), nUrl)
         try:
-            rdmonStatus = requests.get(nUrl)
+            rdmonStatus = self.__get(nUrl)
         except Exception as inst:
             logger.error('[%s] : [ERROR] Exception has occured while connecting to dmon with type %s at arguments %s',
                          datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args)
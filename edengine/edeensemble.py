@@ -0,0 +1,110 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from datetime import datetime
+import time
+from joblib import Parallel, delayed
+from edelogger import logger
+from util import log_format
+
+
+class EnsembleDetector:
+    """
+    Scores one preprocessed window with several models in parallel threads and combines the anomalies
+    reported by each model by weighted voting. Members are scored with the same callable used for single
+    model detection so loaded models are shared through the model registry.
+    """
+    votings = ('majority', 'any', 'all')
+
+    def __init__(self, members,
+                 voting='majority',
+                 n_jobs=None):
+        '''
+        :param members: -> list of dictionaries with Method, Load and optionally Type and Weight
+        :param voting: -> majority, any, all or the minimum summed weight of an anomaly
+        :param n_jobs: -> number of members scored at once, defaults to all members
+        '''
+        self.members = []
+        for member in members:
+            member = dict(member)
+            member.setdefault('Weight', 1)
+            member['name'] = '{}_{}'.format(member['Method'], member['Load'])
+            self.members.append(member)
+        if voting not in self.votings and not isinstance(voting, (int, float)):
+            raise ValueError('Unknown ensemble voting {}, expected one of {} or a number'.format(voting, self.votings))
+        self.voting = voting
+        self.n_jobs = n_jobs or len(self.members)
+
+    def threshold(self, total):
+        '''
+        :param total: -> summed weight of the members that scored the window
+        :return: -> minimum summed weight required for an anomaly
+        '''
+        if self.voting == 'any':
+            return min((m['Weight'] for m in self.members if m['Weight'] > 0), default=1)
+        if self.voting == 'all':
+            return total
+        if self.voting == 'majority':
+            return total / 2.0 + 1e-9  # strictly more than half
+        return self.voting
+
+    def __score(self, score, member, data):
+        start = time.time()
+        try:
+            result = score(member, data)
+        except (Exception, SystemExit) as inst:  # a failing member must not fail the ensemble
+            logger.error('[{}] : [ERROR] Ensemble member {} failed with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), member['name'], type(inst), inst.args))
+            return None
+        logger.info('[{}] : [INFO] Ensemble member {} scored {} rows in {:.3f} seconds'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), member['name'], data.shape[0],
+            time.time() - start))
+        return result
+
+    def detect(self, score, data):
+        '''
+        :param score: -> callable(member, data) returning the anomaly dictionary of one member
+        :param data: -> preprocessed window
+        :return: -> combined anomaly dictionary
+        '''
+        results = Parallel(n_jobs=self.n_jobs, backend='threading')(
+            delayed(self.__score)(score, member, data) for member in self.members)
+        votes = {}
+        total = 0
+        reports = {}
+        for member, result in zip(self.members, results):
+            if result is None:
+                continue
+            total += member['Weight']
+            for anomaly in result.get('anomalies', []):
+                record = votes.setdefault(anomaly['utc'], {'utc': anomaly['utc'], 'hutc': anomaly['hutc'],
+                                                           'votes': 0, 'members': {}})
+                record['votes'] += member['Weight']
+                record['members'][member['name']] = {k: v for k, v in anomaly.items() if k not in ('utc', 'hutc')}
+            extra = {k: v for k, v in result.items() if k != 'anomalies'}
+            if extra:
+                reports[member['name']] = extra
+        required = self.threshold(total)
+        anomalies = [votes[utc] for utc in sorted(votes) if votes[utc]['votes'] >= required]
+        logger.info('[{}] : [INFO] Ensemble of {} members voted {} of {} candidate anomalies with {} voting'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), len(self.members), len(anomalies), len(votes),
+            self.voting))
+        ensemble = {'anomalies': anomalies, 'method': 'ensemble',
+                    'ensemble': [m['name'] for m in self.members], 'voting': self.voting}
+        if reports:
+            ensemble['members'] = reports
+        return ensemble
@@ -15,21 +15,35 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from edeconnector import Connector, logger, datetime, time
-from edepoint.edepoint import EdePoint
-from util import queryParser, nodesParse, str2Bool, cfilterparse, rfilterparse, pointThraesholds, parseDelay, parseMethodSettings, ut2hum, checkFile, log_format
+from edeconnector import Connector, ConnectorError, logger, datetime, time
+from edepoint.edepoint import EdePoint, PointDetector
+from util import queryParser, nodesParse, str2Bool, cfilterparse, rfilterparse, pointThraesholds, parseDelay, parseMethodSettings, ut2hum, checkFile, log_format, LazyModule
 from .threadRun import EdeDetectThread, EdePointThread, EdeTrainThread
 from .multiprocRun import EdeDetectProcess, EdePointProcess, EdeTrainProcess
+from .edestream import StreamingScorer
+from .edeensemble import EnsembleDetector
+from .edereporter import AnomalyReporter
 from time import sleep
 import sys
 import os
+import atexit
+import re
 import tempfile
-from edescikit import edescilearncluster as sede
-from edescikit import edescilearnclassification as cede
+import pandas as pd
+import numpy as np
 from pyQueryConstructor import QueryConstructor
 from dataformatter import DataFormatter
+from edepipeline import PreprocessPipeline
+from edescikit.modelregistry import model_registry
+from edescikit.edeshared import SharedScorer
+from edescikit.edeshap import plot_worker
+import joblib
 import subprocess
 
+# Loaded by the first clustering or classification call, a clustering run never imports TensorFlow or yellowbrick
+sede = LazyModule('edescikit.edescilearncluster')
+cede = LazyModule('edescikit.edescilearnclassification')
+
 
 class EDEngine:
     def __init__(self,
@@ -39,7 +53,7 @@ class EDEngine:
                  queryDir):
         self.esendpoint = settingsDict['esendpoint']
         self.prendoint = settingsDict['prendpoint']
-        self.sr_pmds_end = settingsDict['pmdsendpoint'] # Serrano
+        self.sr_pmds_endpoint = settingsDict['pmdsendpoint'] # Serrano
         self.sr_pmds_check = False # Serrano, used for checking if PMDS is online, once on startup
         self.sr_cluster_id = settingsDict['pmdsclusterid'] # Serrano
         self.sr_pmds_namespace = settingsDict['pmdsnamespace'] # Serrano
@@ -55,9 +69,19 @@ class EDEngine:
         self.prKafkaEndpoint = settingsDict['prkafkaendpoint']
         self.prKafkaPort = settingsDict['prkafkaport']
         self.prKafkaTopic = settingsDict['prkafkatopic']
+        self.stream = str2Bool(settingsDict['stream'])
+        self.http_settings = settingsDict['http']
+        self.qconcurrency = settingsDict['qconcurrency']
+        self.incremental = str2Bool(settingsDict['incremental'])
+        self.pr_range = settingsDict['prrange']
+        self.detect_window = None  # trailing detection window, used if incremental is set
+        self.detect_watermark = None  # newest fetched sample
+        self.detect_scored = None  # newest scored sample
         self.grafana_url = settingsDict['grafanaurl']
         self.grafana_credentials = settingsDict['grafanatoken']
         self.grafana_tag = settingsDict['grafanatag']
+        self.grafana_gap = parseDelay(str(settingsDict.get('grafanagap'))) if settingsDict.get('grafanagap') else None
+        self.grafanadash = None  # client reused by all reports
         self.EDEPort = settingsDict['EDEPort']
         self.index = settingsDict['index']
         self.tfrom = settingsDict['from']
@@ -89,6 +113,16 @@ class EDEngine:
         self.verbosecv = settingsDict['verbosecv']
         self.trainscore = settingsDict['trainscore']
         self.returnestimators = settingsDict['returnestimators']
+        self.outofcore = settingsDict['outofcore']
+        self.streaming = settingsDict['streaming']
+        self.detectpipeline = str2Bool(settingsDict['detectpipeline'])
+        self.shared = settingsDict['shared']
+        self.sharedscorer = None  # started on first detection if shared is set
+        self.ensemble = settingsDict['ensemble']
+        self.ensembledetector = None
+        self.reporting = settingsDict['reporting']
+        self.anomalyreporter = None  # started on the first report if reporting is set
+        self.ohencoder = None  # one hot encoder fitted by the last filterData call
         self.analysis = settingsDict['analysis']
         self.validate = settingsDict['validate']
         self.learningcurve = settingsDict['LearningCurve']
@@ -125,10 +159,18 @@ class EDEngine:
                                       index=self.index,
                                       prKafkaEndpoint=self.prKafkaEndpoint,
                                       prKafkaPort=self.prKafkaPort,
-                                      prKafkaTopic=self.prKafkaTopic
+                                      prKafkaTopic=self.prKafkaTopic,
+                                      http_settings=self.http_settings,
+                                      pool_size=max(int(self.qconcurrency), len(self.sr_pmds_group) if self.sr_pmds_endpoint else 0),
+                                      query_concurrency=self.qconcurrency,
+                                      es_bulk=settingsDict.get('esbulk'),
+                                      kafka_settings=settingsDict.get('kafka')
                                       )
         self.qConstructor = QueryConstructor(self.queryDir)
-        self.dformat = DataFormatter(self.dataDir)
+        self.checkpointformat = settingsDict['checkpointformat']
+        self.checkpointcompression = settingsDict['checkpointcompression']
+        self.dformat = DataFormatter(self.dataDir, checkpoint_format=self.checkpointformat,
+                                     checkpoint_compression=self.checkpointcompression)
         self.cfilter = settingsDict['cfilter']
         self.rfilter = settingsDict['rfilter']
         self.dfilter = settingsDict['dfilter']
@@ -259,10 +301,19 @@ class EDEngine:
         return col
 
     def getDataPR(self,
-                  detect=False):
+                  detect=False,
+                  since=None):
+        """
+        Fetch data from the local file, PMDS or PR backend
+
+        :param detect: True if called from the detection loop
+        :param since: only fetch samples from the last since seconds, overrides the configured range
+        :return: dataframe
+        """
         if self.local is not None and not detect:
             if checkFile(self.local):
-                df_qpr = self.edeConnector.localData(self.local)
+                columns, time_range = self.__localPushdown()
+                df_qpr = self.edeConnector.localData(self.local, columns=columns, time_range=time_range)
                 logger.info('[{}] : [INFO] Loading local training file {}'.format(
                     datetime.fromtimestamp(time.time()).strftime(log_format), self.local))
             else:
@@ -275,11 +326,14 @@ class EDEngine:
             query_param = {
                 'cluster_uuid': self.sr_cluster_id,
                 'groups': self.sr_pmds_group,
-                'start': self.sr_pmds_start,
+                'start': self.sr_pmds_start if since is None else '-{}s'.format(since),
                 'stop': self.sr_pmds_end,
                 'format': 'raw',
             }
-            r_pmds = self.edeConnector.sr_pmds_query(query_param)
+            try:
+                r_pmds = self.edeConnector.sr_pmds_query(query_param, stream=self.stream)
+            except ConnectorError as inst:
+                self.__connectorFailure(inst, detect)
             logger.info('[{}] : [INFO] Fetching data from Serrano PMDS backend with query: {}'.format(
                 datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), query_param))
 
@@ -295,13 +349,168 @@ class EDEngine:
                 else:
                     qtime = '10m'
                 queryd = self.qConstructor.pr_query_node(time=qtime)
+            if since is not None:
+                queryd = dict(queryd)
+                queryd['query'] = re.sub(r'\[[^\]]+\]\s*$', '[{}s]'.format(since), queryd['query'])
 
             logger.info('[{}] : [INFO] Fetching data from PR backend with query: {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), queryd))
-            qpr = self.edeConnector.pr_query(queryd)
+            try:
+                if self.pr_range and not detect:
+                    rstart, rend = self.__prRangeBounds()
+                    expr = re.sub(r'\[[^\]]+\]\s*$', '', queryd['query'])
+                    qpr = self.edeConnector.pr_query_range(expr, rstart, rend, step=self.pr_range.get('Step', '1m'),
+                                                           chunk=self.pr_range.get('Chunk', None), stream=self.stream)
+                else:
+                    qpr = self.edeConnector.pr_query(queryd, stream=self.stream)
+            except ConnectorError as inst:
+                self.__connectorFailure(inst, detect)
             df_qpr = self.dformat.prtoDF(data=qpr, checkpoint=checkpoint, verbose=True, detect=detect)
         return df_qpr
 
+    def __localPushdown(self, drop_target=False):
+        """
+        Translates the Filter settings used by filterData into a column predicate and time range for the local
+        data reader. Only columns and rows removed by filterData anyway are skipped, filterData still runs afterwards.
+        DColumns are not pushed down as dropColumns expects them to be present.
+
+        :param drop_target: skip the ground truth column, used by out of core clustering
+        :return: column predicate or None, time range tuple or None
+        """
+        keep = {'time'}
+        if self.target is not None and not drop_target:
+            keep.add(self.target)
+        if self.categorical is not None:
+            keep.update(cfilterparse(self.categorical))
+        predicates = []
+        if self.cfilter is not None and cfilterparse(self.cfilter):
+            cols = set(cfilterparse(self.cfilter))
+            predicates.append(lambda c: c in cols)
+        if self.filterwild and 'Regex' in self.filterwild.keys():
+            regex = re.compile(self.filterwild['Regex'])
+            if self.filterwild.get('Keep', False):
+                predicates.append(lambda c: regex.search(c) is not None)
+            else:
+                predicates.append(lambda c: regex.search(c) is None)
+        if self.target is not None and drop_target:
+            target = self.target
+            predicates.append(lambda c: c != target)
+        columns = None
+        if predicates:
+            columns = lambda c: c in keep or all(p(c) for p in predicates)
+        time_range = None
+        if self.rfilter is not None:
+            ld, gd = rfilterparse(self.rfilter)
+            if int(ld):
+                time_range = (int(gd) if int(gd) else None, int(ld))
+        logger.info('[{}] : [INFO] Local data pushdown, column filter {}, time range {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), columns is not None, time_range))
+        return columns, time_range
+
+    def getDataPRWindow(self):
+        """
+        Rolling detection window. The first call fetches the full interval, subsequent calls only fetch samples
+        newer than the watermark, append them to the window and evict rows older than the interval. The whole
+        window is transformed so filters see the same amount of data as a full fetch, only rows newer than the
+        last scored sample are scored (see __unscoredRows).
+
+        :return: detection window, empty if no new samples were fetched
+        """
+        if self.detect_window is None:
+            new_rows = self.getDataPR(detect=True)
+        else:
+            since = max(int(time.time() - self.__windowTime(self.detect_watermark)) + 1, 1)
+            new_rows = self.getDataPR(detect=True, since=since)
+            if new_rows.shape[0] and 'time' in new_rows.columns:
+                new_rows = new_rows[new_rows['time'] > self.detect_watermark]
+                added = new_rows.columns.difference(self.detect_window.columns)
+                if len(added):
+                    logger.warning('[{}] : [WARN] Dropping {} columns not present in the first detection window: {}'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), len(added), list(added)))
+                new_rows = new_rows.reindex(columns=self.detect_window.columns)
+        if not new_rows.shape[0] or 'time' not in new_rows.columns:
+            logger.info('[{}] : [INFO] No new samples since last detection cycle'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format)))
+            return new_rows
+        if self.detect_window is None:
+            self.detect_window = new_rows.reset_index(drop=True)
+        else:
+            self.detect_window = pd.concat([self.detect_window, new_rows], ignore_index=True)
+        self.detect_watermark = self.detect_window['time'].max()
+        if isinstance(self.detect_watermark, pd.Timestamp):
+            window_start = self.detect_watermark - pd.Timedelta(seconds=self.__windowLength())
+        else:
+            window_start = self.detect_watermark - self.__windowLength()
+        self.detect_window = self.detect_window[self.detect_window['time'] > window_start].reset_index(drop=True)
+        logger.info('[{}] : [INFO] Detection window has {} rows, {} new rows to be scored'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), self.detect_window.shape[0], new_rows.shape[0]))
+        return self.detect_window.copy()
+
+    def __prRangeBounds(self):
+        """
+        Parse the Connector Range Start and End settings, accepted values are epoch seconds, now or -<duration>
+
+        :return: start and end epoch in seconds
+        """
+        now = int(time.time())
+        bounds = []
+        for key, default in (('Start', '-1h'), ('End', 'now')):
+            value = self.pr_range.get(key, default)
+            if value is None or value == 'now':
+                bounds.append(now)
+            elif isinstance(value, str) and value.startswith('-'):
+                bounds.append(now - parseDelay(value[1:]))
+            else:
+                bounds.append(int(value))
+        return bounds[0], bounds[1]
+
+    def __windowTime(self, t):
+        """
+        :param t: PR epoch seconds or PMDS timestamp
+        :return: epoch seconds
+        """
+        if isinstance(t, pd.Timestamp):
+            return t.timestamp()
+        return float(t)
+
+    def __windowLength(self):
+        """
+        :return: length in seconds of the configured detection range
+        """
+        if self.sr_pmds_end is not None:
+            return parseDelay(str(self.sr_pmds_start).lstrip('-'))
+        if self.query is not None:
+            qrange = re.search(r'\[([^\]]+)\]\s*$', self.query['query'])
+            if qrange:
+                return parseDelay(qrange.group(1))
+        return parseDelay(self.qinterval or '10m')
+
+    def __unscoredRows(self, data, scored):
+        """
+        :param data: transformed detection window, indexed by time
+        :param scored: newest sample scored in a previous cycle, None scores the whole window
+        :return: rows newer than scored
+        """
+        if scored is None:
+            return data
+        data = data[data.index > scored]
+        logger.info('[{}] : [INFO] Scoring {} rows newer than {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), data.shape[0], scored))
+        return data
+
+    def __connectorFailure(self, inst, detect):
+        """
+        Training can not continue without data, detection skips the current cycle instead of exiting
+
+        :param inst: ConnectorError raised by the connector
+        :param detect: True if called from the detection loop
+        """
+        if detect:
+            raise inst
+        logger.error('[{}] : [ERROR] Failed to fetch training data with {}, exiting'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), inst))
+        sys.exit(2)
+
     def getData(self, detect=False):
         if detect:
             tfrom = "now-%s" %self.interval
@@ -323,6 +532,8 @@ class EDEngine:
                 linterface = []
                 lpack = []
 
+                # Build all per node queries first and execute them concurrently
+                node_queries = []
                 for node in desNodes:
                     load, load_file = self.qConstructor.loadString(node)
                     memory, memory_file = self.qConstructor.memoryString(node)
@@ -334,12 +545,13 @@ class EDEngine:
                     qmemory = self.qConstructor.systemMemoryQuery(memory, tfrom, to, self.qsize, self.qinterval)
                     qinterface = self.qConstructor.systemInterfaceQuery(interface, tfrom, to, self.qsize, self.qinterval)
                     qpacket = self.qConstructor.systemInterfaceQuery(packet, tfrom, to, self.qsize, self.qinterval)
+                    node_queries.append(((qload, load_file), (qmemory, memory_file),
+                                         (qinterface, interface_file), (qpacket, packet_file)))
+                responses = self.edeConnector.aggQueryParallel([q for nq in node_queries for q, _ in nq])
 
-                    # Execute query and convert response to csv
-                    qloadResponse = self.edeConnector.aggQuery(qload)
-                    gmemoryResponse = self.edeConnector.aggQuery(qmemory)
-                    ginterfaceResponse = self.edeConnector.aggQuery(qinterface)
-                    gpacketResponse = self.edeConnector.aggQuery(qpacket)
+                for idx, nq in enumerate(node_queries):
+                    (qload, load_file), (qmemory, memory_file), (qinterface, interface_file), (qpacket, packet_file) = nq
+                    qloadResponse, gmemoryResponse, ginterfaceResponse, gpacketResponse = responses[idx * 4:(idx + 1) * 4]
 
                     if not checkpoint:
                         self.dformat.dict2csv(ginterfaceResponse, qinterface, interface_file)
@@ -387,6 +599,7 @@ class EDEngine:
                 lDataNode = []
                 lmap = {}
                 lreduce = {}
+                node_queries = []
                 for node in desNodes:
                     nodeManager, nodeManager_file = self.qConstructor.nodeManagerString(node)
                     jvmNodeManager, jvmNodeManager_file = self.qConstructor.jvmnodeManagerString(node)
@@ -401,13 +614,15 @@ class EDEngine:
                     qshuffle = self.qConstructor.shuffleQuery(shuffle, tfrom, to, self.qsize, self.qinterval)
                     qreduce = self.qConstructor.queryByProcess(reduce, tfrom, to, 500, self.qinterval)
                     qmap = self.qConstructor.queryByProcess(map, tfrom, to, 500, self.qinterval)
+                    node_queries.append((node, [qnodeManager, qjvmNodeManager, qshuffle, qdatanode, qreduce, qmap],
+                                         [nodeManager_file, jvmNodeManager_file, shuffle_file, datanode_file]))
+                responses = self.edeConnector.aggQueryParallel([q for nq in node_queries for q in nq[1]])
 
-                    gnodeManagerResponse = self.edeConnector.aggQuery(qnodeManager)
-                    gjvmNodeManagerResponse = self.edeConnector.aggQuery(qjvmNodeManager)
-                    gshuffleResponse = self.edeConnector.aggQuery(qshuffle)
-                    gdatanode = self.edeConnector.aggQuery(qdatanode)
-                    greduce = self.edeConnector.aggQuery(qreduce)
-                    gmap = self.edeConnector.aggQuery(qmap)
+                for idx, (node, nqueries, nfiles) in enumerate(node_queries):
+                    qnodeManager, qjvmNodeManager, qshuffle, qdatanode, qreduce, qmap = nqueries
+                    nodeManager_file, jvmNodeManager_file, shuffle_file, datanode_file = nfiles
+                    gnodeManagerResponse, gjvmNodeManagerResponse, gshuffleResponse, gdatanode, greduce, gmap = \
+                        responses[idx * 6:(idx + 1) * 6]
 
                     if list(gnodeManagerResponse['aggregations'].values())[0].values()[0]:
                         if not checkpoint:
@@ -457,41 +672,32 @@ class EDEngine:
                         uniqueMap.add(i['_source']['ProcessName'])
                     nodeProcessMap[node] = list(uniqueMap)
                 # Get Process info by host and name
-                for host, processes in nodeProcessReduce.items():
-                    if processes:
-                        for process in processes:
-                            logger.info('[%s] : [INFO] Reduce process %s for host  %s found',
-                                            datetime.fromtimestamp(time.time()).strftime(log_format), process,
-                                            host)
-                            hreduce, hreduce_file = self.qConstructor.jvmRedProcessbyNameString(host, process)
-                            qhreduce = self.qConstructor.jvmNNquery(hreduce, tfrom, to, self.qsize, self.qinterval)
-                            ghreduce = self.edeConnector.aggQuery(qhreduce)
-                            if not checkpoint:
-                                self.dformat.dict2csv(ghreduce, qhreduce, hreduce_file)
-                            else:
-                                lreduce[process] = self.dformat.dict2csv(ghreduce, qhreduce, hreduce_file, df=checkpoint)
-                    else:
-                        logger.info('[%s] : [INFO] No reduce process for host  %s found',
-                                        datetime.fromtimestamp(time.time()).strftime(log_format), host)
-                        pass
-
-                for host, processes in nodeProcessMap.items():
-                    if processes:
-                        for process in processes:
-                            logger.info('[%s] : [INFO] Map process %s for host  %s found',
-                                            datetime.fromtimestamp(time.time()).strftime(log_format), process,
+                process_queries = []
+                for kind, nodeProcess in (('Reduce', nodeProcessReduce), ('Map', nodeProcessMap)):
+                    for host, processes in nodeProcess.items():
+                        if processes:
+                            for process in processes:
+                                logger.info('[%s] : [INFO] %s process %s for host  %s found',
+                                                datetime.fromtimestamp(time.time()).strftime(log_format), kind,
+                                                process, host)
+                                if kind == 'Reduce':
+                                    hproc, hproc_file = self.qConstructor.jvmRedProcessbyNameString(host, process)
+                                else:
+                                    hproc, hproc_file = self.qConstructor.jvmMapProcessbyNameString(host, process)
+                                qhproc = self.qConstructor.jvmNNquery(hproc, tfrom, to, self.qsize, self.qinterval)
+                                process_queries.append((kind, process, qhproc, hproc_file))
+                        else:
+                            logger.info('[%s] : [INFO] No %s process for host  %s found',
+                                            datetime.fromtimestamp(time.time()).strftime(log_format), kind.lower(),
                                             host)
-                            hmap, hmap_file = self.qConstructor.jvmMapProcessbyNameString(host, process)
-                            qhmap = self.qConstructor.jvmNNquery(hmap, tfrom, to, self.qsize, self.qinterval)
-                            ghmap = self.edeConnector.aggQuery(qhmap)
-                            if not checkpoint:
-                                self.dformat.dict2csv(ghmap, qhmap, hmap_file)
-                            else:
-                                lmap[process] = self.dformat.dict2csv(ghmap, qhmap, hmap_file, df=checkpoint)
+                process_responses = self.edeConnector.aggQueryParallel([pq[2] for pq in process_queries])
+                for (kind, process, qhproc, hproc_file), ghproc in zip(process_queries, process_responses):
+                    if not checkpoint:
+                        self.dformat.dict2csv(ghproc, qhproc, hproc_file)
+                    elif kind == 'Reduce':
+                        lreduce[process] = self.dformat.dict2csv(ghproc, qhproc, hproc_file, df=checkpoint)
                     else:
-                        logger.info('[%s] : [INFO] No map process for host  %s found',
-                                        datetime.fromtimestamp(time.time()).strftime(log_format), host)
-                        pass
+                        lmap[process] = self.dformat.dict2csv(ghproc, qhproc, hproc_file, df=checkpoint)
 
                         # Get non host based metrics queries and file strings
                 dfs, dfs_file = self.qConstructor.dfsString()
@@ -516,14 +722,9 @@ class EDEngine:
 
 
                 # Responses
-                gdfs = self.edeConnector.aggQuery(qdfs)
-                gdfsFs = self.edeConnector.aggQuery(qdfsFs)
-                gjvmNameNode = self.edeConnector.aggQuery(qjvmNameNode)
-                gqueue = self.edeConnector.aggQuery(qqueue)
-                gcluster = self.edeConnector.aggQuery(qcluster)
-                gjvmResourceManager = self.edeConnector.aggQuery(qjvmResMng)
-                gjvmMrapp = self.edeConnector.aggQuery(qjvmMrapp)
-                gfsop = self.edeConnector.aggQuery(qfsop)
+                gdfs, gdfsFs, gjvmNameNode, gqueue, gcluster, gjvmResourceManager, gjvmMrapp, gfsop = \
+                    self.edeConnector.aggQueryParallel([qdfs, qdfsFs, qjvmNameNode, qqueue, qcluster, qjvmResMng,
+                                                        qjvmMrapp, qfsop])
 
                 if not checkpoint:
                     self.dformat.dict2csv(gdfs, qdfs, dfs_file)
@@ -731,14 +932,15 @@ class EDEngine:
                         datetime.fromtimestamp(time.time()).strftime(log_format))
             col = self.getCategoricalFeatures()
             df, v, o = self.dformat.ohEncoding(df, cols=col)
+            self.ohencoder = o
         if checkpoint:
             logger.info('[{}] : [INFO] Checkpointing  filtered data ...'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format)))
             if detect:
-                pr_f = "pr_data_detect_filtered.csv"
+                pr_f = "pr_data_detect_filtered"
             else:
-                pr_f = 'pr_data_filtered.csv'
-            df.to_csv(os.path.join(self.dataDir, pr_f))
+                pr_f = 'pr_data_filtered'
+            self.dformat.checkpoint(df, pr_f)
         logger.info('[{}] : [INFO] Filtered data shape {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), df.shape))
         if df.shape[0] == 0:
@@ -747,43 +949,210 @@ class EDEngine:
             sys.exit(1)
         return df
 
+    def __outOfCoreBatches(self, ddf, drop_cols):
+        """
+        Compute one partition at a time and apply the row level filters. Column level filters are pushed down
+        into the reader or computed globally beforehand by __trainOutOfCore.
+
+        :param ddf: dask dataframe
+        :param drop_cols: columns to drop from every partition
+        :return: generator of (features, ground truth or None) tuples indexed by time
+        """
+        for part in ddf.to_delayed():
+            df = part.compute()
+            if df.empty:
+                continue
+            y = None
+            if self.traintype == 'classification' or self.traintype == 'hpo' or self.traintype == 'tpot':
+                df, y = self.dformat.getGT(df, gt=self.target)
+            if drop_cols:
+                df = df.drop([c for c in drop_cols if c in df.columns], axis=1)
+            if self.fillnan:
+                df.fillna(0, inplace=True)
+            df.set_index('time', inplace=True)
+            yield df, y
+
+    def __trainOutOfCore(self):
+        """
+        Out of core training on local data larger than memory. The file is read as a partitioned dask dataframe,
+        global statistics used by the filters are computed in a single pass, the scaler is fitted incrementally and
+        partitions are streamed to the estimator. User defined clustering methods exposing partial_fit are trained on
+        every partition, all other methods are trained on a per partition random sample.
+
+        :return: sampled training data and ground truth, (None, None) if the model was trained incrementally
+        """
+        import dask
+        blocksize = self.outofcore.get('Blocksize', '64MB')
+        frac = float(self.outofcore.get('Sample', 0.1))
+        seed = self.outofcore.get('Seed', 42)
+        ground_truth = self.traintype in ('classification', 'hpo', 'tpot')
+        columns, time_range = self.__localPushdown(drop_target=not ground_truth)
+        ddf = self.dformat.toDask(os.path.join(self.dataDir, self.local), blocksize=blocksize, columns=columns,
+                                  time_range=time_range)
+        drop_cols = []
+        if self.target is not None and not ground_truth:
+            drop_cols.append(self.target)  # in case the reader ignored the projection
+        if self.dfilter is not None and cfilterparse(self.dfilter):
+            drop_cols.extend(cfilterparse(self.dfilter))
+        if self.filterlow or self.dropnan:
+            keep = ['time', self.target]
+            num = ddf[[c for c in ddf.select_dtypes('number').columns if c not in keep]]
+            logger.info('[{}] : [INFO] Computing global column statistics over {} partitions ...'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), ddf.npartitions))
+            cmin, cmax, ccount = dask.compute(num.min(), num.max(), num.count())
+            if self.filterlow:
+                low = list(cmin[(cmin == cmax) | (ccount == 0)].index)
+                logger.info('[{}] : [INFO] Found {} low variance columns removing ...'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), len(low)))
+                drop_cols.extend(low)
+            if self.dropnan:
+                empty = list(ccount[ccount == 0].index)
+                logger.info('[{}] : [INFO] Found {} columns with only missing values removing ...'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), len(empty)))
+                drop_cols.extend(empty)
+        drop_cols = list(dict.fromkeys(drop_cols))
+
+        scaler = None
+        operations = False
+        remove_filtered = False
+        if self.augmentations is not None:
+            scaler_type = self.augmentations.get('Scaler', False)
+            if scaler_type:
+                scaler = self.dformat.partial_scale((X for X, _ in self.__outOfCoreBatches(ddf, drop_cols)),
+                                                    scaler_type=scaler_type)
+            if 'Operations' in self.augmentations:
+                operations = self.augmentations['Operations']
+                remove_filtered = operations.get('RemoveFiltered', True)
+
+        def prepared():
+            for X, y in self.__outOfCoreBatches(ddf, drop_cols):
+                if scaler is not None:
+                    X = self.dformat.transform(X, scaler)
+                if operations:
+                    X = self.dformat.computeOnColumns(X, operations=operations, remove_filtered=remove_filtered)
+                yield X, y
+
+        if self.traintype == 'clustering' and not isinstance(self.trainmethod, str) \
+                and hasattr(self.trainmethod, 'partial_fit'):
+            logger.info('[{}] : [INFO] Training user defined method incrementally ...'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format)))
+            umeth = sede.SciCluster(self.modelsDir)
+            umeth.dask_partialFitMethod(cluster_method=self.trainmethod, mname=self.export,
+                                        batches=(X for X, _ in prepared()))
+            return None, None
+
+        logger.info('[{}] : [INFO] Method does not support incremental training, sampling {} of each partition'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), frac))
+        rng = np.random.RandomState(seed)
+        samples = []
+        ys = []
+        for X, y in prepared():
+            mask = rng.random_sample(X.shape[0]) < frac
+            samples.append(X[mask])
+            if y is not None:
+                ys.append(y[mask])
+        if not samples:
+            logger.error('[{}] : [ERROR] Empty dataframe rezulted after filtering! Exiting!'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format)))
+            sys.exit(1)
+        asudata = pd.concat(samples)
+        y = np.concatenate(ys) if ys else None
+        logger.info('[{}] : [INFO] Sampled training data shape {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), asudata.shape))
+        if str2Bool(self.checkpoint):
+            self.dformat.checkpoint(asudata, 'pr_data_augmented')
+        return asudata, y
+
+    def __compilePipeline(self, pr_data, filtered_columns, asudata, scaled=False):
+        """
+        Compile the preprocessing applied during training and save it next to the model
+
+        :param pr_data: raw training data
+        :param filtered_columns: columns remaining after filterData
+        :param asudata: training data after filtering, scaling and augmentation
+        :param scaled: True if the training scaler was applied
+        """
+        encoder = self.ohencoder if self.categorical is not None else None
+        encoded = set(encoder.get_feature_names()) if encoder is not None else set()
+        scaler = None
+        operations = None
+        remove_filtered = True
+        if self.augmentations is not None:
+            if scaled:
+                scaler_name = list(self.augmentations['Scaler'].keys())[-1]
+                scaler = joblib.load(os.path.join(self.dataDir, '{}.scaler'.format(scaler_name)))
+            if 'Operations' in self.augmentations:
+                operations = self.augmentations['Operations']
+                remove_filtered = operations.get('RemoveFiltered', True)
+        pipeline = PreprocessPipeline([c for c in filtered_columns if c not in encoded],
+                                      categorical=self.getCategoricalFeatures() if encoder is not None else None,
+                                      encoder=encoder, fillna=bool(self.fillnan), scaler=scaler,
+                                      operations=operations, remove_filtered=remove_filtered)
+        if not pipeline.verify(pr_data, asudata):
+            logger.warning('[{}] : [WARN] Compiled pipeline does not reproduce training preprocessing, not saved'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format)))
+            return
+        pipeline_file = os.path.join(self.modelsDir, '{}.pipeline'.format(self.export))
+        try:
+            pipeline.save(pipeline_file)
+        except Exception as inst:
+            logger.warning('[{}] : [WARN] Failed to save compiled pipeline with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+            return
+        model_registry.invalidate(pipeline_file)
+
     def trainDaskMethod(self):
         if str2Bool(self.train):
             logger.info('[{}] : [INFO] Training started. Getting data ...'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format)))
             checkpoint = str2Bool(self.checkpoint)
-            pr_data = self.getDataPR()
-            if self.traintype == 'classification' or self.traintype == 'hpo' or self.traintype =='tpot':
-                pr_data, y = self.dformat.getGT(pr_data, gt=self.target)
-            udata = self.filterData(pr_data)
-            if self.augmentations is not None:
-                try:
-                    scaler_type = self.augmentations['Scaler']
+            if self.outofcore is not None and self.local is not None and self.categorical is None:
+                asudata, y = self.__trainOutOfCore()
+                if asudata is None:
+                    logger.info('[{}] : [INFO] Training complete'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format)))
+                    return 0
+                pr_data = asudata
+            else:
+                if self.outofcore is not None:
+                    logger.warning('[{}] : [WARN] Out of core training requires local data without categorical features, loading in memory'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format)))
+                pr_data = self.getDataPR()
+                if self.traintype == 'classification' or self.traintype == 'hpo' or self.traintype =='tpot':
+                    pr_data, y = self.dformat.getGT(pr_data, gt=self.target)
+                udata = self.filterData(pr_data)
+                filtered_columns = list(udata.columns)
+                if self.augmentations is not None:
+                    try:
+                        scaler_type = self.augmentations['Scaler']
 
-                except Exception:
-                    scaler_type = False
+                    except Exception:
+                        scaler_type = False
 
-                try:
-                    sudata = self.dformat.scale(data=udata, scaler_type=scaler_type)
-                except Exception as inst:
-                    logger.warning('[{}] : [WARN] Failed to initialize scaler with {} and {}'.format(
-                    datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
-                    sudata = udata
-                try:
-                    operations = self.augmentations['Operations']
                     try:
-                        remove_filtered = self.augmentations['Operations']['RemoveFiltered']
+                        sudata = self.dformat.scale(data=udata, scaler_type=scaler_type)
+                    except Exception as inst:
+                        logger.warning('[{}] : [WARN] Failed to initialize scaler with {} and {}'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+                        sudata = udata
+                    try:
+                        operations = self.augmentations['Operations']
+                        try:
+                            remove_filtered = self.augmentations['Operations']['RemoveFiltered']
+                        except Exception:
+                            remove_filtered = True
                     except Exception:
-                        remove_filtered = True
-                except Exception:
-                    operations = False
-                    remove_filtered = False
+                        operations = False
+                        remove_filtered = False
 
-                asudata = self.dformat.computeOnColumns(sudata, operations=operations, remove_filtered=remove_filtered)
-                if checkpoint:
-                    asudata.to_csv(os.path.join(self.dataDir, 'pr_data_augmented.csv'))
-            else:
-                asudata = udata
+                    asudata = self.dformat.computeOnColumns(sudata, operations=operations, remove_filtered=remove_filtered)
+                    if checkpoint:
+                        self.dformat.checkpoint(asudata, 'pr_data_augmented')
+                else:
+                    asudata = udata
+                if self.traintype == 'clustering' or self.traintype == 'classification':
+                    self.__compilePipeline(pr_data, filtered_columns, asudata,
+                                           scaled=self.augmentations is not None and sudata is not udata)
             # User defined analysis
             if self.analysis is not None:
                 self.analisysDask(pr_data)
@@ -1107,7 +1476,7 @@ class EDEngine:
             logger.warning('[%s] : [WARN] Using default values for point anomaly load',
                            datetime.fromtimestamp(time.time()).strftime(log_format))
         networkth = pointThraesholds(self.snetwork)
-        if not loadth:
+        if not networkth:
             networkth = {'rx': {'threashold': '1000000000', 'bound': 'gd'},
                          'tx': {'threashold': '1000000000', 'bound': 'gd'}}
             logger.warning('[%s] : [WARN] Using default values for point anomaly network',
@@ -1120,7 +1489,7 @@ class EDEngine:
                         'free': {'threashold': '100000000', 'bound': 'ld'}}
             logger.warning('[%s] : [WARN] Using default values for point anomaly memory',
                            datetime.fromtimestamp(time.time()).strftime(log_format))
-        all = [loadth, networkth, memoryth]
+        detector = PointDetector([loadth, networkth, memoryth])
         while True:
             lload = []
             lmemory = []
@@ -1157,146 +1526,217 @@ class EDEngine:
                                                                                             lpack=lpack)
                 df_system = self.dformat.chainMergeNR(interface=df_interface, memory=df_memory,
                                                       load=df_load, packets=df_packet)
-                dict_system = self.dformat.df2dict(df_system)
-                # print dict_system
-                for th in all:
-                    for type, val in th.items():
-                        responseD = {}
-                        if val['bound'] == 'gd':
-                            anomalies = self.edepoint.detpoint(dict_system, type=type, threashold=val['threashold'], lt=False)
-                            if anomalies:
-                                responseD['anomalies'] = anomalies
-                                # self.reportAnomaly(responseD)
-                            else:
-                                logger.info('[%s] : [INFO] No point anomalies detected for type %s',
-                         datetime.fromtimestamp(time.time()).strftime(log_format), type)
-                        else:
-                            anomalies = self.edepoint.detpoint(dict_system, type=type, threashold=val['threashold'], lt=True)
-                            if anomalies:
-                                responseD['anomalies'] = anomalies
-                                # self.reportAnomaly(responseD)
-                            else:
-                                logger.info('[%s] : [INFO] No point anomalies detected for type %s ',
-                                            datetime.fromtimestamp(time.time()).strftime(log_format), type)
-                    if responseD:
-                        self.reportAnomaly(responseD)
-                    else:
-                        logger.info('[%s] : [INFO] No point anomalies detected',
-                                    datetime.fromtimestamp(time.time()).strftime(log_format))
-                    sleep(parseDelay(self.delay))
+                anomalies = detector.detect(df_system, index='key')
+                if anomalies:
+                    self.reportAnomaly({'anomalies': anomalies, 'method': 'point', 'node': node})
+                else:
+                    logger.info('[%s] : [INFO] No point anomalies detected for node %s',
+                                datetime.fromtimestamp(time.time()).strftime(log_format), node)
+            sleep(parseDelay(self.delay))
+
+    def __detectTransform(self, pr_data):
+        """
+        Apply filters, detection scaler and augmentations to a detection window. If a compiled pipeline was
+        saved with the model it replaces filterData, the detection scaler and computeOnColumns.
+
+        :param pr_data: raw detection window
+        :return: transformed window, only rows not scored in a previous cycle if incremental is set
+        """
+        scored = None
+        if self.incremental and 'time' in pr_data.columns:
+            # windows are transformed in fetch order, also by the streaming transform stage
+            scored, self.detect_scored = self.detect_scored, pr_data['time'].max()
+        pipeline = None
+        if self.detectpipeline:
+            pipeline = model_registry.load(os.path.join(self.modelsDir, '{}.pipeline'.format(self.load)))
+        if pipeline is not None:
+            if self.rfilter is not None:
+                ld, gd = rfilterparse(self.rfilter)
+                if int(ld):
+                    pr_data = self.dformat.filterRows(pr_data, int(ld), int(gd))
+            asudata = pipeline.transform(pr_data)
+            logger.info('[{}] : [INFO] Compiled pipeline transformed data shape {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), asudata.shape))
+            if str2Bool(self.checkpoint):
+                self.dformat.checkpoint(asudata, 'pr_data_detect_augmented')
+            return self.__unscoredRows(asudata, scored)
+        udata = self.filterData(pr_data, detect=True)
+        if self.detectionscaler is not None:
+            logger.info('[{}] : [INFO] Detection scaler set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), self.detectionscaler))
+            scaler_file = os.path.join(self.dataDir, "{}.scaler".format(self.detectionscaler))
+            try:
+                logger.info('[{}] : [INFO] Detection started. Getting data ...'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format)))
+                sudata = self.dformat.load_scaler(udata, scaler_file)
+            except Exception as inst:
+                logger.warning('[{}] : [WARN] Failed to initialize detection scaler with {} and {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), type(inst),
+                    inst.args))
+                sudata = udata
+        else:
+            sudata = udata
+        if self.augmentations is not None:
+            try:
+                operations = self.augmentations['Operations']
+                try:
+                    remove_filtered = self.augmentations['Operations']['RemoveFiltered']
+                except Exception:
+                    remove_filtered = True
+            except Exception:
+                operations = False
+                remove_filtered = False
+            asudata = self.dformat.computeOnColumns(sudata, operations=operations,
+                                                    remove_filtered=remove_filtered)
+        else:
+            asudata = sudata
+        if str2Bool(self.checkpoint):
+            self.dformat.checkpoint(asudata, 'pr_data_detect_augmented')
+        return self.__unscoredRows(asudata, scored)
+
+    def __detectScore(self, data):
+        """
+        Score a detection window or micro batch with the loaded model, or all models of the ensemble
+
+        :param data: transformed data
+        :return: anomaly dictionary
+        """
+        if not data.shape[0]:
+            return {'anomalies': []}
+        if self.ensemble:
+            self.__sharedScorer()  # created once before members are scored in parallel
+            return self.__ensembleDetector().detect(self.__memberScore, data)
+        return self.__memberScore({'Method': self.detectmethod, 'Load': self.load, 'Type': self.detecttype}, data)
+
+    def __memberScore(self, member, data):
+        """
+        :param member: dictionary with Method, Load and Type of the model
+        :param data: transformed data
+        :return: anomaly dictionary
+        """
+        scorer = self.__sharedScorer()
+        if member.get('Type', self.detecttype) == 'clustering':
+            smodel = sede.SciCluster(modelDir=self.modelsDir, pred_analysis=self.pred_analysis, scorer=scorer)
+            return smodel.dask_detect(member['Method'], member['Load'], data=data)
+        classede = cede.SciClassification(self.modelsDir, self.dataDir, self.checkpoint, self.export,
+                                          training=self.trainingSet, validation=self.validationSet,
+                                          validratio=self.validratio, compare=self.compare, cv=self.cv,
+                                          trainscore=self.trainscore, scorers=self.scorers,
+                                          returnestimators=self.returnestimators,
+                                          pred_analysis=self.pred_analysis, scorer=scorer)
+        return classede.dask_detect(member['Method'], member['Load'], data=data)
+
+    def __ensembleDetector(self):
+        if self.ensembledetector is not None:
+            return self.ensembledetector
+        try:
+            members = self.ensemble['Members']
+            for member in members:
+                if member.get('Type', self.detecttype) not in ('clustering', 'classification'):
+                    raise ValueError('Unknown detection type {} of member {}'.format(member.get('Type'), member))
+            try:
+                voting = self.ensemble['Voting']
+            except Exception:
+                voting = 'majority'
+            try:
+                n_jobs = self.ensemble['Workers']
+            except Exception:
+                n_jobs = None
+            self.ensembledetector = EnsembleDetector(members, voting=voting, n_jobs=n_jobs)
+        except Exception as inst:
+            logger.error('[{}] : [ERROR] Invalid ensemble settings {} with {} and {}. Exiting ...'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), self.ensemble, type(inst), inst.args))
+            sys.exit(1)
+        logger.info('[{}] : [INFO] Ensemble detection with members {} and {} voting'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format),
+            [m['name'] for m in self.ensembledetector.members], self.ensembledetector.voting))
+        return self.ensembledetector
+
+    def __sharedScorer(self):
+        """
+        Shared memory scoring workers, created in the detect process so each detect process owns its pool
+
+        :return: SharedScorer or None if not set
+        """
+        if not self.shared or self.sharedscorer is not None:
+            return self.sharedscorer
+        try:
+            workers = self.shared['Workers']
+        except Exception:
+            workers = 2
+        try:
+            min_rows = self.shared['MinRows']
+        except Exception:
+            min_rows = 2048
+        logger.info('[{}] : [INFO] Shared memory scoring set with {} workers for windows of at least {} rows'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), workers, min_rows))
+        self.sharedscorer = SharedScorer(workers=workers, min_rows=min_rows)
+        return self.sharedscorer
+
+    def __detectReport(self, anomalies):
+        if not anomalies['anomalies']:
+            logger.info('[{}] : [INFO] No anomalies detected with {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), anomalies.get('method', self.detectmethod)))
+        else:
+            anomalies.setdefault('method', self.detectmethod)
+            anomalies['interval'] = self.qinterval
+            logger.info('[{}] : [DEBUG] Reporting detected anomalies: {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), anomalies))
+            self.reportAnomaly(anomalies, dask=True)
+
+    def __detectFetch(self):
+        try:
+            if self.incremental:
+                return self.getDataPRWindow()
+            return self.getDataPR(detect=True)
+        except ConnectorError as inst:
+            logger.warning('[{}] : [WARN] Skipping detection cycle, data fetch failed with {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), inst))
+            return None
+
+    def detectStreaming(self):
+        """
+        Fixed rate pipelined detection, the window period is set by delay
+        """
+        try:
+            micro_batch = self.streaming['MicroBatch']
+        except Exception:
+            micro_batch = None
+        try:
+            queue_size = self.streaming['QueueSize']
+        except Exception:
+            queue_size = 2
+        scorer = StreamingScorer(fetch=self.__detectFetch, transform=self.__detectTransform,
+                                 score=self.__detectScore, report=self.__detectReport,
+                                 period=parseDelay(self.delay), micro_batch=micro_batch, queue_size=queue_size)
+        scorer.run()
 
     def detectDaskAnomalies(self):
         if str2Bool(self.detect):
-            checkpoint = str2Bool(self.checkpoint)
+            if self.detecttype not in ('clustering', 'classification'):
+                logger.error('[{}] : [ERROR] Unknown detection type {}. Exiting..'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), self.detecttype))
+                sys.exit(1)
             if self.detecttype == 'clustering':
                 logger.info('[{}] : [INFO] Detection with clusterer started. Getting data ...'.format(
                     datetime.fromtimestamp(time.time()).strftime(log_format)))
-                while True:
-                    pr_data = self.getDataPR(detect=True)
-                    udata = self.filterData(pr_data, detect=True)
-                    if self.detectionscaler is not None:
-                        logger.info('[{}] : [INFO] Detection scaler set to {}'.format(
-                            datetime.fromtimestamp(time.time()).strftime(log_format), self.detectionscaler))
-                        scaler_file = os.path.join(self.dataDir, "{}.scaler".format(self.detectionscaler))
-                        try:
-                            logger.info('[{}] : [INFO] Detection started. Getting data ...'.format(
-                                datetime.fromtimestamp(time.time()).strftime(log_format)))
-                            sudata = self.dformat.load_scaler(udata, scaler_file)
-                        except Exception as inst:
-                            logger.warning('[{}] : [WARN] Failed to initialize detection scaler with {} and {}'.format(
-                                datetime.fromtimestamp(time.time()).strftime(log_format), type(inst),
-                                inst.args))
-                            sudata = udata
-                    else:
-                        sudata = udata
-                    if self.augmentations is not None:
-                        try:
-                            operations = self.augmentations['Operations']
-                            try:
-                                remove_filtered = self.augmentations['Operations']['RemoveFiltered']
-                            except Exception:
-                                remove_filtered = True
-                        except Exception:
-                            operations = False
-                            remove_filtered = False
-                        asudata = self.dformat.computeOnColumns(sudata, operations=operations, remove_filtered=remove_filtered)
-                    else:
-                        asudata = sudata
-                    if checkpoint:
-                        asudata.to_csv(os.path.join(self.dataDir, 'pr_data_detect_augmented.csv'))
-                    smodel = sede.SciCluster(modelDir=self.modelsDir, pred_analysis=self.pred_analysis)
-                    anomalies = smodel.dask_detect(self.detectmethod, self.load, data=asudata)
-                    if not anomalies['anomalies']:
-                        logger.info('[{}] : [INFO] No anomalies detected with {}'.format(
-                            datetime.fromtimestamp(time.time()).strftime(log_format), self.detectmethod))
-                        sleep(parseDelay(self.delay))
-                    else:
-                        anomalies['method'] = self.detectmethod
-                        anomalies['interval'] = self.qinterval
-                        logger.info('[{}] : [DEBUG] Reporting detected anomalies: {}'.format(
-                            datetime.fromtimestamp(time.time()).strftime(log_format), anomalies))
-                        self.reportAnomaly(anomalies, dask=True)
-                        sleep(parseDelay(self.delay))
-            elif self.detecttype == 'classification':
+            else:
                 logger.info('[{}] : [INFO] Detection with classifier started. Getting data ...'.format(
                     datetime.fromtimestamp(time.time()).strftime(log_format)))
-                while True:
-                    pr_data = self.getDataPR(detect=True)
-                    udata = self.filterData(pr_data, detect=True)
-                    if self.detectionscaler is not None:
-                        logger.info('[{}] : [INFO] Detection scaler set to {}'.format(
-                            datetime.fromtimestamp(time.time()).strftime(log_format), self.detectionscaler))
-                        scaler_file = os.path.join(self.dataDir, "{}.scaler".format(self.detectionscaler))
-                        try:
-                            logger.info('[{}] : [INFO] Detection started. Getting data ...'.format(
-                                datetime.fromtimestamp(time.time()).strftime(log_format)))
-                            sudata = self.dformat.load_scaler(udata, scaler_file)
-                        except Exception as inst:
-                            logger.warning('[{}] : [WARN] Failed to initialize detection scaler with {} and {}'.format(
-                                datetime.fromtimestamp(time.time()).strftime(log_format), type(inst),
-                                inst.args))
-                            sudata = udata
-                    else:
-                        sudata = udata
-                    if self.augmentations is not None:
-                        try:
-                            operations = self.augmentations['Operations']
-                            try:
-                                remove_filtered = self.augmentations['Operations']['RemoveFiltered']
-                            except Exception:
-                                remove_filtered = True
-                        except Exception:
-                            operations = False
-                            remove_filtered = False
-                        asudata = self.dformat.computeOnColumns(sudata, operations=operations,
-                                                                remove_filtered=remove_filtered)
-                    else:
-                        asudata = sudata
-                    if checkpoint:
-                        asudata.to_csv(os.path.join(self.dataDir, 'pr_data_detect_augmented.csv'))
-                    classede = cede.SciClassification(self.modelsDir, self.dataDir, self.checkpoint, self.export,
-                                                      training=self.trainingSet, validation=self.validationSet,
-                                                      validratio=self.validratio, compare=self.compare, cv=self.cv,
-                                                      trainscore=self.trainscore, scorers=self.scorers,
-                                                      returnestimators=self.returnestimators,
-                                                      pred_analysis=self.pred_analysis)
-                    anomalies = classede.dask_detect(self.detectmethod, self.load, data=asudata)
-                    if not anomalies['anomalies']:
-                        logger.info('[{}] : [INFO] No anomalies detected with {}'.format(
-                            datetime.fromtimestamp(time.time()).strftime(log_format), self.detectmethod))
-                        sleep(parseDelay(self.delay))
-                    else:
-                        anomalies['method'] = self.detectmethod
-                        anomalies['interval'] = self.qinterval
-                        logger.info('[{}] : [DEBUG] Reporting detected anomalies: {}'.format(
-                            datetime.fromtimestamp(time.time()).strftime(log_format), anomalies))
-                        self.reportAnomaly(anomalies, dask=True)
-                        # print(anomalies)
-                        sleep(parseDelay(self.delay))
-            else:
-                logger.error('[{}] : [ERROR] Unknown detection type {}. Exiting..'.format(
-                    datetime.fromtimestamp(time.time()).strftime(log_format), self.detecttype))
-                sys.exit(1)
+            if self.ensemble:
+                self.__ensembleDetector()
+            if self.streaming:
+                self.detectStreaming()
+                return
+            while True:
+                pr_data = self.__detectFetch()
+                if pr_data is None or not pr_data.shape[0]:
+                    sleep(parseDelay(self.delay))
+                    continue
+                asudata = self.__detectTransform(pr_data)
+                anomalies = self.__detectScore(asudata)
+                self.__detectReport(anomalies)
+                sleep(parseDelay(self.delay))
         else:
             logger.warning('[%s] : [WARN] Detect is set to false, skipping...',
                        datetime.fromtimestamp(time.time()).strftime(log_format))
@@ -1523,9 +1963,15 @@ class EDEngine:
             processTrain.start()
             processDetect.start()
 
-            for p in proc:
-                p.join()
-                print('%s.exitcode = %s' % (p.name, p.exitcode))
+            try:
+                for p in proc:
+                    p.join()
+                    print('%s.exitcode = %s' % (p.name, p.exitcode))
+            finally:
+                for p in proc:
+                    if p.is_alive():
+                        p.terminate()  # detect processes deliver buffered reports on SIGTERM
+                        p.join(30)
 
         except Exception as inst:
             logger.error('[%s] : [ERROR] Exception %s with %s during process execution, halting',
@@ -1544,6 +1990,8 @@ class EDEngine:
             logger.error('[{}] : [ERROR] Exception while running Dask backend with {} and {}, halting'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
             sys.exit(1)
+        finally:
+            engine.closeReporting()
 
     def modelName(self, methodname, modelName):
         '''
@@ -1562,48 +2010,106 @@ class EDEngine:
     def compareModel(self):
         return "Compare models"
 
+    def closeReporting(self):
+        """
+        Deliver the anomaly reports still buffered, flush the connector sinks and pending plots and stop the
+        shared scoring workers, called when detection stops
+        """
+        if self.anomalyreporter is not None:
+            self.anomalyreporter.stop()
+        self.edeConnector.closeReporting()
+        plot_worker.drain()
+        if self.sharedscorer is not None:
+            self.sharedscorer.close()
+
     def reportAnomaly(self, body, dask=False):
         now = datetime.utcnow()
         itime = now.strftime("%Y-%m-%dT%H:%M:%S") + ".%03d" % (now.microsecond / 1000) + "Z"
         body["reporttimestamp"] = itime
+        reporter = self.__anomalyReporter(dask)
+        if reporter is not None:
+            reporter.submit(body)
+            return
         if not dask:
-            self.edeConnector.pushAnomalyES(anomalyIndex=self.anomalyIndex, doc_type='anomaly', body=body)
+            self.__reportES([body])
         else:
-            self.edeConnector.pushAnomalyKafka(body=body)
+            self.__reportKafka([body])
+        if self.grafana_url:
+            self.__reportGrafana([body])
+
+    def __anomalyReporter(self, dask):
+        if not self.reporting or self.anomalyreporter is not None:
+            return self.anomalyreporter
+        if not isinstance(self.reporting, dict):
+            self.reporting = {}
+        sinks = {'kafka': self.__reportKafka} if dask else {'elasticsearch': self.__reportES}
         if self.grafana_url:
+            sinks['grafana'] = self.__reportGrafana
+        try:
+            self.anomalyreporter = AnomalyReporter(sinks,
+                                                   queue_size=self.reporting.get('QueueSize', 1000),
+                                                   batch_size=self.reporting.get('BatchSize', 100),
+                                                   flush_interval=self.reporting.get('FlushInterval', 1.0),
+                                                   overflow=self.reporting.get('Overflow', 'block'),
+                                                   block_timeout=self.reporting.get('BlockTimeout', None),
+                                                   metrics_every=self.reporting.get('MetricsEvery', 60))
+        except Exception as inst:
+            logger.error('[{}] : [ERROR] Invalid reporting settings {} with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), self.reporting, type(inst), inst.args))
+            sys.exit(1)
+        atexit.register(self.anomalyreporter.stop)  # threaded and Dask backends, detect processes use closeReporting
+        return self.anomalyreporter
+
+    def __reportES(self, bodies):
+        self.edeConnector.pushAnomaliesES(anomalyIndex=self.anomalyIndex, doc_type='anomaly', bodies=bodies)
+
+    def __reportKafka(self, bodies):
+        for body in bodies:
+            self.edeConnector.pushAnomalyKafka(body=body)
+
+    def __grafanaDash(self):
+        if self.grafanadash is None:
             from edereporting.edegrafana import EDEGrafanaDash
-            logger.info('[%s] : [INFO] Adding Grafana annotation ...',
-                                            datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
+            self.grafanadash = EDEGrafanaDash(grafana_token=self.grafana_credentials, grafana_url=self.grafana_url)
+        return self.grafanadash
+
+    def __reportGrafana(self, bodies):
+        from edereporting.edegrafana import coalesce_annotations
+        logger.info('[%s] : [INFO] Adding Grafana annotation ...',
+                                        datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
+        ede_grafana = self.__grafanaDash()
+        # Check if dashboard exists with tag, cached by the client
+        dash_uid, dash_url, dash_id = ede_grafana.get_dash(tag=self.grafana_tag)
+        if dash_uid:
+            logger.info('[{}] : [INFO] Detected Grafana dashboard with tag {}, marking anomalies ... '.format(
+                datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.grafana_tag))
+        else:
+            # Generate Demo Dashboard
+            logger.info('[{}] : [INFO] Grafana Dashoard with tag {} not detected, creating ... '.format(
+                datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.grafana_tag))
+            ede_grafana.generate_dash(tag=self.grafana_tag, title="Serrano Grafana Dash Demo v1")
+            ede_grafana.create_dash()
+            # Getting dash data
+            dash_uid, dash_url, dash_id = ede_grafana.get_dash(tag=self.grafana_tag)
+            logger.info(
+                '[{}] : [INFO] Grafana Dashoard generated with tag {}, uid {}, marking anomalies ... '.format(
+                    datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.grafana_tag, dash_uid))
+        points = []
+        for body in bodies:
             det_method = body['method']
-            det_model = body['model']
+            det_model = body.get('model', self.load)
             anomaly_method = f"Anomalies detected by EDE with method {det_method}, model: {det_model}"
-            anomaly_tags = [f'{det_method}_anomaly']
-            ede_grafana = EDEGrafanaDash(grafana_token=self.grafana_credentials, grafana_url=self.grafana_url)
-            # Check if dashboard exists with tag
-            dash_uid, dash_url, dash_id = ede_grafana.get_dash(tag=self.grafana_tag)
-            if dash_uid:
-                logger.info('[{}] : [INFO] Detected Grafana dashboard with tag {}, marking anomalies ... '.format(
-                    datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.grafana_tag))
-            else:
-                # Generate Demo Dashboard
-                logger.info('[{}] : [INFO] Grafana Dashoard with tag {} not detected, creating ... '.format(
-                    datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.grafana_tag))
-                ede_grafana.generate_dash(tag=self.grafana_tag, title="Serrano Grafana Dash Demo v1")
-                ede_grafana.create_dash()
-                # Getting dash data
-                dash_uid, dash_url, dash_id = ede_grafana.get_dash(tag=self.grafana_tag)
-                logger.info(
-                    '[{}] : [INFO] Grafana Dashoard generated with tag {}, uid {}, marking anomalies ... '.format(
-                        datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.grafana_tag, dash_uid))
-            for anomaly in body['anomalies']: # todo if anomalies are sequential make one continouse annotation not separate ones
-                try:
-                    anomaly_type = anomaly['type']
-                    anomaly_tags = [f'{anomaly_type}_{det_method}_anomaly']
-                except:
-                    pass
-                ede_grafana.push_annotation(int(anomaly['utc'] * 1000), int(anomaly['utc'] * 1000),
-                                            anomaly_tags=anomaly_tags,
-                                            message=anomaly_method, dash_id=dash_id)
+            for anomaly in body['anomalies']:
+                if 'type' in anomaly:
+                    anomaly_tags = [f"{anomaly['type']}_{det_method}_anomaly"]
+                else:
+                    anomaly_tags = [f'{det_method}_anomaly']
+                points.append((int(anomaly['utc'] * 1000), anomaly_tags, anomaly_method))
+        gap = self.grafana_gap or 2 * (parseDelay(str(self.qinterval)) or 60)
+        regions = coalesce_annotations(points, gap=gap * 1000)
+        pushed = ede_grafana.push_annotations(regions, dash_id=dash_id)
+        logger.info('[{}] : [INFO] Pushed {} Grafana annotations for {} anomalies'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), pushed, len(points)))
 
     def getDFS(self, detect=False):
         # Query Strings
@@ -0,0 +1,245 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from edelogger import logger
+from util import log_format
+
+
+class ReportSink:
+    """
+    Bounded buffer of anomaly reports drained in batches by one background thread. A slow or failing sink
+    only delays its own buffer, reports are handed to the sink callable as a list once batch_size reports are
+    waiting or the oldest one waited flush_interval seconds. When the buffer is full new reports wait for room
+    (block), are discarded (drop_newest) or replace the oldest waiting report (drop_oldest).
+    """
+    policies = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, name,
+                 deliver,
+                 queue_size=1000,
+                 batch_size=100,
+                 flush_interval=1.0,
+                 overflow='block',
+                 block_timeout=None):
+        '''
+        :param name: -> sink name used in logs and metrics
+        :param deliver: -> callable receiving a list of report bodies, exceptions count the batch as failed
+        :param queue_size: -> maximum number of reports buffered
+        :param batch_size: -> maximum number of reports delivered at once
+        :param flush_interval: -> seconds a report may wait for a batch to fill
+        :param overflow: -> block, drop_newest or drop_oldest
+        :param block_timeout: -> seconds block waits for room before dropping the report, None waits forever
+        '''
+        if overflow not in self.policies:
+            raise ValueError('Unknown reporting overflow policy {}, expected one of {}'.format(overflow, self.policies))
+        self.name = name
+        self.deliver = deliver
+        self.queue_size = max(int(queue_size), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = float(flush_interval)
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.buffer = deque()
+        self.cond = threading.Condition()
+        self.stop_event = threading.Event()
+        self.busy = False
+        self.thread = None
+        self.__metrics = {'submitted': 0, 'delivered': 0, 'failed': 0, 'dropped': 0, 'batches': 0,
+                          'deliver_time': 0.0, 'max_delay': 0.0}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__run, name='ede-report-{}'.format(self.name), daemon=True)
+            self.thread.start()
+
+    def submit(self, body):
+        '''
+        :param body: -> anomaly report
+        :return: -> True if the report was buffered
+        '''
+        item = (time.time(), body)
+        with self.cond:
+            self.__metrics['submitted'] += 1
+            if len(self.buffer) >= self.queue_size:
+                if self.overflow == 'drop_newest':
+                    self.__metrics['dropped'] += 1
+                    return False
+                if self.overflow == 'drop_oldest':
+                    self.buffer.popleft()
+                    self.__metrics['dropped'] += 1
+                else:
+                    deadline = None if self.block_timeout is None else time.time() + self.block_timeout
+                    while len(self.buffer) >= self.queue_size and not self.stop_event.is_set():
+                        wait = None if deadline is None else deadline - time.time()
+                        if wait is not None and wait <= 0:
+                            self.__metrics['dropped'] += 1
+                            return False
+                        self.cond.wait(wait)
+            self.buffer.append(item)
+            self.cond.notify_all()
+        return True
+
+    def metrics(self):
+        '''
+        :return: -> copy of the sink metrics, times are cumulative seconds
+        '''
+        with self.cond:
+            metrics = dict(self.__metrics)
+            metrics['buffered'] = len(self.buffer)
+        return metrics
+
+    def flush(self, timeout=None):
+        '''
+        :param timeout: -> seconds to wait, None waits until the buffer is delivered
+        :return: -> True if the buffer was drained
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            self.cond.notify_all()
+            while self.buffer or self.busy:
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    return False
+                self.cond.wait(wait)
+        return True
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def __batch(self):
+        with self.cond:
+            while not self.buffer and not self.stop_event.is_set():
+                self.cond.wait()
+            while self.buffer and len(self.buffer) < self.batch_size and not self.stop_event.is_set():
+                wait = self.buffer[0][0] + self.flush_interval - time.time()
+                if wait <= 0:
+                    break
+                self.cond.wait(wait)
+            batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            self.busy = bool(batch)
+            self.cond.notify_all()  # wake producers blocked on a full buffer
+        return batch
+
+    def __run(self):
+        while True:
+            batch = self.__batch()
+            if not batch:
+                if self.stop_event.is_set():
+                    return
+                continue
+            start = time.time()
+            try:
+                self.deliver([body for _, body in batch])
+                failed = 0
+            except (Exception, SystemExit) as inst:  # a failing sink must not stop the reporting thread
+                logger.error('[{}] : [ERROR] Reporting sink {} failed to deliver {} reports with {} and {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), self.name, len(batch), type(inst),
+                    inst.args))
+                failed = len(batch)
+            end = time.time()
+            with self.cond:
+                self.__metrics['batches'] += 1
+                self.__metrics['delivered'] += len(batch) - failed
+                self.__metrics['failed'] += failed
+                self.__metrics['deliver_time'] += end - start
+                self.__metrics['max_delay'] = max(self.__metrics['max_delay'], end - batch[0][0])
+                self.busy = False
+                self.cond.notify_all()
+
+
+class AnomalyReporter:
+    """
+    Decouples anomaly reporting from detection. Each report is handed to every sink (Elasticsearch, Kafka,
+    Grafana) through its own bounded buffer and delivered in batches from a background thread, so the detect
+    loop only pays for appending to the buffers.
+    """
+    def __init__(self, sinks,
+                 queue_size=1000,
+                 batch_size=100,
+                 flush_interval=1.0,
+                 overflow='block',
+                 block_timeout=None,
+                 metrics_every=60):
+        '''
+        :param sinks: -> dictionary of sink name and callable receiving a list of report bodies
+        :param queue_size: -> maximum number of reports buffered per sink
+        :param batch_size: -> maximum number of reports delivered at once per sink
+        :param flush_interval: -> seconds a report may wait for a batch to fill
+        :param overflow: -> block, drop_newest or drop_oldest
+        :param block_timeout: -> seconds block waits for room before dropping the report, None waits forever
+        :param metrics_every: -> log delivery metrics every metrics_every submitted reports
+        '''
+        self.sinks = [ReportSink(name, deliver, queue_size=queue_size, batch_size=batch_size,
+                                 flush_interval=flush_interval, overflow=overflow, block_timeout=block_timeout)
+                      for name, deliver in sinks.items()]
+        self.metrics_every = metrics_every
+        self.submitted = 0
+        self.stopped = False
+        for sink in self.sinks:
+            sink.start()
+        logger.info('[{}] : [INFO] Started reporting to {} with queue size {}, batch size {}, flush interval {}s and {} overflow'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), [s.name for s in self.sinks], queue_size,
+            batch_size, flush_interval, overflow))
+
+    def submit(self, body):
+        '''
+        :param body: -> anomaly report, shared by all sinks and not to be modified after submit
+        '''
+        for sink in self.sinks:
+            if not sink.submit(body):
+                logger.warning('[{}] : [WARN] Reporting buffer of {} full, report dropped'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), sink.name))
+        self.submitted += 1
+        if self.metrics_every and self.submitted % self.metrics_every == 0:
+            logger.info('[{}] : [INFO] Reporting metrics {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), self.metrics()))
+
+    def metrics(self):
+        '''
+        :return: -> dictionary of sink name and sink metrics
+        '''
+        return {sink.name: sink.metrics() for sink in self.sinks}
+
+    def flush(self, timeout=None):
+        '''
+        :param timeout: -> seconds to wait for each sink
+        :return: -> True if all buffers were delivered
+        '''
+        return all([sink.flush(timeout) for sink in self.sinks])
+
+    def stop(self, timeout=10):
+        '''
+        Deliver the buffered reports and stop the sink threads
+
+        :param timeout: -> seconds to wait for each sink
+        '''
+        if self.stopped:
+            return
+        self.stopped = True
+        self.flush(timeout)
+        for sink in self.sinks:
+            sink.stop(timeout)
+        logger.info('[{}] : [INFO] Stopped reporting with metrics {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), self.metrics()))
@@ -0,0 +1,201 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import queue
+import threading
+import time
+from datetime import datetime
+from edelogger import logger
+from util import log_format
+
+
+class StreamingScorer:
+    """
+    Fixed rate detection pipeline. Fetch, transform and score run as separate stages connected by bounded
+    queues so the next window is fetched while the previous one is scored. Windows are released on a fixed
+    schedule (start + k * period) instead of sleeping after processing. A full queue blocks the upstream stage
+    (backpressure), ticks that could not be released on time are skipped and counted. Windows are scored in
+    micro batches of at most micro_batch rows.
+    """
+    def __init__(self, fetch,
+                 transform,
+                 score,
+                 report,
+                 period,
+                 micro_batch=None,
+                 queue_size=2,
+                 metrics_every=60):
+        '''
+        :param fetch: -> callable returning the next window as a dataframe, None or empty skips the tick
+        :param transform: -> callable applying filters, scaler and augmentations to a window
+        :param score: -> callable returning the anomaly dictionary of a micro batch
+        :param report: -> callable receiving the merged anomaly dictionary of a window
+        :param period: -> seconds between consecutive windows
+        :param micro_batch: -> maximum number of rows scored at once, None scores the whole window
+        :param queue_size: -> windows buffered between stages before the upstream stage blocks
+        :param metrics_every: -> log pipeline metrics every metrics_every windows
+        '''
+        self.fetch = fetch
+        self.transform = transform
+        self.score = score
+        self.report = report
+        self.period = float(period)
+        self.micro_batch = micro_batch
+        self.metrics_every = metrics_every
+        self.fetched = queue.Queue(maxsize=queue_size)
+        self.transformed = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.__metrics_lock = threading.Lock()
+        self.__metrics = {'windows': 0, 'scored': 0, 'rows': 0, 'skipped_ticks': 0, 'missed_deadlines': 0,
+                          'backpressure': 0, 'fetch_time': 0.0, 'transform_time': 0.0, 'score_time': 0.0, 'max_latency': 0.0}
+
+    def metrics(self):
+        '''
+        :return: -> copy of the pipeline metrics, times are cumulative seconds
+        '''
+        with self.__metrics_lock:
+            metrics = dict(self.__metrics)
+        metrics['fetch_queue'] = self.fetched.qsize()
+        metrics['transform_queue'] = self.transformed.qsize()
+        return metrics
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        '''
+        Start the fetch and transform stages and score windows on the calling thread until stop is called.
+        '''
+        logger.info('[{}] : [INFO] Starting streaming detection with period {}s, micro batch {}, queue size {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), self.period, self.micro_batch,
+            self.fetched.maxsize))
+        stages = [threading.Thread(target=self.__fetchStage, name='ede-stream-fetch', daemon=True),
+                  threading.Thread(target=self.__transformStage, name='ede-stream-transform', daemon=True)]
+        for stage in stages:
+            stage.start()
+        self.__scoreStage()
+
+    def __update(self, **kwargs):
+        with self.__metrics_lock:
+            for k, v in kwargs.items():
+                if k == 'max_latency':
+                    self.__metrics[k] = max(self.__metrics[k], v)
+                else:
+                    self.__metrics[k] += v
+
+    def __put(self, q, item):
+        blocked = False
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=self.period)
+                return True
+            except queue.Full:
+                if not blocked:
+                    logger.warning('[{}] : [WARN] Streaming stage backpressure, {} windows waiting'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), q.qsize()))
+                    self.__update(backpressure=1)
+                    blocked = True
+        return False
+
+    def __get(self, q):
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=self.period)
+            except queue.Empty:
+                continue
+        return None
+
+    def __fetchStage(self):
+        start = time.time()
+        tick = 0
+        while not self.stop_event.is_set():
+            release = start + tick * self.period
+            wait = release - time.time()
+            if wait > 0:
+                self.stop_event.wait(wait)
+            else:
+                late = int(-wait // self.period)
+                if late:
+                    logger.warning('[{}] : [WARN] Streaming detection fell behind, skipping {} ticks'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), late))
+                    self.__update(skipped_ticks=late)
+                    tick += late
+                    release = start + tick * self.period
+            tick += 1
+            fstart = time.time()
+            try:
+                window = self.fetch()
+            except (Exception, SystemExit) as inst:  # a failed window must not stop the stage thread
+                logger.error('[{}] : [ERROR] Streaming fetch failed with {} and {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+                continue
+            self.__update(fetch_time=time.time() - fstart)
+            if window is None or not window.shape[0]:
+                continue
+            self.__update(windows=1)
+            self.__put(self.fetched, (release, window))
+
+    def __transformStage(self):
+        while not self.stop_event.is_set():
+            item = self.__get(self.fetched)
+            if item is None:
+                continue
+            release, window = item
+            tstart = time.time()
+            try:
+                window = self.transform(window)
+            except (Exception, SystemExit) as inst:
+                logger.error('[{}] : [ERROR] Streaming transform failed with {} and {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+                continue
+            self.__update(transform_time=time.time() - tstart)
+            self.__put(self.transformed, (release, window))
+
+    def __scoreStage(self):
+        while not self.stop_event.is_set():
+            item = self.__get(self.transformed)
+            if item is None:
+                continue
+            release, window = item
+            sstart = time.time()
+            if self.micro_batch:
+                batches = [window.iloc[i:i + self.micro_batch] for i in range(0, window.shape[0], self.micro_batch)]
+            else:
+                batches = [window]
+            anomalies = {'anomalies': []}
+            try:
+                for batch in batches:
+                    banomalies = self.score(batch)
+                    anomalies['anomalies'].extend(banomalies.pop('anomalies', []))
+                    for k, v in banomalies.items():
+                        anomalies.setdefault(k, v)
+                self.report(anomalies)
+            except Exception as inst:
+                logger.error('[{}] : [ERROR] Streaming scoring failed with {} and {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+            latency = time.time() - release
+            missed = int(latency > self.period)
+            if missed:
+                logger.warning('[{}] : [WARN] Window released at {} scored after {:.3f}s, deadline {}s missed'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format),
+                    datetime.fromtimestamp(release).strftime(log_format), latency, self.period))
+            self.__update(scored=1, rows=window.shape[0], score_time=time.time() - sstart,
+                          missed_deadlines=missed, max_latency=latency)
+            metrics = self.metrics()
+            if self.metrics_every and metrics['scored'] % self.metrics_every == 0:
+                logger.info('[{}] : [INFO] Streaming detection metrics {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), metrics))
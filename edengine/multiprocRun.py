@@ -17,11 +17,34 @@ limitations under the License.
 """
 
 import multiprocessing
+import signal
+import sys
 import time
 from datetime import datetime
 from edelogger import logger
 
 
+def runReporting(method):
+    """
+    Process target for engine methods that report anomalies. SIGTERM exits the process like SIGINT and the
+    buffered reports are delivered before the process ends, atexit handlers do not run in child processes.
+
+    :param method: bound engine method
+    """
+    def handler(signal_received, frame):
+        logger.info('[{}] : [INFO] Signal {} received, stopping {}'.format(
+            datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), signal_received, method.__name__))
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+    try:
+        method()
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)  # a second signal must not interrupt delivery
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        method.__self__.closeReporting()
+
+
 def test(times, processID):
     logger.info('[{}] : [INFO] Starting Engine Point process {}'.format(
         datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), processID))
@@ -39,7 +62,7 @@ class EdePointProcess():
     def run(self):
         logger.info('[{}] : [INFO] Starting engine Point process  {}'.format(
             datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.processID))
-        p = multiprocessing.Process(target=self.engine.detectPointAnomalies)
+        p = multiprocessing.Process(target=runReporting, args=(self.engine.detectPointAnomalies,))
         return p
 
 
@@ -65,7 +88,7 @@ class EdeDetectProcess():
     def run(self):
         logger.info('[{}] : [INFO] Starting engine Detect process  {}'.format(
             datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), self.processID))
-        p = multiprocessing.Process(target=self.engine.detectAnomalies)
+        p = multiprocessing.Process(target=runReporting, args=(self.engine.detectAnomalies,))
         return p
 
 
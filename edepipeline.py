@@ -0,0 +1,145 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import pickle as pickle
+import warnings
+from datetime import datetime
+import time
+import numpy as np
+import pandas as pd
+from edelogger import logger
+from util import log_format
+
+
+class PreprocessPipeline:
+    """
+    Training time preprocessing compiled into a fixed column layout. Column filters, wildcard, low variance
+    and missing value drops are resolved to the list of kept columns, the one hot vocabulary, fitted scaler and
+    augmentation column groups are stored with it. At detection time a window is reindexed onto the layout and
+    transformed as a single numpy array.
+    """
+    def __init__(self, columns,
+                 categorical=None,
+                 encoder=None,
+                 fillna=False,
+                 scaler=None,
+                 operations=None,
+                 remove_filtered=True,
+                 index='time'):
+        '''
+        :param columns: -> numeric columns kept by filterData, in order
+        :param categorical: -> categorical columns encoded by encoder
+        :param encoder: -> fitted DictVectorizer used for one hot encoding
+        :param fillna: -> replace missing values with 0
+        :param scaler: -> fitted scaler
+        :param operations: -> augmentation operations as used by computeOnColumns
+        :param remove_filtered: -> drop the columns used by augmentations
+        :param index: -> name of the timestamp column
+        '''
+        self.columns = list(columns)
+        self.categorical = list(categorical or [])
+        self.encoder = encoder
+        self.fillna = fillna
+        self.scaler = scaler
+        self.index = index
+        self.features = self.columns + (list(encoder.get_feature_names()) if encoder is not None else [])
+        position = {c: i for i, c in enumerate(self.features)}
+        self.groups = []
+        processed = []
+        self.method = None
+        if operations:
+            for key, func in (('STD', np.nanstd), ('Mean', np.nanmean), ('Median', np.nanmedian)):
+                for group in operations.get(key) or []:
+                    for name, cols in group.items():
+                        idx = np.array([position[c] for c in cols if c in position], dtype=np.int64)
+                        self.groups.append((name, func, idx))
+                        processed.extend(cols)
+            self.method = operations.get('Method')
+        self.drop = set(processed) if operations and remove_filtered else set()
+        # Output layout over [features, groups], a group named like an existing column replaces it in place
+        layout = dict((c, i) for i, c in enumerate(self.features))
+        for j, (name, _, _) in enumerate(self.groups):
+            layout[name] = len(self.features) + j
+        self.layout = list(layout.keys())
+        self.take = np.array(list(layout.values()), dtype=np.int64)
+        self.output = [c for c in self.layout if c not in self.drop]
+
+    def transform(self, df):
+        '''
+        :param df: -> raw window, timestamps as index or index column
+        :return: -> transformed dataframe with the training column layout
+        '''
+        if self.index in df.columns:
+            df = df.set_index(self.index)
+        X = df.reindex(columns=self.columns).to_numpy(dtype=np.float64)
+        if self.encoder is not None:
+            cat = df.reindex(columns=self.categorical)
+            if self.fillna:
+                cat = cat.fillna(0)
+            X = np.hstack([X, self.encoder.transform(cat.to_dict('records')).toarray()])
+        if self.fillna:
+            X = np.where(np.isnan(X), 0.0, X)
+        if self.scaler is not None:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=UserWarning)  # fitted on a dataframe, same column layout
+                X = self.scaler.transform(X)
+        if self.groups:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)  # all missing rows yield nan as in pandas
+                G = np.column_stack([func(X[:, idx], axis=1, ddof=1) if func is np.nanstd else func(X[:, idx], axis=1)
+                                     for _, func, idx in self.groups])
+            X = np.hstack([X, G])
+        if self.method is None:
+            keep = np.array([c not in self.drop for c in self.layout], dtype=bool)
+            return pd.DataFrame(X[:, self.take[keep]], index=df.index, columns=self.output)
+        out = pd.DataFrame(X[:, self.take], index=df.index, columns=self.layout)
+        out = self.method(out)
+        return out.drop([c for c in self.drop if c in out.columns], axis=1)
+
+    def verify(self, raw, expected, rows=100):
+        '''
+        Check that the compiled pipeline reproduces the training preprocessing
+
+        :param raw: -> raw training data
+        :param expected: -> training data after filtering, scaling and augmentation
+        :param rows: -> number of rows compared
+        :return: -> True if columns and values match
+        '''
+        try:
+            result = self.transform(raw.head(rows * 10))
+            if list(result.columns) != list(expected.columns):
+                logger.warning('[{}] : [WARN] Compiled pipeline column layout differs from training data'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format)))
+                return False
+            common = expected.index[expected.index.isin(result.index)][:rows]
+            if not common.is_unique:
+                return False
+            return np.allclose(result.loc[common].to_numpy(dtype=np.float64),
+                               expected.loc[common].to_numpy(dtype=np.float64), equal_nan=True)
+        except Exception as inst:
+            logger.warning('[{}] : [WARN] Failed to verify compiled pipeline with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+            return False
+
+    def save(self, location):
+        '''
+        :param location: -> file location, stored next to the model
+        '''
+        with open(location, 'wb') as fpipe:
+            pickle.dump(self, fpipe)
+        logger.info('[{}] : [INFO] Saved compiled preprocessing pipeline with {} input and {} output columns at {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), len(self.features), len(self.output), location))
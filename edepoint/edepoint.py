@@ -22,6 +22,79 @@ from edelogger import logger
 from datetime import datetime
 from random import randint
 import time
+import numpy as np
+import pandas as pd
+
+
+class PointDetector:
+    """
+    Evaluates all point thresholds over a window in one vectorized comparison. Thresholds are matched to the
+    metric columns containing their type (as in detpoint), a column matched by several thresholds is compared
+    against each of them. Records are only built for the violations.
+    """
+    def __init__(self, thresholds):
+        '''
+        :param thresholds: -> list of threshold dictionaries as returned by pointThraesholds, metric type mapped
+        to threashold and bound, gd marks an upper bound (greater values are anomalies) and ld a lower bound
+        '''
+        self.rules = []
+        for th in thresholds:
+            for mtype, val in (th or {}).items():
+                self.rules.append((mtype, float(val['threashold']), val['bound'] != 'ld'))
+        self.__layouts = {}
+
+    def layout(self, columns):
+        '''
+        :param columns: -> metric columns of the window
+        :return: -> column positions, thresholds and upper bound flags of every (column, threshold) pair
+        '''
+        columns = tuple(columns)
+        layout = self.__layouts.get(columns)
+        if layout is None:
+            pairs = [(i, th, upper) for i, c in enumerate(columns) for mtype, th, upper in self.rules if mtype in c]
+            layout = (np.array([p[0] for p in pairs], dtype=np.int64),
+                      np.array([p[1] for p in pairs], dtype=np.float64),
+                      np.array([p[2] for p in pairs], dtype=bool))
+            self.__layouts[columns] = layout
+        return layout
+
+    def masks(self, df, index='key'):
+        '''
+        :param df: -> window with one numeric column per metric
+        :param index: -> name of the timestamp column, in ms
+        :return: -> hit mask and compared values of shape (rows, pairs), numeric window and layout
+        '''
+        if index in df.columns:
+            df = df.set_index(index)
+        metrics = df.select_dtypes(include='number')
+        cols, th, upper = self.layout(metrics.columns)
+        values = metrics.to_numpy(dtype=np.float64)[:, cols]
+        with np.errstate(invalid='ignore'):
+            hits = np.where(upper, values > th, values < th)  # nan never violates
+        return hits, values, metrics, (cols, th, upper)
+
+    def detect(self, df, index='key'):
+        '''
+        :param df: -> window with one numeric column per metric
+        :param index: -> name of the timestamp column, in ms
+        :return: -> list containing detected anomalies
+        '''
+        hits, values, metrics, (cols, th, upper) = self.masks(df, index=index)
+        rows, pairs = np.nonzero(hits)
+        names = metrics.columns
+        stamps = metrics.index.to_numpy()
+        anomalies = []
+        for r, p in zip(rows.tolist(), pairs.tolist()):
+            t = float(stamps[r])
+            anomalies.append({"type": "point", "metric": names[cols[p]], "utc": t / 1000,
+                              "time": datetime.fromtimestamp(t / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+                              "value": float(values[r, p]), "threashold": float(th[p]),
+                              "threashold_type": "upper" if upper[p] else "lower"})
+        if anomalies:
+            logger.info('[%s] : [INFO] Found %s point anomalies over %s metrics and %s thresholds',
+                        datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), len(anomalies),
+                        len(set(cols[pairs].tolist())), len(self.rules))
+        return anomalies
 
 
 class EdePoint:
@@ -169,29 +242,8 @@ class EdePoint:
         :param lt: -> less than is set to false then use greather then
         :return: -> list containing  detected anomalies
         '''
-        anomalies = []
-        for k, v in data.items():
-            if type in k:
-                for t, vl in v.items():
-                    times = datetime.fromtimestamp(t / 1000).strftime('%Y-%m-%d %H:%M:%S')
-                    if lt:
-                        if vl > threashold:
-                            print(("Found anomaly for %s at %s with value %f" % (k, times, vl)))
-                            logger.info('[%s] : [INFO] Found anomaly for %s at %s with value %f!',
-                                     datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), k, times, vl)
-                            anomalies.append(
-                                {"type": "point", "metric": k, "time": times, "value": vl, "threashold": threashold,
-                                     "threashold_type": "upper"})
-                    else:
-                        if vl < threashold:
-                            print(("Found anomaly for %s at %s with value %f" % (k, t, vl)))
-                            anomalies.append(
-                                    {"type": "point", "metric": k, "time": times, "value": vl, "threashold": threashold,
-                                     "threashold_type": "lower"})
-                            logger.info('[%s] : [INFO] Found anomaly for %s at %s with value %f!',
-                                        datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), k, times, vl)
-        return anomalies
-
+        detector = PointDetector([{type: {'threashold': threashold, 'bound': 'gd' if lt else 'ld'}}])
+        return detector.detect(pd.DataFrame(data))
 
 if __name__ == '__main__':
     testWatcher = EdePoint('85.120.206.27')
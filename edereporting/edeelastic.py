@@ -0,0 +1,237 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from edelogger import logger
+from util import log_format
+
+
+def _json_default(o):
+    if hasattr(o, 'item'):  # numpy scalars
+        return o.item()
+    if hasattr(o, 'tolist'):
+        return o.tolist()
+    return str(o)
+
+
+class ESBulkSink:
+    """
+    Indexes anomaly documents with the bulk API. Documents are buffered and sent once batch_size documents are
+    waiting or flush_interval seconds passed. If Elasticsearch can not be reached, or rejects documents because
+    it is overloaded, the documents are appended to a local spool file (one JSON document per line) and bulk
+    requests are retried every retry_interval seconds. The spool is replayed, oldest documents first, before new
+    documents are indexed.
+    """
+    retry_status = (429, 502, 503, 504)
+
+    def __init__(self, es, index,
+                 doc_type='anomaly',
+                 spool='anomalies.spool',
+                 batch_size=500,
+                 flush_interval=5.0,
+                 retry_interval=30.0):
+        '''
+        :param es: -> Elasticsearch client
+        :param index: -> anomaly index
+        :param doc_type: -> document type, None for typeless indices
+        :param spool: -> location of the spool file
+        :param batch_size: -> maximum number of documents per bulk request
+        :param flush_interval: -> seconds a document may wait for a batch to fill
+        :param retry_interval: -> seconds between bulk attempts while Elasticsearch is unreachable
+        '''
+        self.es = es
+        self.index = index
+        self.doc_type = doc_type
+        self.spool = spool
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = float(flush_interval)
+        self.retry_interval = float(retry_interval)
+        self.pending = []
+        self.first = None  # time the oldest pending document was added
+        self.retry_at = 0.0
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.__metrics = {'indexed': 0, 'rejected': 0, 'spooled': 0, 'replayed': 0, 'requests': 0,
+                          'failed_requests': 0, 'bulk_time': 0.0}
+        if self.spooled():
+            logger.warning('[{}] : [WARN] Found {} spooled anomaly documents at {}, replaying when ES is reachable'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), self.spooled(), self.spool))
+        self.thread = threading.Thread(target=self.__run, name='ede-es-bulk', daemon=True)
+        self.thread.start()
+
+    def push(self, bodies):
+        '''
+        :param bodies: -> list of anomaly documents
+        '''
+        with self.lock:
+            if not self.pending:
+                self.first = time.time()
+            self.pending.extend(bodies)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def metrics(self):
+        '''
+        :return: -> copy of the sink counters, docs_per_second is measured over bulk request time
+        '''
+        with self.lock:
+            metrics = dict(self.__metrics)
+            metrics['pending'] = len(self.pending)
+        metrics['spool'] = self.spooled()
+        metrics['docs_per_second'] = metrics['indexed'] / metrics['bulk_time'] if metrics['bulk_time'] else 0.0
+        return metrics
+
+    def spooled(self):
+        '''
+        :return: -> number of documents waiting in the spool file
+        '''
+        try:
+            with open(self.spool, 'rb') as fspool:
+                return sum(1 for _ in fspool)
+        except OSError:
+            return 0
+
+    def flush(self):
+        '''
+        Replay the spool and index the pending documents, documents that could not be indexed are spooled
+        '''
+        with self.lock:
+            docs, self.pending, self.first = self.pending, [], None
+            if time.time() < self.retry_at:
+                self.__spool(docs)
+                return
+            if not self.__replay():
+                self.__spool(docs)
+                return
+            for i in range(0, len(docs), self.batch_size):
+                retry = self.__bulk(docs[i:i + self.batch_size])
+                if retry is None:
+                    self.__spool(docs[i:])
+                    return
+                self.__spool(retry)
+
+    def close(self):
+        '''
+        Index or spool the pending documents, safe to call more than once
+        '''
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.flush()
+        logger.info('[{}] : [INFO] ES bulk reporting stopped with metrics {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), self.metrics()))
+
+    def __run(self):
+        while not self.stop_event.wait(min(self.flush_interval, self.retry_interval) / 2.0 or 0.5):
+            with self.lock:
+                due = self.first is not None and time.time() - self.first >= self.flush_interval
+                replay = not self.pending and time.time() >= self.retry_at and os.path.isfile(self.spool)
+            if due or replay:
+                try:
+                    self.flush()
+                except Exception as inst:
+                    logger.error('[{}] : [ERROR] ES bulk flush failed with {} and {}'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+
+    def __bulk(self, docs):
+        '''
+        :param docs: -> documents indexed in one bulk request
+        :return: -> documents to retry later, None if the request failed
+        '''
+        if not docs:
+            return []
+        action = {'index': {'_index': self.index}}
+        if self.doc_type is not None:
+            action['index']['_type'] = self.doc_type
+        action = json.dumps(action)
+        payload = '\n'.join('{}\n{}'.format(action, json.dumps(doc, default=_json_default)) for doc in docs) + '\n'
+        start = time.time()
+        self.__metrics['requests'] += 1
+        try:
+            res = self.es.bulk(body=payload)
+        except Exception as inst:
+            self.__metrics['failed_requests'] += 1
+            self.retry_at = time.time() + self.retry_interval
+            logger.error('[{}] : [ERROR] ES bulk request of {} anomaly documents failed with {} and {}, retrying in {}s'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), len(docs), type(inst), inst.args,
+                self.retry_interval))
+            return None
+        self.__metrics['bulk_time'] += time.time() - start
+        retry = []
+        rejected = 0
+        if res.get('errors'):
+            for doc, item in zip(docs, res.get('items', [])):
+                status = list(item.values())[0].get('status', 500)
+                if status in self.retry_status:
+                    retry.append(doc)
+                elif status >= 300:
+                    rejected += 1
+            if rejected:
+                logger.error('[{}] : [ERROR] ES rejected {} anomaly documents'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), rejected))
+            if retry:
+                self.retry_at = time.time() + self.retry_interval
+        self.__metrics['indexed'] += len(docs) - len(retry) - rejected
+        self.__metrics['rejected'] += rejected
+        return retry
+
+    def __spool(self, docs):
+        if not docs:
+            return
+        with open(self.spool, 'a') as fspool:
+            for doc in docs:
+                fspool.write(json.dumps(doc, default=_json_default) + '\n')
+            fspool.flush()
+            os.fsync(fspool.fileno())
+        self.__metrics['spooled'] += len(docs)
+        logger.warning('[{}] : [WARN] Spooled {} anomaly documents to {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), len(docs), self.spool))
+
+    def __replay(self):
+        '''
+        :return: -> True if the spool is empty after replay
+        '''
+        if not os.path.isfile(self.spool):
+            return True
+        with open(self.spool) as fspool:
+            docs = [json.loads(line) for line in fspool if line.strip()]
+        done = 0
+        retry = []
+        while done < len(docs):
+            retry = self.__bulk(docs[done:done + self.batch_size])
+            if retry is None or retry:
+                break
+            done += self.batch_size
+        remaining = docs[done:] if retry is None else retry + docs[done + self.batch_size:]
+        replayed = len(docs) - len(remaining)
+        if remaining:
+            tmp = '{}.tmp'.format(self.spool)
+            with open(tmp, 'w') as fspool:
+                for doc in remaining:
+                    fspool.write(json.dumps(doc) + '\n')
+            os.replace(tmp, self.spool)
+        else:
+            os.remove(self.spool)
+        self.__metrics['replayed'] += replayed
+        if replayed:
+            logger.info('[{}] : [INFO] Replayed {} spooled anomaly documents, {} left'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), replayed, len(remaining)))
+        return not remaining
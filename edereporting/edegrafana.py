@@ -25,8 +25,33 @@ from datetime import datetime
 import time
 
 
+def coalesce_annotations(points, gap):
+    """
+    Merges anomaly timestamps into region annotations. Points with the same tags and message are sorted and
+    merged while consecutive timestamps are at most gap apart.
+    :param points: List of (time in ms, tags, message) tuples
+    :param gap: Maximum distance in ms between two anomalies of the same region
+    :return: List of region dictionaries with time_from, time_to, tags, message and count, sorted by start
+    """
+    labels = {}
+    for ts, tags, message in points:
+        labels.setdefault((tuple(tags), message), []).append(int(ts))
+    regions = []
+    for (tags, message), times in labels.items():
+        times.sort()
+        region = None
+        for ts in times:
+            if region is not None and ts - region['time_to'] <= gap:
+                region['time_to'] = ts
+                region['count'] += 1
+                continue
+            region = {'time_from': ts, 'time_to': ts, 'tags': list(tags), 'message': message, 'count': 1}
+            regions.append(region)
+    return sorted(regions, key=lambda r: r['time_from'])
+
+
 class EDEGrafanaDash:
-    def __init__(self, grafana_token, grafana_url):
+    def __init__(self, grafana_token, grafana_url, cache_ttl=300):
         self.dash_dict = {
                   "dashboard": {
                     "id": None,
@@ -558,14 +583,25 @@ class EDEGrafanaDash:
         self.dash_uid = None
         self.dash_url = None
         self.dash_id = None
+        self.cache_ttl = cache_ttl
+        self.dash_cache = {}
 
-    def get_dash(self, tag, working_dash=False):
+    def get_dash(self, tag, working_dash=False, refresh=False):
         """
-        gets dash information based on tag.
+        gets dash information based on tag. Found dashboards are cached for cache_ttl seconds.
         :param tag: Tag to search for.
         :param working_dash: If dashboard is found and working_dash set to true it will be set as the current working dash
+        :param refresh: If set the cached dashboard is ignored and searched again
         :return: Dash UID, Dash URL, Dash ID
         """
+        cached = self.dash_cache.get(tag)
+        if cached is not None and not refresh and time.time() - cached[0] < self.cache_ttl:
+            dash_uid, dash_url, dash_id = cached[1]
+            if working_dash:
+                self.dash_uid = dash_uid
+                self.dash_url = dash_url
+                self.dash_id = dash_id
+            return dash_uid, dash_url, dash_id
         dashboards = self.grafana.search.search_dashboards(tag=tag)
 
         if not dashboards:
@@ -585,6 +621,7 @@ class EDEGrafanaDash:
             self.dash_uid = dash_uid
             self.dash_url = dash_url
             self.dash_id = dash_id
+        self.dash_cache[tag] = (time.time(), (dash_uid, dash_url, dash_id))
         return dash_uid, dash_url, dash_id
 
     def generate_dash(self,
@@ -633,6 +670,8 @@ class EDEGrafanaDash:
             self.dash_uid = dash_inf['uid']
             self.dash_url = dash_inf['url']
             self.dash_id = dash_inf['id']
+            for tag in self.dash_dict['dashboard']['tags']:
+                self.dash_cache[tag] = (time.time(), (self.dash_uid, self.dash_url, self.dash_id))
             logger.info(
               '[{}] : [INFO] Created new dashboard with id {}, url {} and tag {}'.format(
                 datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'),
@@ -702,6 +741,23 @@ class EDEGrafanaDash:
             return 0
         return annotation
 
+    def push_annotations(self, regions, dash_id=None):
+        """
+        Pushes region annotations created by coalesce_annotations, one request per region
+        :param regions: List of region dictionaries with time_from, time_to, tags, message and count
+        :param dash_id: ID of the dash where annotations are to be pushed
+        :return: Number of annotations pushed
+        """
+        pushed = 0
+        for region in regions:
+            message = region['message']
+            if region['count'] > 1:
+                message = '{} ({} anomalies)'.format(message, region['count'])
+            if self.push_annotation(region['time_from'], region['time_to'], anomaly_tags=region['tags'],
+                                    message=message, dash_id=dash_id):
+                pushed += 1
+        return pushed
+
     def get_annotations(self,
                         time_from=None,
                         time_to=None,
@@ -77,8 +77,12 @@ from pyod.models.ocsvm import OCSVM
 from pyod.models.lscp import LSCP
 
 from collections import defaultdict
+import threading
+import time
+from datetime import datetime
 
 import numpy as np
+import tensorflow as tf
 
 from sklearn.preprocessing import StandardScaler
 from sklearn.utils import check_array
@@ -90,6 +94,8 @@ from pyod.models.base_dl import _get_tensorflow_version
 
 from pyod.models.gaal_base import create_discriminator
 from pyod.models.gaal_base import create_generator
+from edelogger import logger
+from util import log_format
 
 
 # if tensorflow 2, import from tf directly
@@ -109,7 +115,178 @@ else:
     from tensorflow.keras import backend as K
 
 
-class SO_GAAL_EDE(BaseDetector):
+class KerasInference(object):
+    """Persistent inference session for the Keras based detectors.
+
+    The forward pass of the fitted network is traced once as a tf.function
+    with a fixed [batch_size, n_features] input signature and reused by every
+    decision_function call. Inputs are split into full batches and the last
+    batch is zero padded, so the function is never retraced. Reconstruction
+    models (AutoEncoder, VAE) can score with float16 or int8 quantized
+    weights through TensorFlow Lite. The session is built on first use, kept
+    for as long as the detector is loaded and never serialized.
+    """
+    _reconstruction = False
+    inference_batch_size = 256
+    inference_quantization = None
+    inference_threads = None
+
+    def set_inference(self, batch_size=256, quantization=None,
+                      num_threads=None):
+        """Configure the inference session, an existing session is dropped.
+
+        Parameters
+        ----------
+        batch_size : int, optional (default=256)
+            Number of rows scored per call of the traced function.
+
+        quantization : str, optional (default=None)
+            None, 'float16' or 'int8' weights. Only used by reconstruction
+            models.
+
+        num_threads : int, optional (default=None)
+            Number of TensorFlow Lite interpreter threads.
+
+        Returns
+        -------
+        self : object
+        """
+        if quantization not in (None, 'float16', 'int8'):
+            raise ValueError("quantization must be None, 'float16' or "
+                             "'int8', got %s" % quantization)
+        self.inference_batch_size = int(batch_size)
+        self.inference_quantization = quantization
+        self.inference_threads = num_threads
+        self.__dict__.pop('_inference', None)
+        return self
+
+    def __getstate__(self):
+        parent = getattr(super(KerasInference, self), '__getstate__', None)
+        state = dict(parent() if parent is not None else self.__dict__)
+        state.pop('_inference', None)
+        return state
+
+    def _network(self):
+        """Fitted Keras network scored by the session, GAAL detectors
+        override it with their discriminator."""
+        return self.model_
+
+    def _network_input(self, X):
+        return X
+
+    def _lite_function(self, forward, spec):
+        # tensorflow 2.6 takes only the functions, trackable_obj was added in 2.7
+        converter = tf.lite.TFLiteConverter.from_concrete_functions(
+            [forward.get_concrete_function(spec)])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if self.inference_quantization == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        interpreter = tf.lite.Interpreter(model_content=converter.convert(),
+                                          num_threads=self.inference_threads)
+        interpreter.allocate_tensors()
+        source = interpreter.get_input_details()[0]['index']
+        target = interpreter.get_output_details()[0]['index']
+
+        def run(x):
+            interpreter.set_tensor(source, x)
+            interpreter.invoke()
+            return interpreter.get_tensor(target)
+        return run
+
+    def _inference_session(self, n_features):
+        session = self.__dict__.get('_inference')
+        if session is not None and session['n_features'] == n_features:
+            return session
+        start = time.time()
+        network = self._network()
+        batch = self.inference_batch_size
+        quantization = self.inference_quantization if self._reconstruction \
+            else None
+        if not hasattr(tf, 'function'):  # TensorFlow 1, no tracing
+            run = lambda x: network.predict(x, batch_size=batch)
+        else:
+            spec = tf.TensorSpec([batch, n_features], tf.float32)
+
+            def forward(x):
+                out = network(x, training=False)
+                return out[0] if isinstance(out, (list, tuple)) else out
+            if quantization:
+                run = self._lite_function(tf.function(forward), spec)
+            else:
+                traced = tf.function(forward, input_signature=[spec])
+                run = lambda x: traced(tf.constant(x)).numpy()
+        run(np.zeros((batch, n_features), dtype=np.float32))  # trace and warm up
+        session = {'n_features': n_features, 'batch': batch, 'run': run,
+                   'lock': threading.Lock(),
+                   'build_ms': (time.time() - start) * 1000.0}
+        self._inference = session
+        logger.info('[{}] : [INFO] Inference session for {} built in {:.1f} ms with batch size {} and {} weights'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), type(self).__name__, session['build_ms'],
+            batch, quantization or 'float32'))
+        return session
+
+    def _inference_predict(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        session = self._inference_session(X.shape[1])
+        batch = session['batch']
+        parts = []
+        for start in range(0, X.shape[0], batch):
+            chunk = X[start:start + batch]
+            rows = chunk.shape[0]
+            if rows < batch:
+                chunk = np.vstack([chunk, np.zeros((batch - rows, X.shape[1]),
+                                                   dtype=np.float32)])
+            with session['lock']:
+                parts.append(np.asarray(session['run'](chunk))[:rows])
+        if not parts:
+            return np.zeros((0, X.shape[1]), dtype=np.float32)
+        return np.concatenate(parts)
+
+    def inference_benchmark(self, X, repeats=10):
+        """Compare the latency of Keras predict and the inference session.
+
+        Parameters
+        ----------
+        X : numpy array of shape (n_samples, n_features)
+            Window used for the benchmark.
+
+        repeats : int, optional (default=10)
+            Number of timed calls of each path.
+
+        Returns
+        -------
+        benchmark : dict
+            Milliseconds per call of both paths, session build time and the
+            largest absolute difference between their outputs.
+        """
+        X_in = np.asarray(self._network_input(check_array(X)),
+                          dtype=np.float32)
+        session = self._inference_session(X_in.shape[1])
+        timings = {}
+        outputs = {}
+        for name, fn in (('predict', self._network().predict),
+                         ('session', self._inference_predict)):
+            outputs[name] = np.asarray(fn(X_in))  # first call not timed
+            start = time.time()
+            for _ in range(repeats):
+                fn(X_in)
+            timings[name] = (time.time() - start) * 1000.0 / repeats
+        benchmark = {'detector': type(self).__name__, 'rows': X_in.shape[0],
+                     'batch_size': session['batch'],
+                     'quantization': self.inference_quantization
+                     if self._reconstruction else None,
+                     'build_ms': session['build_ms'],
+                     'predict_ms': timings['predict'],
+                     'session_ms': timings['session'],
+                     'max_abs_error': float(np.max(np.abs(
+                         outputs['predict'].reshape(outputs['session'].shape)
+                         - outputs['session']))) if X_in.shape[0] else 0.0}
+        logger.info('[{}] : [INFO] Inference benchmark {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), benchmark))
+        return benchmark
+
+
+class SO_GAAL_EDE(KerasInference, BaseDetector):
     """Single-Objective Generative Adversarial Active Learning.
 
     SO-GAAL directly generates informative potential outliers to assist the
@@ -281,11 +458,14 @@ class SO_GAAL_EDE(BaseDetector):
         """
         check_is_fitted(self, ['discriminator'])
         X = check_array(X)
-        pred_scores = self.discriminator.predict(X).ravel()
+        pred_scores = self._inference_predict(X).ravel()
         return pred_scores
 
+    def _network(self):
+        return self.discriminator
+
 
-class MO_GAAL_EDE(BaseDetector):
+class MO_GAAL_EDE(KerasInference, BaseDetector):
     """Multi-Objective Generative Adversarial Active Learning.
 
     MO_GAAL directly generates informative potential outliers to assist the
@@ -519,12 +699,15 @@ class MO_GAAL_EDE(BaseDetector):
         """
         check_is_fitted(self, ['discriminator'])
         X = check_array(X)
-        pred_scores = self.discriminator.predict(X).ravel()
+        pred_scores = self._inference_predict(X).ravel()
         return pred_scores
 
+    def _network(self):
+        return self.discriminator
+
 
 
-class VAE_EDE(BaseDetector):
+class VAE_EDE(KerasInference, BaseDetector):
     """ Variational auto encoder
     Encoder maps X onto a latent space Z
     Decoder samples Z from N(0,1)
@@ -652,6 +835,8 @@ class VAE_EDE(BaseDetector):
         ``threshold_`` on ``decision_scores_``.
     """
 
+    _reconstruction = True
+
     def __init__(self, encoder_neurons=None, decoder_neurons=None,
                  latent_dim=2, hidden_activation='relu',
                  output_activation='sigmoid', loss=mse, optimizer='adam',
@@ -854,18 +1039,18 @@ class VAE_EDE(BaseDetector):
             The anomaly score of the input samples.
         """
         check_is_fitted(self, ['model_', 'history_'])
-        X = check_array(X)
-
-        if self.preprocessing:
-            X_norm = self.scaler_.transform(X)
-        else:
-            X_norm = np.copy(X)
+        X_norm = self._network_input(check_array(X))
 
         # Predict on X and return the reconstruction errors
-        pred_scores = self.model_.predict(X_norm)
+        pred_scores = self._inference_predict(X_norm)
         return pairwise_distances_no_broadcast(X_norm, pred_scores)
 
-class AutoEncoder_EDE(BaseDetector):
+    def _network_input(self, X):
+        if self.preprocessing:
+            return self.scaler_.transform(X)
+        return np.copy(X)
+
+class AutoEncoder_EDE(KerasInference, BaseDetector):
     """Auto Encoder (AE) is a type of neural networks for learning useful data
     representations unsupervisedly. Similar to PCA, AE could be used to
     detect outlying objects in the data by calculating the reconstruction
@@ -967,6 +1152,8 @@ class AutoEncoder_EDE(BaseDetector):
         ``threshold_`` on ``decision_scores_``.
     """
 
+    _reconstruction = True
+
     def __init__(self, hidden_neurons=None,
                  hidden_activation='relu', output_activation='sigmoid',
                  loss=mean_squared_error, optimizer='adam',
@@ -1117,17 +1304,17 @@ class AutoEncoder_EDE(BaseDetector):
             The anomaly score of the input samples.
         """
         check_is_fitted(self, ['model_', 'history_'])
-        X = check_array(X)
-
-        if self.preprocessing:
-            X_norm = self.scaler_.transform(X)
-        else:
-            X_norm = np.copy(X)
+        X_norm = self._network_input(check_array(X))
 
         # Predict on X and return the reconstruction errors
-        pred_scores = self.model_.predict(X_norm)
+        pred_scores = self._inference_predict(X_norm)
         return pairwise_distances_no_broadcast(X_norm, pred_scores)
 
+    def _network_input(self, X):
+        if self.preprocessing:
+            return self.scaler_.transform(X)
+        return np.copy(X)
+
 
 def ede_abod(contamination,
              n_neighbors=5,
@@ -1171,8 +1358,10 @@ def ede_hbos(contamination,
     return clf
 
 
-def ede_ae():
+def ede_ae(inference_batch_size=256,
+           quantization=None):
     clf = AutoEncoder_EDE()
+    clf.set_inference(batch_size=inference_batch_size, quantization=quantization)
     return clf
 
 
@@ -1192,7 +1381,9 @@ def ede_vae(contamination,
                   validation_size=0.1,
                   preprocessing=True,
                   verbose=1,
-                  random_state=42):
+                  random_state=42,
+                  inference_batch_size=256,
+                  quantization=None):
     clf = VAE_EDE(contamination=contamination,
                   encoder_neurons=encoder_neurons,
                   decoder_neurons=decoder_neurons,
@@ -1211,6 +1402,7 @@ def ede_vae(contamination,
                   verbose=verbose,
                   random_state=random_state
                   )
+    clf.set_inference(batch_size=inference_batch_size, quantization=quantization)
     return clf
 
 
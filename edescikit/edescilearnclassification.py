@@ -19,6 +19,8 @@ limitations under the License.
 import os
 import importlib
 from edelogger import logger
+from edescikit.modelregistry import model_registry
+from edescikit.edeshap import analysis_setting, sample_positions, batched_shap_values, plot_worker
 from datetime import datetime
 import time
 import sys
@@ -36,24 +38,11 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import GridSearchCV, RandomizedSearchCV
 from sklearn.cluster import DBSCAN
 from sklearn.metrics import make_scorer, SCORERS, get_scorer, classification_report, confusion_matrix, accuracy_score
-from tensorflow.keras.wrappers.scikit_learn import KerasClassifier
-from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
-from imblearn.metrics import classification_report_imbalanced
-from yellowbrick.model_selection import LearningCurve, ValidationCurve, RFECV
-from yellowbrick.classifier import PrecisionRecallCurve, ROCAUC
-from yellowbrick.contrib.classifier import DecisionViz
-from yellowbrick.style import set_palette
-import matplotlib.pyplot as plt
-import seaborn as sns
 import yaml
 import joblib
 import pickle as pickle
-from util import str2Bool, log_format
-import glob
-from util import ut2hum
-import shap
-from ededeap import EvolutionaryAlgorithmSearchCV
-from edetensorflow.edetensor import dnn_aspide
+from util import str2Bool, log_format, LazyModule
+from util import anomaly_records
 import itertools
 
 pd.options.mode.chained_assignment = None
@@ -61,8 +50,24 @@ import warnings
 
 warnings.filterwarnings("ignore")
 
-# set color palette yellowbrick
-set_palette('sns_deep')
+# TensorFlow, yellowbrick, seaborn, imbalanced-learn, SHAP and DEAP are only loaded by the methods using them
+keras_wrappers = LazyModule('tensorflow.keras.wrappers.scikit_learn')
+keras_callbacks = LazyModule('tensorflow.keras.callbacks')
+edetensor = LazyModule('edetensorflow.edetensor')
+imblearn_metrics = LazyModule('imblearn.metrics')
+
+
+def _yellowbrick_palette(module):
+    importlib.import_module('yellowbrick.style').set_palette('sns_deep')  # set color palette yellowbrick
+
+
+yb_model_selection = LazyModule('yellowbrick.model_selection', on_load=_yellowbrick_palette)
+yb_classifier = LazyModule('yellowbrick.classifier', on_load=_yellowbrick_palette)
+yb_contrib = LazyModule('yellowbrick.contrib.classifier', on_load=_yellowbrick_palette)
+plt = LazyModule('matplotlib.pyplot')
+sns = LazyModule('seaborn')
+shap = LazyModule('shap')
+ededeap = LazyModule('ededeap')
 
 
 class SciClassification:
@@ -85,7 +90,8 @@ class SciClassification:
                  pred_analysis=False,
                  trainscore=False,
                  scorers=None,
-                 returnestimators=False):
+                 returnestimators=False,
+                 scorer=None):
         self.modelDir = modelDir
         self.dataDir = dataDir
         self.checkpoint = checkpoint
@@ -106,6 +112,7 @@ class SciClassification:
         self.trainscore = trainscore
         self.scorers = scorers
         self.returnestimators = returnestimators
+        self.scorer = scorer
         self.skscorer = 'sklearn.metrics'
         self.sksplitgen = 'sklearn.model_selection'
 
@@ -211,16 +218,8 @@ class SciClassification:
                                                                        str(data.shape[1])))
             print("dpredict type is %s" % (type(dpredict)))
             if type(dpredict) is not int:
-                data['AType'] = dpredict
-                for index, row in data.iterrows():
-                    anomalies = {}
-                    if row['AType'] != 0:
-                        print(index)
-                        print(data.get_value(index, 'AType'))
-                        anomalies['utc'] = int(index)
-                        anomalies['hutc'] = ut2hum(int(index))
-                        anomalies['anomaly_type'] = data.get_value(index, 'AType')
-                        anomalieslist.append(anomalies)
+                anomalieslist = anomaly_records(data.index, np.flatnonzero(dpredict != 0), labels=dpredict,
+                                                label_key='anomaly_type')
         anomaliesDict = {}
         anomaliesDict['anomalies'] = anomalieslist
         logger.info('[%s] : [INFO] Detected anomalies with model %s using method %s are -> %s',
@@ -247,6 +246,10 @@ class SciClassification:
                     for k, v in smodel.get_params().items():
                         logger.info('[{}] : [INFO] Predict model parameter {} set to {}'.format(
                             datetime.fromtimestamp(time.time()).strftime(log_format), k, v))
+                    if self.scorer is not None:
+                        dpredict = self.scorer.predict(os.path.join(self.modelDir, "%s_%s.pkl" % (method, model)),
+                                                       smodel, data)
+                    else:
                         dpredict = smodel.predict(data)
                 except Exception as inst:
                     logger.error('[{}] : [ERROR] Failed to load predictive model with {} and {}'.format(
@@ -263,39 +266,28 @@ class SciClassification:
             else:
                 nl = normal_label
             anomalyArray = np.argwhere(dpredict != nl)  # Pandas bug where np.argwhere not working on dataframes
+            anomaliesList = anomaly_records(data.index, anomalyArray, labels=dpredict)
             if self.pred_analysis and anomalyArray.shape[0]:
-                try:
-                    plot = self.pred_analysis['Plot']
-                except Exception:
-                    plot = False
-                df_anomaly_data = data.copy(deep=True)  # copy for second filter using pandas
-                df_anomaly_data['target'] = dpredict
-                anomaliesDict['complete_shap_analysis'], explainer, shap_values = self.__shap_analysis(smodel,
-                                                                                                       df_anomaly_data,
-                                                                                                       normal_value=nl,
-                                                                                                       plot=plot)
-            count = 0 # todo merge filtering of dpred detection; related to np.argwhere bug for pandas and __shap_analysis data refiltering
-            for an in anomalyArray:
-                anomalies = {}
-                if pd._libs.tslibs.timestamps.Timestamp == type(data.iloc[an[0]].name):
-                    anomalies['utc'] = data.iloc[an[0]].name.timestamp()
-                    anomalies['hutc'] = str(data.iloc[an[0]].name)
-                else:
-                    anomalies['utc'] = int(data.iloc[an[0]].name)
-                    anomalies['hutc'] = ut2hum(int(data.iloc[an[0]].name))
-                anomalies['type'] = str(dpredict[an[0]])
-                if explainer:
+                plot = analysis_setting(self.pred_analysis, 'Plot', False)
+                explained = sample_positions(anomalyArray,
+                                             max_explained=analysis_setting(self.pred_analysis, 'MaxExplained', 100))
+                df_explained = data.iloc[explained]
+                anomaliesDict['complete_shap_analysis'], explainer, shap_values = self.__shap_analysis(
+                    smodel, df_explained, plot=plot,
+                    batch_size=analysis_setting(self.pred_analysis, 'BatchSize', 256))
+            if explainer:
+                slot = {pos: i for i, pos in enumerate(anomalyArray.ravel())}
+                for count, pos in enumerate(explained):
+                    anomalies = anomaliesList[slot[pos]]
                     anomalies['analysis'] = self.__shap_values_processing(explainer=explainer,
                                                                           shap_values=shap_values,
-                                                                          label=dpredict[an[0]],
+                                                                          label=dpredict[pos],
                                                                           feature_names=data.columns,
                                                                           instance=count)
                     if plot and count < 10: # todo make number of force plots user definable
-                        self.__shap_force_plot(explainer=explainer, shap_values=shap_values, data=data,
-                                               label=dpredict[an[0]], instance=count, utc=anomalies['utc'])
-
-                anomaliesList.append(anomalies)
-                count += 1
+                        plot_worker.submit(self.__shap_force_plot, explainer=explainer, shap_values=shap_values,
+                                           data=df_explained, label=dpredict[pos], instance=count,
+                                           utc=anomalies['utc'])
         anomaliesDict['anomalies'] = anomaliesList
 
         logger.info('[{}] : [INFO] Detected {} anomalies with model {} using method {} '.format(
@@ -306,38 +298,36 @@ class SciClassification:
     def __shap_analysis(self,
                         model,
                         data,
-                        normal_value,
-                        plot):
+                        plot,
+                        batch_size=256):
         # todo use non tokenized labels for data
         """
         Shap analysis of incoming data
 
         :param model: Predictive model to be analyzed
-        :param data: data for analysis
-        :param normal_value: denotes the normal (majority) class label
-        :return: feature importance
+        :param data: anomalous instances to be analyzed
+        :param plot: render summary plots in the background
+        :param batch_size: number of instances explained at once
+        :return: feature importance, explainer, shap values
         """
-        logger.info('[%s] : [INFO] Executing classification prediction analysis ...',
-                    datetime.fromtimestamp(time.time()).strftime(log_format))
-
-        data_filtered = data.loc[data['target'] != normal_value]
-        data_filtered.drop(['target'], inplace=True, axis=1)
+        logger.info('[%s] : [INFO] Executing classification prediction analysis on %s instances ...',
+                    datetime.fromtimestamp(time.time()).strftime(log_format), data.shape[0])
 
-        explainer = shap.TreeExplainer(model)
-        shap_values = explainer.shap_values(data_filtered)
+        explainer = model_registry.explainer(model, shap.TreeExplainer)
+        shap_values = batched_shap_values(explainer.shap_values, data, batch_size=batch_size)
 
         try:
             labels = model.classes_
         except Exception as inst:
             logger.error('[%s] : [ERROR] Prediction analysis failed with {} and {}',
                         datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args)
-            return 0
+            return 0, 0, 0
 
         feature_imp = self.__shap_feature_importance(shap_values=shap_values,
                                                      data=data,
                                                      label=labels)
         if plot:
-            self.__shap_summary_plot(shap_values, data_filtered, labels)
+            plot_worker.submit(self.__shap_summary_plot, shap_values, data, labels)
         return feature_imp, explainer, shap_values
 
     def __shap_values_processing(self,
@@ -908,7 +898,7 @@ class SciClassification:
                 n_inputs, n_outputs = X.shape[1], len(np.unique(y))
                 settings.update({"n_input_shape": n_inputs, "n_output_shape": n_outputs})
                 try:
-                    clf = dnn_aspide(**settings)
+                    clf = edetensor.dnn_aspide(**settings)
                     print(clf.summary())  # todo make toggle
                 except Exception as inst:
                     logger.error('[{}] : [INFO] Failed to instanciate {} with {} and {}'.format(
@@ -920,7 +910,7 @@ class SciClassification:
                 #### Start better integrate into ede workflow #### Todo better integration
 
                 def wrapper_dnn_aspide(settings=settings):
-                    return dnn_aspide(**settings)
+                    return edetensor.dnn_aspide(**settings)
 
                 sss = StratifiedShuffleSplit(n_splits=5, test_size=0.25, random_state=42)  # todo make user definable
                 y = pd.Series(y)
@@ -937,10 +927,10 @@ class SciClassification:
                         y_oh_train = pd.get_dummies(ytrain, prefix='target')
                         y_oh_test = pd.get_dummies(ytest, prefix='target')
 
-                        early_stopping = EarlyStopping(monitor="loss", patience=3)  # early stop patience
-                        reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.2,
+                        early_stopping = keras_callbacks.EarlyStopping(monitor="loss", patience=3)  # early stop patience
+                        reduce_lr = keras_callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.2,
                                                       patience=5, min_lr=0.00001)
-                        model = KerasClassifier(build_fn=wrapper_dnn_aspide, verbose=0, callbacks=[early_stopping, reduce_lr])
+                        model = keras_wrappers.KerasClassifier(build_fn=wrapper_dnn_aspide, verbose=0, callbacks=[early_stopping, reduce_lr])
                         history = model.fit(np.asarray(Xtrain), np.asarray(y_oh_train),
                                             batch_size=batch_size,
                                             epochs=999,
@@ -958,8 +948,8 @@ class SciClassification:
                         df_classification_report.to_csv(os.path.join(self.modelDir, classification_rep_name))
                         logger.info('[{}] : [INFO] Computing imbalanced classification report for fold {}'.format(
                             datetime.fromtimestamp(time.time()).strftime(log_format), fold))
-                        print(classification_report_imbalanced(ytest, y_pred, digits=4, target_names=y_definitions))
-                        imb_cf_report = classification_report_imbalanced(ytest, y_pred, output_dict=True, digits=4,
+                        print(imblearn_metrics.classification_report_imbalanced(ytest, y_pred, digits=4, target_names=y_definitions))
+                        imb_cf_report = imblearn_metrics.classification_report_imbalanced(ytest, y_pred, output_dict=True, digits=4,
                                                                          target_names=y_definitions)
                         df_imb_classification_report = pd.DataFrame(imb_cf_report).transpose()
                         imb_df_report_name = f"DNN_Imbalanced_classification_Report_{self.export}_Fold_{fold}.csv"
@@ -1301,7 +1291,7 @@ class SciClassification:
         # Split data into training and testing  # todo add customizability
         XTrain, XTest, yTrain, yTest = train_test_split(X_tranformed, y, test_size=.33, shuffle=True, random_state=42)
 
-        viz = DecisionViz(
+        viz = yb_contrib.DecisionViz(
             model,
             title=f"Decision Boundary {self.export} {model_name}",
             features=['PC1', 'PC2'], classes=definitions
@@ -1344,7 +1334,7 @@ class SciClassification:
                 datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
             sys.exit(1)
 
-        viz = RFECV(model, cv=cv, scoring=scorer, step=step)
+        viz = yb_model_selection.RFECV(model, cv=cv, scoring=scorer, step=step)
         viz.fit(X, y)
         rfe_report = {}
         # cv_scores = viz.cv_scores_  # cv scores
@@ -1400,7 +1390,7 @@ class SciClassification:
         XTrain, XTest, yTrain, yTest = train_test_split(X, y, test_size=.33, shuffle=True, random_state=42)
 
         # Compute ROC AUC
-        viz = ROCAUC(model, classes=definitions)
+        viz = yb_classifier.ROCAUC(model, classes=definitions)
         viz.fit(XTrain, yTrain)
         viz.score(XTest, yTest)
         ROCAUC_curve_fig = f"ROCAUC_Curve_{self.export}_{model_name}.png"
@@ -1429,7 +1419,7 @@ class SciClassification:
         XTrain, XTest, yTrain, yTest = train_test_split(X, y, test_size=.33, shuffle=True, random_state=42)
 
         # Compute PRC
-        viz = PrecisionRecallCurve(model, per_class=True, cmap="Set1", classes=definitions, iso_f1_curves=True,
+        viz = yb_classifier.PrecisionRecallCurve(model, per_class=True, cmap="Set1", classes=definitions, iso_f1_curves=True,
                                    micro=False)
         viz.fit(XTrain, yTrain)
         viz.score(XTest, yTest)
@@ -1466,7 +1456,7 @@ class SciClassification:
             logger.error('[{}] : [ERROR] Validation Curve parameter error with {} and {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
             sys.exit(1)
-        viz = ValidationCurve(model, param_name=param_name, param_range=param_range,
+        viz = yb_model_selection.ValidationCurve(model, param_name=param_name, param_range=param_range,
                               logx=True, cv=cv, scoring=scorer, n_jobs=n_jobs)
         viz.fit(X, y)
         validation_curve_fig = f"Validation_Curve_{self.export}_{model_name}.png"
@@ -1503,7 +1493,7 @@ class SciClassification:
             logger.error('[{}] : [ERROR] Learning Curve parameter error with {} and {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
             sys.exit(1)
-        viz = LearningCurve(model, cv=cv, scoring=scorer, train_sizes=sizes, n_jobs=n_jobs)
+        viz = yb_model_selection.LearningCurve(model, cv=cv, scoring=scorer, train_sizes=sizes, n_jobs=n_jobs)
         viz.fit(X, y)
         learning_curve_fig = f"Learning_Curve_{self.export}_{model_name}.png"
         viz.show(outpath=os.path.join(self.modelDir, learning_curve_fig))
@@ -1588,8 +1578,8 @@ class SciClassification:
                 # Full imbalanced classification report
                 logger.info('[{}] : [INFO] Computing imbalanced classification report for fold {}'.format(
                     datetime.fromtimestamp(time.time()).strftime(log_format), fold))
-                print(classification_report_imbalanced(ytest, ypred_test, digits=4, target_names=definitions))
-                imb_cf_report = classification_report_imbalanced(ytest, ypred_test, output_dict=True, digits=4,
+                print(imblearn_metrics.classification_report_imbalanced(ytest, ypred_test, digits=4, target_names=definitions))
+                imb_cf_report = imblearn_metrics.classification_report_imbalanced(ytest, ypred_test, output_dict=True, digits=4,
                                                                  target_names=definitions)
                 df_imb_classification_report = pd.DataFrame(imb_cf_report).transpose()
                 imb_df_report_name = f"Imbalanced_classification_Report_{model_name}_Fold_{fold}.csv"
@@ -1758,11 +1748,11 @@ class SciClassification:
                     datetime.fromtimestamp(time.time()).strftime(log_format), k, v))
             if user_m:
                 ev_settings.update({"estimator": classification_method})
-                search = EvolutionaryAlgorithmSearchCV(**ev_settings)
+                search = ededeap.EvolutionaryAlgorithmSearchCV(**ev_settings)
                 # EvolutionaryAlgorithmSearchCV()
             else:
                 ev_settings.update({"estimator": clf})
-                search = EvolutionaryAlgorithmSearchCV(**ev_settings)
+                search = ededeap.EvolutionaryAlgorithmSearchCV(**ev_settings)
         else:
             logger.error('[{}] : [ERROR] Invalid HPO method specified: {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), hpomethod))
@@ -2291,13 +2281,12 @@ class SciClassification:
         :param model: -> model name
         :return: -> instance of serialized object
         '''
-        lmodel = glob.glob(os.path.join(self.modelDir, ("%s_%s.pkl" % (method, model))))
-        if not lmodel:
+        smodel = model_registry.load(os.path.join(self.modelDir, ("%s_%s.pkl" % (method, model))))
+        if smodel is None:
             logger.warning('[%s] : [WARN] No %s model with the name %s found',
                            datetime.fromtimestamp(time.time()).strftime(log_format), method, model)
             return 0
         else:
-            smodel = pickle.load(open(lmodel[0], "rb"))
             logger.info('[%s] : [INFO] Succesfully loaded %s model with the name %s',
                         datetime.fromtimestamp(time.time()).strftime(log_format), method, model)
             return smodel
@@ -2335,7 +2324,9 @@ class SciClassification:
         '''
         fpath = "%s_%s.pkl" % (method, mname)
         fname = os.path.join(self.modelDir, fpath)
-        pickle.dump(model, open(fname, "wb"))
+        with open(fname, "wb") as fmodel:
+            pickle.dump(model, fmodel)
+        model_registry.invalidate(fname)
         logger.info('[{}] : [INFO] Serializing model {} at {}'.format(
             datetime.fromtimestamp(time.time()).strftime(log_format), method, fpath))
 
@@ -19,7 +19,6 @@ import joblib
 import numpy as np
 from sklearn.cluster import DBSCAN
 from sklearn.ensemble import IsolationForest
-import matplotlib.pyplot as plt
 from sklearn import metrics
 # from sklearn.datasets.samples_generator import make_blobs
 from sklearn.preprocessing import StandardScaler
@@ -28,22 +27,28 @@ import os
 from util import str2Bool
 import pandas as pd
 from edelogger import logger
+from edescikit.modelregistry import model_registry
+from edescikit.edeshared import fast_scorer
+from edescikit.edeshap import analysis_setting, sample_positions, batched_shap_values, plot_worker
 from datetime import datetime
 import time
 import sys
-import glob
 from sklearn.decomposition import SparsePCA, PCA
-import pyod
-from util import ut2hum, log_format
-import shap
+from util import log_format, anomaly_records, LazyModule
+
+# Plotting and SHAP are only loaded when plots or prediction analysis are requested
+plt = LazyModule('matplotlib.pyplot')
+shap = LazyModule('shap')
 
 
 class SciCluster:
     def __init__(self,
                  modelDir,
-                 pred_analysis=False):
+                 pred_analysis=False,
+                 scorer=None):
         self.modelDir = modelDir
         self.pred_analysis = pred_analysis
+        self.scorer = scorer
 
     def dask_sdbscanTrain(self,
                           settings,
@@ -282,12 +287,7 @@ class SciCluster:
                              str(data.shape[1])))
             print("dpredict type is %s" % (type(dpredict)))
         if type(dpredict) is not int:
-            anomalyarray = np.argwhere(dpredict == -1)
-            for an in anomalyarray:
-                anomalies = {}
-                anomalies['utc'] = int(data.iloc[an[0]].name)
-                anomalies['hutc'] = ut2hum(int(data.iloc[an[0]].name))
-                anomalieslist.append(anomalies)
+            anomalieslist = anomaly_records(data.index, np.flatnonzero(dpredict == -1))
         anomaliesDict = {}
         anomaliesDict['anomalies'] = anomalieslist
         logger.info('[%s] : [INFO] Detected anomalies with model %s using method %s are -> %s',
@@ -302,7 +302,6 @@ class SciCluster:
         smodel = self.__loadClusterModel(method, model)
         anomaliesList = []
         anomaliesDict = {}
-        shap_values_p = 0
         if not smodel:
             dpredict = 0
         else:
@@ -313,6 +312,13 @@ class SciCluster:
                     for k, v in smodel.get_params().items():
                         logger.info('[{}] : [INFO] Predict model parameter {} set to {}'.format(
                             datetime.fromtimestamp(time.time()).strftime(log_format), k, v))
+                    fast = model_registry.derived(smodel, 'fast_scorer', lambda m: fast_scorer(m, data))
+                    if fast:
+                        dpredict = fast.predict(data)
+                    elif self.scorer is not None:
+                        dpredict = self.scorer.predict(os.path.join(self.modelDir, "%s_%s.pkl" % (method, model)),
+                                                       smodel, data)
+                    else:
                         dpredict = smodel.predict(data)
                 except Exception as inst:
                     logger.error('[{}] : [ERROR] Failed to load predictive model with {} and {}'.format(
@@ -322,37 +328,27 @@ class SciCluster:
                 dpredict = 0
                 logger.warning('[{}] : [WARN] DataFrame is empty with shape {} '.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), str(data.shape)))
-        from pyod.models.iforest import IForest  # pyod.models.iforest.IForest
-        if list(np.unique(dpredict)) == [0, 1] or isinstance(smodel, IForest):
+        # pyod IForest wraps an sklearn IsolationForest, checked without importing pyod
+        if list(np.unique(dpredict)) == [0, 1] or isinstance(getattr(smodel, 'detector_', None), IsolationForest):
             anomaly_label = 1
         else:
             anomaly_label = -1
 
         if type(dpredict) is not int:
             anomalyArray = np.argwhere(dpredict == anomaly_label)
+            anomaliesList = anomaly_records(data.index, anomalyArray)
             if self.pred_analysis and anomalyArray.shape[0]:
-                try:
-                    plot = self.pred_analysis['Plot']
-                    # print(self.pred_analysis['Plot'])
-                except Exception:
-                    plot = False
-                feature_importance, shap_values = self.__shap_analysis(model=smodel, data=data, plot=plot)
+                plot = analysis_setting(self.pred_analysis, 'Plot', False)
+                explained = sample_positions(anomalyArray,
+                                             max_explained=analysis_setting(self.pred_analysis, 'MaxExplained', 100))
+                feature_importance, shap_values = self.__shap_analysis(
+                    model=smodel, data=data.iloc[explained], background=data, plot=plot,
+                    batch_size=analysis_setting(self.pred_analysis, 'BatchSize', 256))
                 anomaliesDict['complete_shap_analysis'] = feature_importance
-                shap_values_p = 1
-            count = 0
-            for an in anomalyArray:
-                anomalies = {}
-                if pd._libs.tslibs.timestamps.Timestamp == type(data.iloc[an[0]].name):
-                    anomalies['utc'] = data.iloc[an[0]].name.timestamp()
-                    anomalies['hutc'] = str(data.iloc[an[0]].name)
-                else:
-                    anomalies['utc'] = int(data.iloc[an[0]].name)
-                    anomalies['hutc'] = ut2hum(int(data.iloc[an[0]].name))
-                if shap_values_p:
-                    anomalies['analysis'] = self.__shap_force_layout(shap_values=shap_values,
-                                                                     instance=count)
-                anomaliesList.append(anomalies)
-                count += 1
+                slot = {pos: i for i, pos in enumerate(anomalyArray.ravel())}
+                for count, pos in enumerate(explained):
+                    anomaliesList[slot[pos]]['analysis'] = self.__shap_force_layout(shap_values=shap_values,
+                                                                                    instance=count)
 
         anomaliesDict['anomalies'] = anomaliesList
         logger.info('[{}] : [INFO] Detected {} anomalies with model {} using method {} '.format(
@@ -363,26 +359,32 @@ class SciCluster:
     def __shap_analysis(self,
                         model,
                         data,
-                        plot=False):
+                        background=None,
+                        plot=False,
+                        batch_size=256):
         """
         Execute shapely value calculation on incoming data and model prediction.
         Several plots are also calculated if set: heatmap, summary and feature importance.
 
         :param model: Predictive model (only for binary classification)
-        :param data: Data collected from monitoring or local file defined in by the user
-        :param plot: If set to True each query interval will also generate the above mentioned plots.
+        :param data: Anomalous instances to be explained
+        :param background: Data used as background when the explainer is first built for the model, defaults to data
+        :param plot: If set to True each query interval will also generate the above mentioned plots in the background.
+        :param batch_size: Number of instances explained at once
         :return: feature importance dictionary form (from pandas dataframe), shapely values
         """
-        explainer = shap.Explainer(model, data)
-        shap_values = explainer(data)
+        if background is None:
+            background = data
+        explainer = model_registry.explainer(model, lambda m: shap.Explainer(m, shap.sample(background, 100)))
+        shap_values = batched_shap_values(explainer, data, batch_size=batch_size)
         vals = np.abs(shap_values.values).mean(0)
         feature_importance = pd.DataFrame(list(zip(shap_values.feature_names, vals)),
                                           columns=['feature_name', 'feature_importance_vals'])
         feature_importance.sort_values(by=['feature_importance_vals'], ascending=False, inplace=True)
         if plot:
-            self.__shap_heatmap(shap_values=shap_values)
-            self.__shap_summary(shap_values=shap_values, data=data)
-            self.__shap_feature_importance(shap_values=shap_values)
+            plot_worker.submit(self.__shap_heatmap, shap_values=shap_values)
+            plot_worker.submit(self.__shap_summary, shap_values=shap_values, data=data)
+            plot_worker.submit(self.__shap_feature_importance, shap_values=shap_values)
         return feature_importance.to_dict(), shap_values
 
     def __shap_force_layout(self,
@@ -497,6 +499,46 @@ class SciCluster:
 
         return clf
 
+    def dask_partialFitMethod(self, cluster_method,
+                              mname,
+                              batches):
+        '''
+        :param cluster_method: -> user defined method exposing partial_fit
+        :param mname: -> name to be used for saved model
+        :param batches: -> iterable of dataframes, consumed one at a time
+        :return: -> fitted model
+        '''
+        logger.info('[{}] : [INFO] Incrementally fitting user defined method {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), type(cluster_method)))
+        for k, v in cluster_method.get_params().items():
+            logger.info('[{}] : [INFO] Method parameter {} set to {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), k, v))
+        nbatches = 0
+        nrows = 0
+        try:
+            for batch in batches:
+                if batch.empty:
+                    continue
+                cluster_method.partial_fit(batch)
+                nbatches += 1
+                nrows += batch.shape[0]
+                logger.debug('[{}] : [DEBUG] Fitted batch {} with shape {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), nbatches, batch.shape))
+        except Exception as inst:
+            logger.error('[{}] : [ERROR] Failed to incrementally fit {} with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), type(cluster_method),
+                type(inst), inst.args))
+            sys.exit(1)
+        if not nbatches:
+            logger.error('[{}] : [ERROR] No data to fit {}, exiting ...'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), type(cluster_method)))
+            sys.exit(1)
+        logger.info('[{}] : [INFO] Fitted {} batches with a total of {} datapoints'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), nbatches, nrows))
+        fname = str(cluster_method).split('(')[0]
+        self.__serializemodel(cluster_method, fname, mname)
+        return cluster_method
+
     def __appendPredictions(self, method, mname, data, pred):
         fpath = "{}_{}.csv".format(method, mname)
         fname = os.path.join(self.modelDir, fpath)
@@ -516,7 +558,9 @@ class SciCluster:
         '''
         fpath = "%s_%s.pkl" % (method, mname)
         fname = os.path.join(self.modelDir, fpath)
-        pickle.dump(model, open(fname, "wb"))
+        with open(fname, "wb") as fmodel:
+            pickle.dump(model, fmodel)
+        model_registry.invalidate(fname)
         logger.info('[{}] : [INFO] Serializing model {} at {}'.format(
                 datetime.fromtimestamp(time.time()).strftime(log_format), method, fpath))
 
@@ -527,13 +571,12 @@ class SciCluster:
         :param model: -> model name
         :return: -> instance of serialized object
         '''
-        lmodel = glob.glob(os.path.join(self.modelDir, ("%s_%s.pkl" % (method, model))))
-        if not lmodel:
+        smodel = model_registry.load(os.path.join(self.modelDir, ("%s_%s.pkl" % (method, model))))
+        if smodel is None:
             logger.warning('[%s] : [WARN] No %s model with the name %s found',
                          datetime.fromtimestamp(time.time()).strftime(log_format), method, model)
             return 0
         else:
-            smodel = pickle.load(open(lmodel[0], "rb"))
             logger.info('[%s] : [INFO] Succesfully loaded %s model with the name %s',
                         datetime.fromtimestamp(time.time()).strftime(log_format), method, model)
             return smodel
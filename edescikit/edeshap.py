@@ -0,0 +1,142 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import atexit
+import queue
+import threading
+from datetime import datetime
+import time
+import numpy as np
+from edelogger import logger
+from util import log_format, LazyModule
+
+shap = LazyModule('shap')
+matplotlib = LazyModule('matplotlib')
+
+
+def analysis_setting(pred_analysis, key, default):
+    '''
+    :param pred_analysis: -> Detect Analysis setting, True or dictionary
+    :param key: -> setting name
+    :param default: -> value used if not set
+    :return: -> setting value
+    '''
+    try:
+        return pred_analysis[key]
+    except Exception:
+        return default
+
+
+def sample_positions(positions, max_explained=100, seed=42):
+    '''
+    :param positions: -> positions of anomalous rows
+    :param max_explained: -> maximum number of rows explained, None explains all
+    :param seed: -> random seed used when sampling
+    :return: -> sorted positions of the rows to be explained
+    '''
+    positions = np.asarray(positions, dtype=np.int64).ravel()
+    if max_explained is None or positions.shape[0] <= max_explained:
+        return positions
+    logger.info('[{}] : [INFO] Explaining {} of {} anomalous instances'.format(
+        datetime.fromtimestamp(time.time()).strftime(log_format), max_explained, positions.shape[0]))
+    return np.sort(np.random.RandomState(seed).choice(positions, size=max_explained, replace=False))
+
+
+def batched_shap_values(fn, data, batch_size=256):
+    '''
+    :param fn: -> shap function called on each batch, explainer.shap_values or explainer
+    :param data: -> dataframe to be explained
+    :param batch_size: -> number of rows explained at once
+    :return: -> shap values merged over all batches, same type as returned by fn
+    '''
+    parts = [fn(data.iloc[i:i + batch_size]) for i in range(0, data.shape[0], batch_size)]
+    if len(parts) == 1:
+        return parts[0]
+    if isinstance(parts[0], list):
+        return [np.concatenate([p[c] for p in parts]) for c in range(len(parts[0]))]
+    if isinstance(parts[0], np.ndarray):
+        return np.concatenate(parts)
+    return shap.Explanation(values=np.concatenate([p.values for p in parts]),
+                            base_values=np.concatenate([np.atleast_1d(p.base_values) for p in parts]),
+                            data=np.concatenate([p.data for p in parts]),
+                            feature_names=parts[0].feature_names)
+
+
+class PlotWorker:
+    """
+    Renders analysis plots outside the detection loop. All rendering happens on one thread with the Agg
+    backend so pyplot is never used concurrently or from a GUI backend, plots are dropped if the queue is full.
+    Pending plots are rendered by drain, called on exit and when a detect process stops.
+    """
+    def __init__(self, max_pending=32):
+        self.max_pending = max_pending
+        self.plots = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.__start_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self.__start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                # a forked detect process inherits neither the thread nor a usable queue, the queue may still
+                # list the parent thread as waiting for plots
+                self.plots = queue.Queue(maxsize=self.max_pending)
+                self.thread = threading.Thread(target=self.__run, name='ede-plot', daemon=True)
+                self.thread.start()
+                atexit.register(self.drain)
+        try:
+            self.plots.put_nowait((fn, args, kwargs))
+        except queue.Full:
+            logger.warning('[{}] : [WARN] Plot queue full, dropping {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), getattr(fn, '__name__', fn)))
+
+    def drain(self, timeout=60):
+        '''
+        :param timeout: -> seconds to wait for the pending plots, None waits until all are rendered
+        :return: -> True if no plots are pending
+        '''
+        if self.thread is None or not self.thread.is_alive():
+            return self.plots.unfinished_tasks == 0
+        deadline = None if timeout is None else time.time() + timeout
+        with self.plots.all_tasks_done:
+            while self.plots.unfinished_tasks:
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    logger.warning('[{}] : [WARN] {} plots still pending after {}s'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), self.plots.unfinished_tasks,
+                        timeout))
+                    return False
+                self.plots.all_tasks_done.wait(wait)
+        return True
+
+    def __run(self):
+        try:
+            matplotlib.use('Agg')
+        except Exception as inst:
+            logger.warning('[{}] : [WARN] Failed to set the Agg plotting backend with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+        while True:
+            fn, args, kwargs = self.plots.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as inst:
+                logger.error('[{}] : [ERROR] Failed to render plot with {} and {}'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), type(inst), inst.args))
+            finally:
+                self.plots.task_done()
+
+
+plot_worker = PlotWorker()
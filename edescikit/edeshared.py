@@ -0,0 +1,427 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import shutil
+import pickle as pickle
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from datetime import datetime
+import time
+import numpy as np
+from sklearn.ensemble import IsolationForest
+from edelogger import logger
+from util import log_format
+
+
+def average_path_length(n_samples):
+    '''
+    :param n_samples: -> array of node sample counts
+    :return: -> average path length of an unsuccessful search in a binary search tree, as used by IsolationForest
+    '''
+    n_samples = np.asarray(n_samples, dtype=np.float64)
+    apl = np.zeros_like(n_samples)
+    two = n_samples == 2
+    many = n_samples > 2
+    apl[two] = 1.0
+    apl[many] = 2.0 * (np.log(n_samples[many] - 1.0) + np.euler_gamma) - 2.0 * (n_samples[many] - 1.0) / n_samples[many]
+    return apl
+
+
+class ForestArrays:
+    """
+    Fitted tree ensemble flattened into contiguous node arrays. Trees of the ensemble are concatenated and
+    delimited by offsets, children of a node are stored side by side and leaves point to themselves so every
+    tree is traversed for a fixed number of steps without branching. Split features are mapped onto input
+    columns. The arrays are saved as plain .npy files and loaded memory mapped so all processes scoring with
+    the same model share one copy of the nodes through the page cache. Supports sklearn IsolationForest (also
+    wrapped by pyod IForest) and single output tree classifiers (RandomForest, ExtraTrees, DecisionTree).
+    """
+    arrays = ('offsets', 'depths', 'children', 'feature', 'threshold', 'missing_left', 'leaf')
+
+    def __init__(self, meta, **arrays):
+        self.meta = meta
+        for name in self.arrays:
+            setattr(self, name, arrays[name])
+
+    @staticmethod
+    def supported(model):
+        if isinstance(getattr(model, 'detector_', None), IsolationForest):
+            model = model.detector_
+        if isinstance(model, IsolationForest):
+            return True
+        estimators = getattr(model, 'estimators_', [model])
+        try:
+            return (hasattr(model, 'classes_') and getattr(model, 'n_outputs_', 1) == 1 and
+                    all(hasattr(e, 'tree_') for e in estimators))
+        except TypeError:
+            return False
+
+    @classmethod
+    def from_model(cls, model):
+        '''
+        :param model: -> fitted model, see supported
+        :return: -> flattened forest, None if the model type is not supported
+        '''
+        if not cls.supported(model):
+            return None
+        meta = {'features': getattr(model, 'feature_names_in_', None)}
+        if isinstance(getattr(model, 'detector_', None), IsolationForest):
+            meta['kind'] = 'pyod_iforest'
+            meta['threshold'] = model.threshold_
+            forest = model.detector_
+        else:
+            forest = model
+        if isinstance(forest, IsolationForest):
+            meta['kind'] = meta.get('kind', 'iforest')
+            meta['offset'] = forest.offset_
+            meta['denominator'] = len(forest.estimators_) * average_path_length([forest.max_samples_])[0]
+            estimators = forest.estimators_
+            subsets = forest.estimators_features_
+        else:
+            meta['kind'] = 'classifier'
+            meta['classes'] = model.classes_
+            estimators = getattr(model, 'estimators_', [model])
+            subsets = [None] * len(estimators)
+        depths, children, feature, threshold, missing_left, leaf = [], [], [], [], [], []
+        offsets = [0]
+        for estimator, subset in zip(estimators, subsets):
+            tree = estimator.tree_
+            n = tree.node_count
+            nodes = np.arange(n)
+            is_leaf = tree.children_left == -1
+            node_depth = np.zeros(n, dtype=np.float64)
+            for node in range(n):  # children always follow their parent
+                if not is_leaf[node]:
+                    node_depth[tree.children_left[node]] = node_depth[node] + 1
+                    node_depth[tree.children_right[node]] = node_depth[node] + 1
+            depths.append(int(node_depth.max()))
+            feat = np.where(is_leaf, 0, tree.feature).astype(np.int64)
+            if subset is not None:
+                feat = np.asarray(subset, dtype=np.int64)[feat]
+            children.append(np.column_stack([np.where(is_leaf, nodes, tree.children_left),
+                                             np.where(is_leaf, nodes, tree.children_right)]).ravel())
+            feature.append(feat)
+            threshold.append(np.where(is_leaf, np.inf, tree.threshold))
+            missing_left.append(getattr(tree, 'missing_go_to_left', np.zeros(n, dtype=np.uint8)).astype(bool))
+            if meta['kind'] == 'classifier':
+                value = tree.value[:, 0, :]
+                leaf.append(value / np.maximum(value.sum(axis=1, keepdims=True), np.finfo(np.float64).tiny))
+            else:
+                leaf.append((node_depth + average_path_length(tree.n_node_samples)).reshape(-1, 1))
+            offsets.append(offsets[-1] + n)
+        meta['n_estimators'] = len(estimators)
+        return cls(meta,
+                   offsets=np.asarray(offsets, dtype=np.int64),
+                   depths=np.asarray(depths, dtype=np.int64),
+                   children=np.concatenate(children).astype(np.intp),
+                   feature=np.concatenate(feature),
+                   threshold=np.concatenate(threshold).astype(np.float64),
+                   missing_left=np.concatenate(missing_left),
+                   leaf=np.concatenate(leaf).astype(np.float64))
+
+    def save(self, location):
+        '''
+        :param location: -> directory the arrays are written to, replaced atomically
+        '''
+        tmp = '{}.tmp{}'.format(location, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name in self.arrays:
+            np.save(os.path.join(tmp, '{}.npy'.format(name)), getattr(self, name))
+        with open(os.path.join(tmp, 'meta.pkl'), 'wb') as fmeta:
+            pickle.dump(self.meta, fmeta)
+        if os.path.isdir(location):
+            shutil.rmtree(location)
+        os.rename(tmp, location)
+        logger.info('[{}] : [INFO] Saved {} shared node arrays with {} nodes at {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), self.meta['kind'], self.feature.shape[0], location))
+
+    @classmethod
+    def load(cls, location):
+        '''
+        :param location: -> directory written by save
+        :return: -> forest with memory mapped, read only node arrays
+        '''
+        with open(os.path.join(location, 'meta.pkl'), 'rb') as fmeta:
+            meta = pickle.load(fmeta)
+        arrays = {name: np.load(os.path.join(location, '{}.npy'.format(name)), mmap_mode='r') for name in cls.arrays}
+        return cls(meta, **arrays)
+
+    def matrix(self, data):
+        '''
+        :param data: -> dataframe in the column layout the model was fitted on
+        :return: -> contiguous float32 feature matrix, trees split on float32 values
+        '''
+        if self.meta['features'] is not None:
+            data = data[list(self.meta['features'])]
+        return np.ascontiguousarray(data.to_numpy(dtype=np.float32))
+
+    def accumulate(self, X):
+        '''
+        :param X: -> float32 feature matrix
+        :return: -> sum of leaf values over all trees for each row
+        '''
+        n = X.shape[0]
+        columns = np.ascontiguousarray(X.T).ravel()  # column major, a split reads one contiguous column
+        rows = np.arange(n, dtype=np.intp)
+        missing = bool(self.missing_left.any()) and bool(np.isnan(columns).any())
+        out = np.zeros((n, self.leaf.shape[1]), dtype=np.float64)
+        for t in range(self.depths.shape[0]):
+            start, stop = int(self.offsets[t]), int(self.offsets[t + 1])
+            feature = self.feature[start:stop] * n
+            threshold = self.threshold[start:stop]
+            children = self.children[2 * start:2 * stop]
+            node = np.zeros(n, dtype=np.intp)
+            for _ in range(int(self.depths[t])):
+                x = columns.take(feature.take(node) + rows)
+                right = ~(x <= threshold.take(node))
+                if missing:
+                    right &= ~(np.isnan(x) & self.missing_left[start:stop].take(node))
+                node = children.take(2 * node + right)
+            out += self.leaf[start:stop].take(node, axis=0)
+        return out
+
+    def scores(self, raw):
+        '''
+        :param raw: -> accumulated leaf values of an isolation forest
+        :return: -> decision function of the model, pyod IForest scores are inverted
+        '''
+        decision = -(2.0 ** (-raw[:, 0] / self.meta['denominator'])) - self.meta['offset']
+        if self.meta['kind'] == 'pyod_iforest':
+            return -decision
+        return decision
+
+    def finalize(self, raw):
+        '''
+        :param raw: -> accumulated leaf values
+        :return: -> predictions with the same labels as model.predict
+        '''
+        if self.meta['kind'] == 'classifier':
+            return np.asarray(self.meta['classes']).take(np.argmax(raw, axis=1))
+        if self.meta['kind'] == 'pyod_iforest':
+            return (self.scores(raw) > self.meta['threshold']).astype(int)
+        return np.where(self.scores(raw) < 0, -1, 1)
+
+    def decision_function(self, data):
+        return self.scores(self.accumulate(self.matrix(data)))
+
+    def predict(self, data):
+        return self.finalize(self.accumulate(self.matrix(data)))
+
+
+class HBOSArrays:
+    """
+    Fitted pyod HBOS reduced to its bin edges and log densities. A window is binned for all features at
+    once, values slightly outside the fitted range (within tol of a bin width) take the score of the edge
+    bin, values further out the lowest score of the feature, as in pyod.
+    """
+    def __init__(self, bin_edges, hist, alpha, tol, threshold):
+        '''
+        :param bin_edges: -> bin edges, n_bins + 1 rows and one column per feature
+        :param hist: -> bin densities, n_bins rows and one column per feature
+        :param alpha: -> density regulariser
+        :param tol: -> fraction of a bin width tolerated outside the fitted range
+        :param threshold: -> decision threshold of the fitted model
+        '''
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        self.log_density = np.log2(np.asarray(hist, dtype=np.float64) + alpha)
+        self.low_margin = tol * (self.bin_edges[1] - self.bin_edges[0])
+        self.high_margin = tol * (self.bin_edges[-1] - self.bin_edges[-2])
+        self.minimum = self.log_density.min(axis=0)
+        self.threshold = threshold
+
+    @classmethod
+    def from_model(cls, model):
+        '''
+        :param model: -> fitted pyod HBOS
+        :return: -> array only scorer, None if the model is not a HBOS with a common number of bins
+        '''
+        if type(model).__name__ != 'HBOS' or not isinstance(getattr(model, 'contamination', None), (float, int)):
+            return None
+        hist, edges = getattr(model, 'hist_', None), getattr(model, 'bin_edges_', None)
+        if not isinstance(hist, np.ndarray) or not isinstance(edges, np.ndarray) or hist.ndim != 2:
+            return None
+        return cls(edges, hist, model.alpha, model.tol, model.threshold_)
+
+    def decision_function(self, data):
+        X = np.asarray(data, dtype=np.float64)
+        n_bins = self.log_density.shape[0]
+        columns = np.arange(X.shape[1])
+        bins = (X[:, None, :] > self.bin_edges[None, :, :]).sum(axis=1)  # np.digitize(right=True) of every feature
+        score = self.log_density[np.clip(bins - 1, 0, n_bins - 1), columns]
+        score = np.where(bins == 0,
+                         np.where(self.bin_edges[0] - X <= self.low_margin, self.log_density[0], self.minimum), score)
+        score = np.where(bins == n_bins + 1,
+                         np.where(X - self.bin_edges[-1] <= self.high_margin, self.log_density[-1], self.minimum),
+                         score)
+        return -score.sum(axis=1)
+
+    def predict(self, data):
+        return (self.decision_function(data) > self.threshold).astype(int)
+
+
+def fast_scorer(model, data, rows=100):
+    '''
+    Array only scorer for pyod HBOS and IForest models, checked against the model on the first rows
+
+    :param model: -> fitted model
+    :param data: -> window used for the check
+    :param rows: -> number of rows compared
+    :return: -> scorer with decision_function and predict, False if not supported or not matching the model
+    '''
+    if isinstance(getattr(model, 'detector_', None), IsolationForest):
+        if not isinstance(getattr(model, 'contamination', None), (float, int)):
+            return False  # threshold given by a PyThresh object
+        scorer = ForestArrays.from_model(model)
+    else:
+        scorer = HBOSArrays.from_model(model)
+    if scorer is None:
+        return False
+    sample = data.iloc[:rows]
+    try:
+        matching = (np.allclose(scorer.decision_function(sample), model.decision_function(sample)) and
+                    np.array_equal(scorer.predict(sample), model.predict(sample)))
+    except Exception as inst:
+        logger.warning('[{}] : [WARN] Failed to check fast scorer of {} with {} and {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), type(model).__name__, type(inst), inst.args))
+        matching = False
+    if not matching:
+        logger.warning('[{}] : [WARN] Fast scorer differs from {}, scoring with the model'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), type(model).__name__))
+        return False
+    logger.info('[{}] : [INFO] Scoring {} with the array only fast path'.format(
+        datetime.fromtimestamp(time.time()).strftime(log_format), type(model).__name__))
+    return scorer
+
+
+_worker_forests = {}
+
+
+def _score_shard(location, name, shape, start, stop):
+    '''
+    Executed in a scoring worker, reads its row range of the shared feature matrix in place.
+    '''
+    signature = os.stat(os.path.join(location, 'meta.pkl')).st_mtime_ns
+    cached = _worker_forests.get(location)
+    if cached is None or cached[0] != signature:
+        cached = (signature, ForestArrays.load(location))
+        _worker_forests[location] = cached
+    shm = shared_memory.SharedMemory(name=name)  # spawned workers share the resource tracker of the detect process
+    try:
+        X = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        raw = cached[1].accumulate(X[start:stop])
+        del X
+    finally:
+        shm.close()
+    return raw
+
+
+class SharedScorer:
+    """
+    Scores detection windows with a pool of worker processes. Fitted tree ensembles are flattened into
+    memory mapped node arrays next to the serialized model and the window feature matrix is placed in shared
+    memory, each worker scores a row range of it without copying model or data. Models that cannot be
+    flattened, or whose flattened predictions differ from the model, are scored in process.
+    """
+    def __init__(self, workers=2, min_rows=2048):
+        '''
+        :param workers: -> number of scoring processes
+        :param min_rows: -> windows with fewer rows are scored in the detect process
+        '''
+        self.workers = max(int(workers), 1)
+        self.min_rows = min_rows
+        self.pool = None
+        self.__published = {}
+        self.__pool_lock = threading.Lock()
+
+    def __publish(self, location, model, data):
+        try:
+            signature = os.stat(location).st_mtime_ns
+        except OSError:
+            return None
+        published = self.__published.get(location)
+        if published is not None and published[0] == signature:
+            return published[1]
+        shared = '{}.shared'.format(location)
+        forest = None
+        try:
+            if os.path.isfile(os.path.join(shared, 'meta.pkl')) and \
+                    os.stat(os.path.join(shared, 'meta.pkl')).st_mtime_ns >= signature:
+                forest = ForestArrays.load(shared)
+            else:
+                forest = ForestArrays.from_model(model)
+                if forest is not None:
+                    forest.save(shared)
+                    forest = ForestArrays.load(shared)
+            if forest is not None:
+                sample = data.iloc[:100]
+                if not np.array_equal(forest.predict(sample), np.asarray(model.predict(sample))):
+                    logger.warning('[{}] : [WARN] Shared node arrays of {} differ from model predictions, scoring in process'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), location))
+                    forest = None
+        except Exception as inst:
+            logger.warning('[{}] : [WARN] Failed to publish shared model {} with {} and {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), location, type(inst), inst.args))
+            forest = None
+        if forest is None:
+            logger.info('[{}] : [INFO] Model {} scored in process'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), location))
+        self.__published[location] = (signature, forest, shared)
+        return forest
+
+    def predict(self, location, model, data):
+        '''
+        :param location: -> location of the serialized model
+        :param model: -> deserialized model, used for unsupported models and verification
+        :param data: -> detection window
+        :return: -> predictions
+        '''
+        forest = self.__publish(location, model, data)
+        if forest is None:
+            return model.predict(data)
+        X = forest.matrix(data)
+        if self.workers < 2 or X.shape[0] < self.min_rows:
+            return forest.finalize(forest.accumulate(X))
+        with self.__pool_lock:
+            if self.pool is None:
+                logger.info('[{}] : [INFO] Starting {} shared memory scoring workers'.format(
+                    datetime.fromtimestamp(time.time()).strftime(log_format), self.workers))
+                # the detect process runs reporting, plotting and connector threads, forking it could copy
+                # locks held by them into the workers
+                self.pool = multiprocessing.get_context('spawn').Pool(self.workers)
+        shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+        try:
+            np.ndarray(X.shape, dtype=np.float32, buffer=shm.buf)[:] = X
+            bounds = np.linspace(0, X.shape[0], self.workers + 1).astype(int)
+            shards = [(self.__published[location][2], shm.name, X.shape, int(s), int(e))
+                      for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+            raw = np.concatenate(self.pool.starmap(_score_shard, shards))
+        finally:
+            shm.close()
+            shm.unlink()
+        return forest.finalize(raw)
+
+    def close(self):
+        '''
+        Stop the scoring workers, safe to call more than once
+        '''
+        with self.__pool_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
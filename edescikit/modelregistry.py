@@ -0,0 +1,137 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import pickle as pickle
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import time
+from edelogger import logger
+from util import log_format
+
+
+class ModelRegistry:
+    """
+    In-process cache of deserialized models shared by all SciCluster and SciClassification instances.
+    Entries are keyed by path and validated against the file mtime and size on every lookup, a model
+    rewritten on disk is reloaded on the next lookup. Least recently used models are evicted once
+    max_models is reached. Explainers and other objects derived from a model are cached alongside it and
+    dropped with it.
+    """
+    def __init__(self, max_models=8):
+        self.max_models = max_models
+        self.__models = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__loading = {}  # per path lock, a model is deserialized once while other models are served
+
+    def load(self, path):
+        '''
+        :param path: -> location of the pickled model
+        :return: -> deserialized model, None if the file does not exist
+        '''
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return None
+        signature = (st.st_mtime_ns, st.st_size)
+        with self.__lock:
+            model = self.__cached(path, signature)
+            if model is not None:
+                return model
+            loading = self.__loading.setdefault(path, threading.Lock())
+        with loading:
+            with self.__lock:  # loaded by another thread while waiting
+                model = self.__cached(path, signature)
+                if model is not None:
+                    return model
+            start = time.time()
+            with open(path, 'rb') as fmodel:
+                model = pickle.load(fmodel)
+            logger.info('[{}] : [INFO] Loaded model {} in {:.3f} seconds'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), path, time.time() - start))
+            with self.__lock:
+                self.__models[path] = {'signature': signature, 'model': model, 'derived': {}}
+                self.__models.move_to_end(path)
+                while len(self.__models) > max(self.max_models, 1):
+                    evicted, _ = self.__models.popitem(last=False)
+                    logger.info('[{}] : [INFO] Evicted model {} from cache'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), evicted))
+            return model
+
+    def __cached(self, path, signature):
+        '''
+        Called with the registry lock held
+
+        :param path: -> location of the pickled model
+        :param signature: -> mtime and size of the file
+        :return: -> cached model, None if missing or changed on disk
+        '''
+        entry = self.__models.get(path)
+        if entry is None:
+            return None
+        if entry['signature'] != signature:
+            logger.info('[{}] : [INFO] Model {} changed on disk, reloading'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), path))
+            return None
+        self.__models.move_to_end(path)
+        logger.debug('[{}] : [DEBUG] Model {} served from cache'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), path))
+        return entry['model']
+
+    def derived(self, model, key, factory):
+        '''
+        :param model: -> model returned by load, other models are not cached
+        :param key: -> name of the derived object
+        :param factory: -> callable building the object from the model, called once per loaded model
+        :return: -> derived object for model
+        '''
+        with self.__lock:
+            entry = next((e for e in self.__models.values() if e['model'] is model), None)
+            if entry is not None and key in entry['derived']:
+                return entry['derived'][key]
+        value = factory(model)
+        if entry is not None:
+            with self.__lock:
+                entry['derived'][key] = value
+        return value
+
+    def explainer(self, model, factory):
+        '''
+        :param model: -> model returned by load, other models are not cached
+        :param factory: -> callable building the explainer, called once per loaded model
+        :return: -> explainer for model
+        '''
+        def build(m):
+            logger.info('[{}] : [INFO] Building explainer for {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), str(m).split('(')[0]))
+            return factory(m)
+        return self.derived(model, 'explainer', build)
+
+    def invalidate(self, path=None):
+        '''
+        :param path: -> model location to drop, None clears the cache
+        '''
+        with self.__lock:
+            if path is None:
+                self.__models.clear()
+            else:
+                self.__models.pop(path, None)
+
+
+model_registry = ModelRegistry()
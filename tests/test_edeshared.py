@@ -0,0 +1,109 @@
+"""
+Copyright 2021, Institute e-Austria, Timisoara, Romania
+    http://www.ieat.ro/
+Developers:
+ * Gabriel Iuhasz, iuhasz.gabriel@info.uvt.ro
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import IsolationForest, RandomForestClassifier
+from edescikit.edeshared import ForestArrays, HBOSArrays, fast_scorer
+
+
+@pytest.fixture
+def train():
+    rng = np.random.RandomState(0)
+    return pd.DataFrame(rng.randn(500, 4), columns=['cpu', 'mem', 'disk', 'net'])
+
+
+@pytest.fixture
+def window(train):
+    '''
+    Unseen rows followed by rows far outside the training range
+    '''
+    rng = np.random.RandomState(1)
+    extreme = np.array([[1e6, -1e6, 0.0, 0.0],
+                        [-50.0, 50.0, -50.0, 50.0],
+                        [np.finfo(np.float32).max, 0.0, 0.0, np.finfo(np.float32).min]])
+    return pd.DataFrame(np.vstack([rng.randn(200, 4) * 3, extreme]), columns=train.columns)
+
+
+def hbos_edge_window(model):
+    '''
+    :param model: -> fitted pyod HBOS
+    :return: -> rows on, just inside tol of and beyond tol of the first and last bin edge of every feature
+    '''
+    edges = model.bin_edges_
+    low = edges[1] - edges[0]
+    high = edges[-1] - edges[-2]
+    rows = [edges[0], edges[-1],
+            edges[0] - 0.5 * model.tol * low, edges[-1] + 0.5 * model.tol * high,
+            edges[0] - 2.0 * model.tol * low, edges[-1] + 2.0 * model.tol * high,
+            edges[0] - 1e3, edges[-1] + 1e3]
+    return np.vstack(rows)
+
+
+def test_iforest_arrays_match_sklearn(train, window):
+    model = IsolationForest(n_estimators=50, random_state=0).fit(train)
+    scorer = ForestArrays.from_model(model)
+    assert np.allclose(scorer.decision_function(window), model.decision_function(window))
+    assert np.array_equal(scorer.predict(window), model.predict(window))
+
+
+def test_forest_arrays_match_classifier(train, window):
+    labels = (train['cpu'] + train['mem'] > 1).astype(int)
+    model = RandomForestClassifier(n_estimators=20, random_state=0).fit(train, labels)
+    scorer = ForestArrays.from_model(model)
+    assert np.array_equal(scorer.predict(window), model.predict(window))
+
+
+def test_forest_arrays_shared_load(train, window, tmp_path):
+    model = IsolationForest(n_estimators=20, random_state=0).fit(train)
+    location = str(tmp_path / 'iforest.shared')
+    ForestArrays.from_model(model).save(location)
+    scorer = ForestArrays.load(location)
+    assert np.allclose(scorer.decision_function(window), model.decision_function(window))
+
+
+def test_fast_scorer_unsupported(train):
+    model = IsolationForest(n_estimators=10, random_state=0).fit(train)
+    assert fast_scorer(model, train) is False
+
+
+def test_fast_scorer_pyod_iforest(train, window):
+    iforest = pytest.importorskip('pyod.models.iforest')
+    model = iforest.IForest(n_estimators=50, contamination=0.05, random_state=0).fit(train.to_numpy())
+    scorer = fast_scorer(model, window)
+    assert scorer is not False
+    X = window.to_numpy()
+    assert np.allclose(scorer.decision_function(window), model.decision_function(X))
+    assert np.array_equal(scorer.predict(window), model.predict(X))
+
+
+@pytest.mark.parametrize('n_bins,tol', [(10, 0.5), (25, 0.1)])
+def test_hbos_arrays_match_pyod(train, window, n_bins, tol):
+    hbos = pytest.importorskip('pyod.models.hbos')
+    model = hbos.HBOS(n_bins=n_bins, tol=tol, contamination=0.05).fit(train.to_numpy())
+    scorer = HBOSArrays.from_model(model)
+    assert scorer is not None
+    X = np.vstack([window.to_numpy(), hbos_edge_window(model)])
+    assert np.allclose(scorer.decision_function(X), model.decision_function(X))
+    assert np.array_equal(scorer.predict(X), model.predict(X))
+
+
+def test_fast_scorer_pyod_hbos(train, window):
+    hbos = pytest.importorskip('pyod.models.hbos')
+    model = hbos.HBOS(contamination=0.05).fit(train.to_numpy())
+    assert isinstance(fast_scorer(model, window), HBOSArrays)
@@ -29,7 +29,19 @@ import csv
 import pandas as pd
 from datetime import datetime
 import time
+import json
 import numpy as np
+import importlib
+import threading
+import types
+from collections import OrderedDict
+from dateutil import tz
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
 
 
 modelDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
@@ -48,6 +60,64 @@ modelDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
 
 log_format = '%Y-%m-%d %H:%M:%S'
 
+# Modules that should only be loaded by the methods that need them
+heavy_modules = ('tensorflow', 'keras', 'shap', 'yellowbrick', 'seaborn', 'imblearn', 'tpot', 'deap', 'dask',
+                 'distributed', 'dask_ml', 'matplotlib', 'torch')
+lazy_imports = OrderedDict()  # module name -> import time in seconds
+_lazy_lock = threading.RLock()  # reentrant, a lazy import may trigger another one
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module imported on first attribute access. Used for subsystems only needed by some methods (TensorFlow,
+    SHAP, yellowbrick etc.) so a detection run only pays for what its model type uses. Import times are
+    recorded in lazy_imports.
+    """
+    def __init__(self, name, on_load=None):
+        '''
+        :param name: -> full module name
+        :param on_load: -> callable receiving the module after the first import
+        '''
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_on_load'] = on_load
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with _lazy_lock:
+                module = self.__dict__['_module']
+                if module is None:
+                    start = time.time()
+                    module = importlib.import_module(self.__name__)
+                    if self.__dict__['_on_load'] is not None:
+                        self.__dict__['_on_load'](module)
+                    lazy_imports[self.__name__] = time.time() - start
+                    logger.info('[{}] : [INFO] Loaded {} on demand in {:.3f} seconds'.format(
+                        datetime.fromtimestamp(time.time()).strftime(log_format), self.__name__,
+                        lazy_imports[self.__name__]))
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def import_profile(start=None):
+    '''
+    :param start: -> process start time, adds the elapsed startup time
+    :return: -> dictionary with on demand imports and their time and the heavy modules already loaded
+    '''
+    profile = {'on_demand': {k: round(v, 3) for k, v in lazy_imports.items()},
+               'heavy_loaded': sorted({m for m in heavy_modules if m in sys.modules})}
+    if start is not None:
+        profile['startup_seconds'] = round(time.time() - start, 3)
+    return profile
+
+
 def queryParser(query):
     '''
     :param query: -> query of the form  {"Query": "yarn:resourcemanager, clustre, jvm_NM;system"}
@@ -254,6 +324,8 @@ def parseDelay(st):
         return int(st[:-1])*60
     elif 'h' == st[-1:]:
         return int(st[:-1]) * 3600
+    elif 'd' == st[-1:]:
+        return int(st[:-1]) * 86400
     else:
         return 0
 
@@ -265,6 +337,47 @@ def ut2hum(ut):
     return htime
 
 
+def ut2hum_array(ut):
+    """
+    Vectorized ut2hum, values are treated as milliseconds unless that falls in 1970, in which case seconds
+
+    :param ut: array of unix timestamps in seconds or milliseconds
+    :return: array of local time strings formatted with log_format
+    """
+    ut = np.asarray(ut, dtype=np.int64)
+    htime = pd.to_datetime(ut, unit='ms', utc=True).tz_convert(tz.tzlocal())
+    seconds = htime.year == 1970
+    if seconds.any():
+        ms = np.where(seconds, ut * 1000, ut)
+        htime = pd.to_datetime(ms, unit='ms', utc=True).tz_convert(tz.tzlocal())
+    return np.asarray(htime.strftime(log_format))
+
+
+def anomaly_records(index, positions, labels=None, label_key='type'):
+    """
+    Build the anomaly report of the selected rows without per row dataframe indexing
+
+    :param index: dataframe index, unix timestamps or datetimes
+    :param positions: positions of the anomalous rows
+    :param labels: predicted labels for every row, added under label_key as python scalars if set
+    :param label_key: name of the label field
+    :return: list of dictionaries containing utc, hutc and the label
+    """
+    positions = np.asarray(positions, dtype=np.int64).ravel()
+    selected = index[positions]
+    if isinstance(selected, pd.DatetimeIndex):
+        utc = ((selected - pd.Timestamp(0, tz=selected.tz)) / pd.Timedelta(seconds=1)).tolist()
+        hutc = list(selected.map(str))
+    else:
+        utc = np.asarray(selected, dtype=np.int64)
+        hutc = ut2hum_array(utc).tolist()
+        utc = utc.tolist()
+    if labels is None:
+        return [{'utc': u, 'hutc': h} for u, h in zip(utc, hutc)]
+    types = np.asarray(labels)[positions].tolist()
+    return [{'utc': u, 'hutc': h, label_key: t} for u, h, t in zip(utc, hutc, types)]
+
+
 def parseMethodSettings(st):
     if st == 'default':
         return 0
@@ -360,6 +473,120 @@ def revers_oh(y_oh):
     return decode
 
 
+checkpoint_ext = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.csv'}
+
+
+def write_frame(df, path, fmt='parquet', compression='snappy', index=True):
+    """
+    Persist a dataframe using the selected checkpoint backend. Parquet and Feather keep dtypes and the index.
+
+    :param df: dataframe to persist
+    :param path: file location without extension
+    :param fmt: parquet, feather or csv
+    :param compression: codec used by the columnar formats (ex. snappy, zstd, lz4), None for no compression
+    :param index: persist the index
+    :return: location of the written file
+    """
+    if fmt not in checkpoint_ext:
+        logger.error('[{}] : [ERROR] Unsupported checkpoint format {}, supported are {}'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), fmt, list(checkpoint_ext.keys())))
+        sys.exit(1)
+    if fmt != 'csv' and pa is None:
+        logger.warning('[{}] : [WARN] pyarrow not installed, checkpoint format {} falling back to csv'.format(
+            datetime.fromtimestamp(time.time()).strftime(log_format), fmt))
+        fmt = 'csv'
+    floc = "{}{}".format(path, checkpoint_ext[fmt])
+    if fmt == 'csv':
+        df.to_csv(floc, index=index)
+    else:
+        table = pa.Table.from_pandas(df, preserve_index=index)
+        if fmt == 'parquet':
+            pq.write_table(table, floc, compression=compression or 'none')
+        else:
+            if compression not in ('lz4', 'zstd'):
+                compression = 'uncompressed'
+            feather.write_feather(table, floc, compression=compression)
+    return floc
 
 
+def read_frame(floc, columns=None, time_range=None, time_col='time'):
+    """
+    Load a dataframe persisted with write_frame or any csv, parquet, feather/Arrow IPC or npy file,
+    format inferred from extension. Columnar and npy files are memory mapped and only the selected
+    columns and rows are materialized.
+
+    :param floc: file location
+    :param columns: list of columns or a predicate on the column name, None loads all columns.
+    The index and time_col are always loaded.
+    :param time_range: tuple (gd, ld), only rows with gd < time_col < ld are loaded, gd can be None
+    :param time_col: name of the timestamp column used by time_range
+    :return: dataframe
+    """
+    ext = os.path.splitext(floc)[1].lower()
 
+    def __select(names, keep=()):
+        if columns is None:
+            return None
+        if callable(columns):
+            selected = [c for c in names if c in keep or columns(c)]
+        else:
+            selected = [c for c in names if c in keep or c in set(columns)]
+        if all(c in keep for c in selected):
+            logger.warning('[{}] : [WARN] Column selection matches no data columns of {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), floc))
+        return selected
+
+    if ext == '.npy':
+        arr = np.load(floc, mmap_mode='r')
+        if arr.dtype.names is None:
+            names = [str(c) for c in range(arr.shape[1])]
+            df_arr = {n: arr[:, i] for i, n in enumerate(names)}
+        else:
+            names = list(arr.dtype.names)
+            df_arr = {n: arr[n] for n in names}
+        selected = __select(names, keep=(time_col,))
+        if selected is None:
+            selected = names
+        if time_range is not None and time_col in df_arr:
+            mask = _time_mask(df_arr[time_col], time_range)
+            return pd.DataFrame({n: np.asarray(df_arr[n][mask]) for n in selected})
+        return pd.DataFrame({n: np.asarray(df_arr[n]) for n in selected})
+    if ext in ('.parquet', '.feather', '.arrow', '.ipc'):
+        if pa is None:
+            logger.error('[{}] : [ERROR] pyarrow is required to load {}'.format(
+                datetime.fromtimestamp(time.time()).strftime(log_format), floc))
+            sys.exit(1)
+        if ext == '.parquet':
+            schema = pq.read_schema(floc)
+        else:
+            with pa.memory_map(floc) as source:
+                schema = pa.ipc.open_file(source).schema
+        index_cols = []
+        if schema.metadata and b'pandas' in schema.metadata:
+            index_cols = [c for c in json.loads(schema.metadata[b'pandas'])['index_columns'] if isinstance(c, str)]
+        selected = __select(schema.names, keep=tuple(index_cols) + (time_col,))
+        filters = None
+        if time_range is not None and time_col in schema.names:
+            filters = [(time_col, '<', time_range[1])]
+            if time_range[0] is not None:
+                filters.append((time_col, '>', time_range[0]))
+        if ext == '.parquet':
+            table = pq.read_table(floc, columns=selected, filters=filters, memory_map=True)
+        else:
+            table = feather.read_table(floc, columns=selected, memory_map=True)
+            if filters is not None:
+                mask = _time_mask(table.column(time_col).to_numpy(), time_range)
+                table = table.filter(pa.array(mask))
+        return table.to_pandas()
+    df = pd.read_csv(floc, usecols=__select(list(pd.read_csv(floc, nrows=0).columns), keep=(time_col,)))
+    if time_range is not None and time_col in df.columns:
+        df = df[_time_mask(df[time_col].values, time_range)]
+    return df
+
+
+def _time_mask(values, time_range):
+    gd, ld = time_range
+    mask = values < ld
+    if gd is not None:
+        mask &= values > gd
+    return mask